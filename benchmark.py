@@ -0,0 +1,465 @@
+"""
+Benchmark Suite of the Data Pipeline and the UResNet Models
+
+This program measures the performance of the main parts of the training and
+evaluation, to find performance regressions. It needs no real data: a
+synthetic dataset is generated with the DSAD layout (directories with
+'imageXX.png' frames and 'maskXX.png' masks), and the benchmarks are:
+
+    - 'dataset': samples/s of 'DresdenDataset.__getitem__' (PNG decoding);
+    - 'transforms': samples/s of the training and validation transforms of
+      'get_loaders' (with decoded frames, so only the transforms count);
+    - 'loaders': time to build the loaders of 'get_loaders' and to get the
+      first training batch;
+    - 'model': forward and backward time (ms) and peak memory (MB) of each
+      UResNet depth and resolution in '--models' and '--sizes';
+    - 'check_accuracy': samples/s of 'check_accuracy' in the validation set;
+    - 'precision' (with '--precision bf16', for example): forward and training
+      step time of each depth in '--models' with fp32 and with the autocast
+      dtype, their speedup, and the Dice parity between both in the synthetic
+      validation set (the difference of the Dice scores and the agreement of
+      the predicted masks, see 'utils.Precision');
+    - 'compile' (with '--compile'): compile time (s) of the model, the loss
+      and the optimizer step with 'torch.compile', and the steady-state
+      training step and forward time of each depth in '--models' in eager
+      and compiled mode (channels_last, see 'utils.CompiledMode').
+
+The results are saved as JSON, and with '--compare' they are compared with a
+baseline (a JSON saved before), flagging the metrics that got worse by more
+than '--tolerance' (the program then exits with code 1).
+
+Examples:
+    python benchmark.py --output baseline.json
+    python benchmark.py --output current.json --compare baseline.json
+    python benchmark.py --results current.json --compare baseline.json
+
+Metrics with names ending in '/s' (and the speedups and agreements) are
+better when higher, and the others (times, memory and differences) are
+better when lower. Use '--quick' for a short run.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+import model as models
+import dataset
+from utils import get_loaders, check_accuracy, peak_memory, reset_peak_memory
+from utils import evaluate, MetricSink, EvaluationSink, Precision, CompiledMode
+from export import measure
+
+
+#%% Synthetic Dataset
+
+def make_synthetic_dsad(root, directories=3, frames=8, size=(1024, 1280), seed=0):
+    '''Write a synthetic dataset with the DSAD layout, returning its directories
+
+    Each directory 'root/liver/NN' has 'frames' pairs of 'imageXX.png' (smooth
+    colors with noise, to have a realistic PNG size) and 'maskXX.png' (an
+    ellipse in white, as the liver in the DSAD masks), of 'size' (height,
+    width). Existing frames are not written again.
+    '''
+    rng = np.random.default_rng(seed)
+    height, width = size
+    rows, cols = np.mgrid[0:height, 0:width]
+    dirs = []
+    for d in range(directories):
+        directory = os.path.join(root, 'liver', '%02d' % (d+1))
+        os.makedirs(directory, exist_ok=True)
+        dirs.append(directory)
+        for f in range(frames):
+            image_path = os.path.join(directory, 'image%02d.png' % f)
+            mask_path = os.path.join(directory, 'mask%02d.png' % f)
+            if os.path.isfile(image_path) and os.path.isfile(mask_path):
+                continue
+            # an ellipse with random center and axes
+            cy, cx = rng.uniform(0.3, 0.7)*height, rng.uniform(0.3, 0.7)*width
+            ay, ax = rng.uniform(0.15, 0.35)*height, rng.uniform(0.15, 0.35)*width
+            mask = ((rows-cy)/ay)**2+((cols-cx)/ax)**2 < 1
+            # low frequency colors, upsampled, with some noise
+            low = rng.uniform(40, 200, (height//64+1, width//64+1, 3)).astype(np.uint8)
+            image = np.array(Image.fromarray(low).resize((width, height), Image.BILINEAR),
+                             dtype=np.int16)
+            image[mask] += 30
+            image += rng.integers(-8, 9, image.shape, dtype=np.int16)
+            Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(image_path)
+            Image.fromarray((255*mask).astype(np.uint8)).save(mask_path)
+    return dirs
+
+
+#%% Benchmarks
+
+# current memory in bytes (allocated by torch in CUDA, resident in CPU)
+def current_memory(device='cpu'):
+    if str(device).startswith('cuda'):
+        return torch.cuda.memory_allocated()
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return 0
+
+
+def bench_dataset(dirs, iterations=3):
+    '''Samples/s of 'DresdenDataset.__getitem__' (decoding, no transforms)'''
+    datasets = [dataset.DresdenDataset(directory) for directory in dirs]
+    samples = sum(len(d) for d in datasets)
+    def run(_):
+        for d in datasets:
+            for i in range(len(d)):
+                d[i]
+    seconds = measure(run, None, iterations, warmup=1)
+    return {'samples/s': samples/seconds}
+
+
+def bench_transforms(loaders, iterations=3, samples=8):
+    '''Samples/s of the per-sample transforms (and of the batch collation)'''
+    train_loader, _, valid_loader = loaders
+    train_dataset, valid_dataset = train_loader.dataset, valid_loader.dataset
+    # the frames are decoded before, so only the transforms are measured
+    index = train_dataset.index
+    raw = [dataset.read_sample(index.image_dirs[index.directory[frame]],
+                               index.image_names[frame], index.label_names[frame],
+                               label_mode=train_dataset.label_mode)
+           for frame in train_dataset.frames[:samples]]
+    results = {}
+    for name, transforms in [('train', train_dataset.transforms),
+                             ('valid', valid_dataset.transforms)]:
+        def run(_):
+            for transform in transforms:
+                for sample in raw:
+                    transform(dict(sample))
+        seconds = measure(run, None, iterations, warmup=1)
+        results[name+' samples/s'] = len(raw)*len(transforms)/seconds
+    # with 'batched_augmentation', the augmentations run in 'collate_fn'
+    if getattr(train_loader.collate_fn, 'augment', None) is not None:
+        transform = train_dataset.transforms[0]
+        batch = []
+        for m in range(len(train_dataset.transforms)):
+            for sample in raw:
+                sample = transform(dict(sample))
+                sample['recipe'] = m
+                batch.append(sample)
+        seconds = measure(train_loader.collate_fn, batch, iterations, warmup=1)
+        results['batch augment samples/s'] = len(batch)/seconds
+    return results
+
+
+def bench_loaders(dirs, height, width, batch_size, num_workers, batched_augmentation):
+    '''Seconds to build the loaders of 'get_loaders' and to get a first batch'''
+    start = time.perf_counter()
+    loaders = get_loaders(train_image_dir=dirs[:-1], valid_percent=0, test_percent=0.15,
+                          batch_size=batch_size, image_height=height, image_width=width,
+                          num_workers=num_workers, pin_memory=False,
+                          val_image_dir=dirs[-1:], label_mode='index',
+                          batched_augmentation=batched_augmentation)
+    startup = time.perf_counter()-start
+    next(iter(loaders[0]))
+    first_batch = time.perf_counter()-start-startup
+    return {'startup (s)': startup, 'first batch (s)': first_batch}, loaders
+
+
+def bench_model(name, height, width, batch_size=2, iterations=3, device='cpu'):
+    '''Forward and backward time (ms) and peak memory (MB) of a training step'''
+    torch.manual_seed(0)
+    model = getattr(models, name)(in_channels=3, num_classes=2).to(device).train()
+    loss_fn = nn.L1Loss()
+    x = torch.randn(batch_size, 3, height, width, device=device)
+    y = torch.rand(batch_size, 2, height, width, device=device)
+    forward, backward = [], []
+    for i in range(iterations+1):
+        model.zero_grad(set_to_none=True)
+        # the first step is a warm-up, and the memory of the step is measured
+        # above the memory of the model (and its inputs)
+        if i == 1:
+            base = current_memory(device)
+            reset_peak_memory(device)
+        start = time.perf_counter()
+        loss = loss_fn(model(x), y)
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        middle = time.perf_counter()
+        loss.backward()
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        if i > 0:
+            forward.append(middle-start)
+            backward.append(time.perf_counter()-middle)
+        del loss
+    memory = max(peak_memory(device)-base, 0)
+    return {'forward (ms)': 1000*float(np.median(forward)),
+            'backward (ms)': 1000*float(np.median(backward)),
+            'peak memory (MB)': memory/1024**2,
+            'train samples/s': batch_size/(float(np.median(forward))+float(np.median(backward)))}
+
+
+def bench_check_accuracy(valid_loader, name='UResNet18', device='cpu'):
+    '''Samples/s of 'check_accuracy' in 'valid_loader' '''
+    model = getattr(models, name)(in_channels=3, num_classes=2).to(device)
+    check_accuracy(valid_loader, model, nn.L1Loss(), device=device)
+    start = time.perf_counter()
+    check_accuracy(valid_loader, model, nn.L1Loss(), device=device)
+    return {'samples/s': len(valid_loader.dataset)/(time.perf_counter()-start)}
+
+
+class MaskSink(EvaluationSink):
+    '''Keep the predicted class of every pixel (to compare two evaluations)'''
+    def __init__(self):
+        self.masks = []
+
+    def update(self, name, batch_idx, x, y, pred):
+        self.masks.append(pred.argmax(1).cpu())
+
+
+def bench_precision(name, height, width, valid_loader, dtype='bf16', batch_size=2,
+                    iterations=3, device='cpu'):
+    '''Time of fp32 and 'dtype' autocast, and Dice parity between both'''
+    torch.manual_seed(0)
+    model = getattr(models, name)(in_channels=3, num_classes=2).to(device)
+    loss_fn = nn.L1Loss()
+    x = torch.randn(batch_size, 3, height, width, device=device)
+    y = torch.rand(batch_size, 2, height, width, device=device)
+    results, masks, dice = {}, {}, {}
+    for precision in [Precision('fp32', device), Precision(dtype, device)]:
+        forward, step = [], []
+        for i in range(iterations+1):
+            # the first iteration is a warm-up
+            model.eval()
+            start = time.perf_counter()
+            with torch.no_grad(), precision.autocast():
+                model(x)
+            if device.startswith('cuda'):
+                torch.cuda.synchronize()
+            middle = time.perf_counter()
+            model.train()
+            model.zero_grad(set_to_none=True)
+            with precision.autocast():
+                loss = loss_fn(model(x), y)
+            loss.backward()
+            if device.startswith('cuda'):
+                torch.cuda.synchronize()
+            if i > 0:
+                forward.append(middle-start)
+                step.append(time.perf_counter()-middle)
+        results[precision.name+' forward (ms)'] = 1000*float(np.median(forward))
+        results[precision.name+' train step (ms)'] = 1000*float(np.median(step))
+        # the initial weights (without the steps above) in the validation set
+        torch.manual_seed(0)
+        initial = getattr(models, name)(in_channels=3, num_classes=2).to(device)
+        metric, mask = MetricSink(), MaskSink()
+        evaluate({'': valid_loader}, initial, [metric, mask], device=device,
+                 progress=False, precision=precision)
+        dice[precision.name] = metric.results[''][2]
+        masks[precision.name] = torch.cat(mask.masks)
+    results[dtype+' forward speedup'] = results['fp32 forward (ms)']/results[dtype+' forward (ms)']
+    results[dtype+' train speedup'] = results['fp32 train step (ms)']/results[dtype+' train step (ms)']
+    results['dice fp32'] = dice['fp32']
+    results['dice difference'] = abs(dice[dtype]-dice['fp32'])
+    results['mask agreement (%)'] = 100*(masks[dtype] == masks['fp32']).double().mean().item()
+    return results
+
+
+def bench_compile(name, height, width, batch_size=2, iterations=3, device='cpu'):
+    '''Compile time, and steady-state time of eager and compiled steps'''
+    x = torch.randn(batch_size, 3, height, width, device=device)
+    y = torch.rand(batch_size, 2, height, width, device=device)
+    results, outputs = {}, {}
+    for mode in ['eager', 'compiled']:
+        compiled = CompiledMode(mode == 'compiled')
+        torch.manual_seed(0)
+        model = compiled.model(getattr(models, name)(in_channels=3, num_classes=2).to(device))
+        initial = {key: value.clone() for key, value in model.state_dict().items()}
+        loss_fn = compiled.loss(nn.L1Loss())
+        optimizer = torch.optim.Adam(model.parameters())
+        compiled.optimizer(optimizer)
+        inputs = compiled.inputs(x)
+        step, forward = [], []
+        # the first step and forward compile the functions (or warm up)
+        for i in range(iterations+1):
+            model.train()
+            start = time.perf_counter()
+            optimizer.zero_grad(set_to_none=True)
+            loss_fn(model(inputs), y).backward()
+            optimizer.step()
+            if device.startswith('cuda'):
+                torch.cuda.synchronize()
+            middle = time.perf_counter()
+            model.eval()
+            with torch.no_grad():
+                model(inputs)
+            if device.startswith('cuda'):
+                torch.cuda.synchronize()
+            if i > 0:
+                step.append(middle-start)
+                forward.append(time.perf_counter()-middle)
+        # the outputs of both modes with the same (initial) weights
+        model.load_state_dict(initial)
+        with torch.no_grad():
+            outputs[mode] = model(inputs)
+        results[mode+' train step (ms)'] = 1000*float(np.median(step))
+        results[mode+' forward (ms)'] = 1000*float(np.median(forward))
+        if compiled.enabled:
+            results['compile (s)'] = sum(compiled.compile_times.values())
+            results['eager fallbacks'] = len(compiled.errors)
+    results['train speedup'] = results['eager train step (ms)']/results['compiled train step (ms)']
+    results['forward speedup'] = results['eager forward (ms)']/results['compiled forward (ms)']
+    results['output difference'] = (outputs['eager']-outputs['compiled']).abs().max().item()
+    return results
+
+
+def run_suite(args):
+    '''Run all benchmarks, returning the dictionary saved in JSON'''
+    root = args.data or os.path.join(tempfile.gettempdir(), 'dsad_benchmark')
+    dirs = make_synthetic_dsad(root, args.directories, args.frames,
+                               (args.frame_height, args.frame_width))
+    results = {}
+    print('\n- dataset')
+    results['dataset'] = bench_dataset(dirs, args.iterations)
+    print('- loaders')
+    results['loaders'], loaders = bench_loaders(dirs, args.height, args.width,
+                                                args.batch_size, args.num_workers,
+                                                args.batched_augmentation)
+    print('- transforms')
+    results['transforms'] = bench_transforms(loaders, args.iterations)
+    for name in args.models:
+        for height, width in args.sizes:
+            print(f'- {name} {height}x{width}')
+            results[f'model {name} {height}x{width}'] = bench_model(
+                name, height, width, args.batch_size, args.iterations, args.device)
+    print('- check_accuracy')
+    results['check_accuracy'] = bench_check_accuracy(loaders[2], device=args.device)
+    if args.precision:
+        height, width = args.sizes[0]
+        for name in args.models:
+            print(f'- precision {args.precision} {name} {height}x{width}')
+            results[f'precision {args.precision} {name} {height}x{width}'] = bench_precision(
+                name, height, width, loaders[2], args.precision, args.batch_size,
+                args.iterations, args.device)
+    if args.compile:
+        height, width = args.sizes[0]
+        for name in args.models:
+            print(f'- compile {name} {height}x{width}')
+            results[f'compile {name} {height}x{width}'] = bench_compile(
+                name, height, width, args.batch_size, args.iterations, args.device)
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(), 'torch': torch.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'threads': torch.get_num_threads(), 'device': args.device,
+            'frames': [args.frame_height, args.frame_width],
+            'batch size': args.batch_size}
+    return {'meta': meta, 'results': results}
+
+
+#%% Comparison
+
+def higher_is_better(metric):
+    return metric.endswith('/s') or 'speedup' in metric or 'agreement' in metric
+
+def compare(results, baseline, tolerance=0.1):
+    '''Compare 'results' with 'baseline', returning a list of dicts (one per
+    metric in both), with 'regression' True when it got worse by more than
+    'tolerance' (a fraction of the baseline value)'''
+    rows = []
+    for bench, metrics in results['results'].items():
+        for metric, value in metrics.items():
+            base = baseline['results'].get(bench, {}).get(metric)
+            if base is None:
+                continue
+            change = (value-base)/base if base else 0.0
+            worse = -change if higher_is_better(metric) else change
+            rows.append({'benchmark': bench, 'metric': metric, 'baseline': base,
+                         'current': value, 'change (%)': 100*change,
+                         'regression': worse > tolerance})
+    return rows
+
+
+def print_comparison(rows):
+    for row in rows:
+        flag = 'REGRESSION' if row['regression'] else ''
+        print(f"{row['benchmark']:<28} {row['metric']:<26} {row['baseline']:>11.3f} "
+              f"{row['current']:>11.3f} {row['change (%)']:>+8.1f}% {flag}")
+
+
+def parse_size(text):
+    height, width = text.lower().split('x')
+    return int(height), int(width)
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the data pipeline and models')
+    parser.add_argument('--output', default=None, help='JSON file to save the results')
+    parser.add_argument('--compare', default=None, help='baseline JSON file')
+    parser.add_argument('--results', default=None,
+                        help='JSON results to compare (instead of running)')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change flagged as regression (default 0.1)')
+    parser.add_argument('--data', default=None,
+                        help='folder of the synthetic dataset (default: temporary)')
+    parser.add_argument('--directories', type=int, default=3)
+    parser.add_argument('--frames', type=int, default=8, help='frames per directory')
+    parser.add_argument('--frame-height', type=int, default=1024)
+    parser.add_argument('--frame-width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=512, help='height of the loaders')
+    parser.add_argument('--width', type=int, default=640, help='width of the loaders')
+    parser.add_argument('--models', nargs='+', default=['UResNet18', 'UResNet34', 'UResNet50'])
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(256, 320), (512, 640)],
+                        help='model resolutions, e.g. 256x320 512x640')
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--batched-augmentation', action='store_true')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--precision', default=None, choices=['bf16', 'fp16'],
+                        help='compare this autocast dtype with fp32 (for each '
+                        'model, in the first size)')
+    parser.add_argument('--compile', action='store_true',
+                        help='compare torch.compile (channels_last) with eager mode '
+                        '(for each model, in the first size)')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--quick', action='store_true',
+                        help='small frames, one model and one resolution')
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args(args)
+    if args.quick:
+        args.frame_height, args.frame_width, args.frames = 256, 320, 4
+        args.height, args.width = 128, 160
+        args.models, args.sizes = ['UResNet18'], [(128, 160)]
+    return args
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.results:
+        with open(args.results) as file:
+            results = json.load(file)
+    else:
+        results = run_suite(args)
+        print('\n'+json.dumps(results['results'], indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'\n- Saved {args.output}')
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        rows = compare(results, baseline, args.tolerance)
+        print(f"\n- Comparison with {args.compare} ({baseline['meta'].get('date')})\n")
+        print_comparison(rows)
+        regressions = [row for row in rows if row['regression']]
+        if regressions:
+            print(f'\n{len(regressions)} regressions (tolerance {100*args.tolerance:.0f}%)')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
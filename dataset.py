@@ -1,23 +1,226 @@
 import os
+import json
+import time
+import atexit
+import shutil
+import hashlib
+import tempfile
 from PIL import Image
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import numpy as np
 import torch
 
 
+class FrameCache(object):
+    '''Cache of decoded 'uint8' frames and labels shared between processes
+
+    The decoded arrays are stored as '.npy' files inside 'root', and they are
+    read back memory-mapped. Since the cache lives in the file system, it is
+    shared by every 'DresdenDataset' that points to the same directory (e.g.
+    the augmentation copies created in 'get_loaders'), and also by all the
+    DataLoader workers. Each frame is cached with the modification time and
+    the size of its file, so a replaced file is decoded again.
+
+    The size of the cache is read from its directory (shared by all the
+    processes) at most every 'rescan' seconds, and when it passes 'max_bytes',
+    the least recently used frames are evicted until it is below 90% of it
+    (so the directory is not scanned again for each new frame). Between the
+    scans, the frames written by the other processes are not counted, so the
+    cache can pass 'max_bytes' by what they write in 'rescan' seconds.
+
+    root: str (input)
+        directory to store the cache (created if it does not exist, and kept
+        at the end, to be used again). By default, a new directory of this run
+        in '/dev/shm' (which is kept in memory), removed when the program
+        exits;
+    max_bytes: int (input)
+        maximum size of the cache in bytes (default is 4 GB);
+    rescan: float (input)
+        seconds between the scans of the size of the cache.
+    '''
+    def __init__(self, root=None, max_bytes=4*1024**3, rescan=1.0):
+        if root is None:
+            base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            root = tempfile.mkdtemp(prefix='dresden_cache-', dir=base)
+            # only the process that created the directory removes it (and not
+            # the DataLoader workers)
+            atexit.register(_remove_cache, root, os.getpid())
+        self.root = root
+        self.max_bytes = max_bytes
+        self.rescan = rescan
+        os.makedirs(self.root, exist_ok=True)
+        # size of the cache in the last scan, plus the frames written by this
+        # process after it
+        self._size = None
+        self._scanned = 0.0
+
+    def _path(self, directory, filename):
+        # each source directory has its own folder, named by a hash of its
+        # path, and the name of each frame has the modification time and the
+        # size of its file
+        key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:16]
+        stat = os.stat(os.path.join(directory, filename))
+        name = f'{filename}.{stat.st_mtime_ns}.{stat.st_size}.npy'
+        return os.path.join(self.root, key, name)
+
+    def _scan(self):
+        # listing all cached files with their size and last access time
+        entries = []
+        for folder in os.scandir(self.root):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _refresh(self, entries=None):
+        # reading the size of the cache from its directory
+        if entries is None:
+            entries = self._scan()
+        self._size = sum(entry[1] for entry in entries)
+        self._scanned = time.monotonic()
+
+    def _evict(self, incoming):
+        # removing the least recently used files until 'incoming' bytes fit
+        # below 90% of 'max_bytes'
+        entries = sorted(self._scan())
+        self._refresh(entries)
+        for _, nbytes, path in entries:
+            if self._size+incoming <= 0.9*self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._size -= nbytes
+            except FileNotFoundError:
+                pass
+
+    def get(self, directory, filename):
+        '''Return the cached array, or 'None' if it is not in the cache'''
+        try:
+            path = self._path(directory, filename)
+            array = np.load(path, mmap_mode='r')
+            # updating the access time used by the eviction policy
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # copying, because the transforms need a writable array
+        return np.array(array)
+
+    def put(self, directory, filename, array):
+        '''Store 'array' in the cache, evicting old frames if needed'''
+        if array.nbytes > self.max_bytes:
+            return
+        if self._size is None or time.monotonic()-self._scanned > self.rescan:
+            self._refresh()
+        if self._size+array.nbytes > self.max_bytes:
+            self._evict(array.nbytes)
+        path = self._path(directory, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # writing in a temporary file and renaming it, so other processes
+        # never read a partially written frame
+        temp = path[:-4]+'.'+str(os.getpid())+'.tmp.npy'
+        try:
+            np.save(temp, array)
+            os.replace(temp, path)
+        except OSError:
+            # if there is no space left, we just do not cache this frame
+            try: os.remove(temp)
+            except OSError: pass
+            return
+        self._size += array.nbytes
+
+    def clear(self):
+        '''Remove every cached frame'''
+        for _, _, path in self._scan():
+            try: os.remove(path)
+            except FileNotFoundError: pass
+        self._refresh()
+
+
+def _remove_cache(root, owner):
+    if os.getpid() == owner:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def read_frame(directory, filename, cache=None, mask=False):
+    '''Read a decoded 'uint8' frame from the cache, or decode it from the disk
+
+    directory: str (input)
+        directory of the frame;
+    filename: str (input)
+        name of the file;
+    cache: 'FrameCache' (input)
+        optional cache of decoded frames;
+    mask: bool (input)
+        if 'True', only the first channel is returned (as for the masks).
+    '''
+    if cache is not None:
+        array = cache.get(directory, filename)
+        if array is not None:
+            return array
+    array = np.array(Image.open(os.path.join(directory, filename)).convert('RGB'))
+    # from masks we only need the first channel (the others are not used)
+    if mask:
+        array = np.ascontiguousarray(array[:,:,0])
+    if cache is not None:
+        cache.put(directory, filename, array)
+    return array
+
+
+def read_sample(directory, image_name, label_name, cache=None, label_mode='onehot'):
+    '''Read an image and its label, returning a dictionary of 'ndarray's
+
+    With 'label_mode' equal to 'onehot', the label has two 'uint8' channels
+    (one per class). With 'index', the label has one 'uint8' channel with the
+    class index plus one (0 marks the pixels with no class, i.e. the ones with
+    a zero one-hot vector), which is 8 times smaller once converted to float.
+    '''
+    image = read_frame(directory, image_name, cache)
+    label1 = read_frame(directory, label_name, cache, mask=True)
+    if label_mode == 'index':
+        label = np.zeros(np.shape(label1)+(1,), np.uint8)
+        label[:,:,0][label1>125] = 1
+        label[:,:,0][label1<125] = 2
+        return {'image0': image, 'image1': label}
+    # to use just three conditions, we create another label with np.zeros
+    label = np.zeros(np.shape(label1)+(2,), np.uint8)
+    label[:,:,0][label1>125] = 1
+    label[:,:,1][label1<125] = 1
+
+    return {'image0': image, 'image1': label}
+
+
+def list_frames(image_dir):
+    '''List the sorted 'imageXX.png' and 'maskXX.png' names in a directory'''
+    filenames = os.listdir(image_dir)
+    image_names = [filename for filename in filenames if filename.startswith("image")]
+    label_names = [filename for filename in filenames if filename.startswith("mask")]
+    # Sort the image and label names based on the numeric part extracted from filenames
+    image_names.sort(key=lambda x: int(x[5:7]))  # Extract the two-digit number from "imageXX.png"
+    label_names.sort(key=lambda x: int(x[4:6]))  # Extract the two-digit number from "maskXX.png"
+
+    return image_names, label_names
+
+
 class DresdenDataset(Dataset):
-    def __init__(self, image_dir, transform=None):
+    def __init__(self, image_dir, transform=None, cache=None, recipe=None,
+                 label_mode='onehot'):
         self.image_dir = image_dir
         basename = os.path.basename(image_dir)
         self.label_dir = os.path.join((os.path.dirname(image_dir)),
                                       basename, 'merged')
         self.transform = transform
-        self.image_names = [filename for filename in os.listdir(image_dir) if filename.startswith("image")]
-        self.label_names = [filename for filename in os.listdir(image_dir) if filename.startswith("mask")]
-
-        # Sort the image and label names based on the numeric part extracted from filenames
-        self.image_names.sort(key=lambda x: int(x[5:7]))  # Extract the two-digit number from "imageXX.png"
-        self.label_names.sort(key=lambda x: int(x[4:6]))  # Extract the two-digit number from "maskXX.png"
+        # 'cache' is an optional 'FrameCache' to avoid decoding PNGs again
+        self.cache = cache
+        # 'recipe' is the augmentation index, used by 'utils.BatchAugment'
+        self.recipe = recipe
+        # 'onehot' or 'index' labels (see 'read_sample')
+        self.label_mode = label_mode
+        self.image_names, self.label_names = list_frames(image_dir)
 
         # print("image_names:", self.image_names)
         # print("label:", self.label_names)
@@ -32,16 +235,427 @@ class DresdenDataset(Dataset):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        image = np.array(Image.open(os.path.join(self.image_dir, self.image_names[idx])).convert('RGB'))
-        label1 = np.array(Image.open(os.path.join(self.image_dir, self.label_names[idx])).convert('RGB'))
-        # to use just three conditions, we create another label with np.zeros
-        label = np.zeros(np.shape(label1), np.uint8)[:,:,0:2]
-        label[:,:,0][label1[:,:,0]>125] = 1
-        label[:,:,1][label1[:,:,0]<125] = 1
-
-        dictionary = {'image0': image, 'image1': label}
+        dictionary = read_sample(self.image_dir, self.image_names[idx],
+                                 self.label_names[idx], self.cache,
+                                 self.label_mode)
 
         if self.transform is not None:
             dictionary = self.transform(dictionary)
+        if self.recipe is not None:
+            dictionary['recipe'] = self.recipe
 
         return dictionary
+
+
+class DresdenIndex(object):
+    '''Index of all the frames in a list of DSAD directories
+
+    Each directory is listed only once. If 'manifest' is given, the listing is
+    read from this JSON file, and directories not in it, or modified since
+    they were listed (files added or removed change the modification time of
+    the directory), are listed again and saved in the file.
+
+    image_dirs: list (input)
+        list of directories with 'imageXX.png' and 'maskXX.png' files;
+    manifest: str (input)
+        optional path to a JSON file caching the listing.
+
+    Attributes 'directory', 'image_names' and 'label_names' give, for each
+    frame, the index of its directory in 'image_dirs' and its file names.
+    '''
+    def __init__(self, image_dirs, manifest=None):
+        self.image_dirs = list(image_dirs)
+        listing = {}
+        if manifest and os.path.isfile(manifest):
+            with open(manifest) as file:
+                listing = json.load(file)
+        # each entry is '[image_names, label_names, mtime]', with the
+        # modification time (in ns) of the directory when it was listed
+        missing = [d for d in self.image_dirs
+                   if listing.get(d, [None]*3)[2:] != [os.stat(d).st_mtime_ns]]
+        for image_dir in missing:
+            mtime = os.stat(image_dir).st_mtime_ns
+            listing[image_dir] = list(list_frames(image_dir))+[mtime]
+        if manifest and missing:
+            # writing in a temporary file, to never leave a broken manifest
+            with open(manifest+'.tmp', 'w') as file:
+                json.dump(listing, file)
+            os.replace(manifest+'.tmp', manifest)
+
+        self.image_names = []
+        self.label_names = []
+        directory = []
+        for n, image_dir in enumerate(self.image_dirs):
+            image_names, label_names = listing[image_dir][:2]
+            self.image_names += image_names
+            self.label_names += label_names
+            directory += [n]*len(image_names)
+        self.directory = np.array(directory, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.image_names)
+
+    def frames(self, n):
+        '''Return the frame indices of the 'n'-th directory'''
+        return np.nonzero(self.directory == n)[0]
+
+
+class AugmentedDresdenDataset(Dataset):
+    '''Flat dataset of (frame, augmentation recipe) pairs
+
+    The global index 'idx' is mapped to the frame 'frames[idx]' of 'index',
+    transformed by 'transforms[recipes[idx]]', so any number of directories
+    and augmentation copies costs only two integer arrays.
+
+    index: 'DresdenIndex' (input)
+        index of the frames;
+    transforms: list (input)
+        transforms of each augmentation recipe;
+    frames: ndarray (input)
+        frame index of each sample;
+    recipes: ndarray (input)
+        recipe index of each sample (all 0 if 'None');
+    cache: 'FrameCache' (input)
+        optional cache of decoded frames;
+    emit_recipe: bool (input)
+        adds the key 'recipe' to the samples (used by 'utils.BatchAugment');
+    label_mode: str (input)
+        'onehot' or 'index' labels (see 'read_sample').
+    '''
+    def __init__(self, index, transforms, frames, recipes=None, cache=None,
+                 emit_recipe=False, label_mode='onehot'):
+        self.index = index
+        self.transforms = transforms
+        self.frames = np.asarray(frames, dtype=np.int64)
+        if recipes is None:
+            recipes = np.zeros(len(self.frames), dtype=np.int64)
+        self.recipes = np.asarray(recipes, dtype=np.int64)
+        self.cache = cache
+        self.emit_recipe = emit_recipe
+        self.label_mode = label_mode
+
+    def __len__(self):
+        return len(self.frames)
+
+    def classes(self):
+        return torch.Tensor([0,1])
+
+    def directory(self):
+        '''Return the directory index (in 'index.image_dirs') of each sample'''
+        return self.index.directory[self.frames]
+
+    def subset(self, indices, transforms=None):
+        '''Return a new dataset with only the samples in 'indices' (and with
+        'transforms' instead of the current ones, if given)'''
+        indices = np.asarray(indices, dtype=np.int64)
+        return AugmentedDresdenDataset(self.index, transforms or self.transforms,
+                                       self.frames[indices], self.recipes[indices],
+                                       cache=self.cache, emit_recipe=self.emit_recipe,
+                                       label_mode=self.label_mode)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        frame = self.frames[idx]
+        recipe = int(self.recipes[idx])
+        directory = self.index.image_dirs[self.index.directory[frame]]
+        dictionary = read_sample(directory, self.index.image_names[frame],
+                                 self.index.label_names[frame], self.cache,
+                                 self.label_mode)
+
+        transform = self.transforms[recipe]
+        if transform is not None:
+            dictionary = transform(dictionary)
+        if self.emit_recipe:
+            dictionary['recipe'] = recipe
+
+        return dictionary
+
+
+class ShardIndex(object):
+    '''Index of the pre-resized shards written by 'shards.py'
+
+    Each split ('train' or 'valid') is a list of shards, each one with two
+    '.npy' files: the 'uint8' frames (N,H,W,3) and the 'index' labels (N,H,W,1)
+    (see 'read_sample'). The frames of a split are numbered in the order of
+    the original directories (as in 'DresdenIndex'), and are read with
+    memory maps, so reading consecutive frames is a sequential read.
+
+    manifest: str (input)
+        path to the 'manifest.json' written by 'shards.py'.
+
+    Attribute 'scale' is the ratio between the stored and the original size
+    of the frames, as '[height ratio, width ratio]' (the translations of the
+    augmentations are scaled by it).
+    '''
+    def __init__(self, manifest):
+        with open(manifest) as file:
+            self.manifest = json.load(file)
+        self.root = os.path.dirname(os.path.abspath(manifest))
+        self.height, self.width = self.manifest['size']
+        source_height, source_width = self.manifest['source size']
+        self.scale = [self.height/source_height, self.width/source_width]
+        self.offsets = {}
+        for split, shards in self.manifest['splits'].items():
+            self.offsets[split] = np.cumsum([0]+[shard['frames'] for shard in shards])
+        self._arrays = {}
+
+    def shards(self, split):
+        return self.manifest['splits'].get(split, [])
+
+    def frames(self, split):
+        '''Return the number of frames of 'split' '''
+        return int(self.offsets[split][-1]) if split in self.offsets else 0
+
+    def directory(self, split):
+        '''Return the directory index (in the split directories) of each frame'''
+        return np.concatenate([shard['directory'] for shard in self.shards(split)]
+                              or [[]]).astype(np.int64)
+
+    def arrays(self, split, shard):
+        '''Return the memory maps of the frames and labels of a shard'''
+        key = (split, shard)
+        if key not in self._arrays:
+            entry = self.shards(split)[shard]
+            self._arrays[key] = tuple(np.load(os.path.join(self.root, entry[name]),
+                                              mmap_mode='r')
+                                      for name in ('images', 'labels'))
+        return self._arrays[key]
+
+    def locate(self, split, frames):
+        '''Return the shard and the position in the shard of each frame'''
+        frames = np.asarray(frames, dtype=np.int64)
+        shard = np.searchsorted(self.offsets[split], frames, side='right')-1
+        return shard, frames-self.offsets[split][shard]
+
+    def read(self, split, frame, label_mode='onehot'):
+        '''Read one frame, returning a dictionary as 'read_sample' '''
+        shard, position = self.locate(split, [frame])
+        images, labels = self.arrays(split, int(shard[0]))
+        return shard_sample(np.array(images[position[0]]),
+                            np.array(labels[position[0]]), label_mode)
+
+    def __getstate__(self):
+        # the memory maps are opened again in each worker
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+
+def shard_sample(image, label, label_mode='onehot'):
+    '''Return a sample dictionary from a stored frame and its 'index' label'''
+    if label_mode == 'index':
+        return {'image0': image, 'image1': label}
+    # the 'onehot' channels are the classes of index 1 and 2
+    onehot = np.concatenate([label == 1, label == 2], axis=2).astype(np.uint8)
+    return {'image0': image, 'image1': onehot}
+
+
+class ShardDataset(Dataset):
+    '''Dataset of (frame, augmentation recipe) pairs read from the shards
+
+    It is the map-style version of 'ShardStream', with random access (used
+    to evaluate), and the same arguments of 'AugmentedDresdenDataset', but
+    with 'index' a 'ShardIndex' and 'split' the split of the frames.
+    '''
+    def __init__(self, index, split, transforms, frames=None, recipes=None,
+                 emit_recipe=False, label_mode='onehot'):
+        self.index = index
+        self.split = split
+        self.transforms = transforms
+        if frames is None:
+            frames = np.arange(index.frames(split))
+        self.frames = np.asarray(frames, dtype=np.int64)
+        if recipes is None:
+            recipes = np.zeros(len(self.frames), dtype=np.int64)
+        self.recipes = np.asarray(recipes, dtype=np.int64)
+        self.emit_recipe = emit_recipe
+        self.label_mode = label_mode
+
+    def __len__(self):
+        return len(self.frames)
+
+    def classes(self):
+        return torch.Tensor([0,1])
+
+    def directory(self):
+        '''Return the directory index of each sample'''
+        return self.index.directory(self.split)[self.frames]
+
+    def subset(self, indices, transforms=None):
+        '''Return a new dataset with only the samples in 'indices' (and with
+        'transforms' instead of the current ones, if given)'''
+        indices = np.asarray(indices, dtype=np.int64)
+        return ShardDataset(self.index, self.split, transforms or self.transforms,
+                            self.frames[indices], self.recipes[indices],
+                            emit_recipe=self.emit_recipe, label_mode=self.label_mode)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+        recipe = int(self.recipes[idx])
+        dictionary = self.index.read(self.split, self.frames[idx], self.label_mode)
+        transform = self.transforms[recipe]
+        if transform is not None:
+            dictionary = transform(dictionary)
+        if self.emit_recipe:
+            dictionary['recipe'] = recipe
+        return dictionary
+
+
+class ShardStream(IterableDataset):
+    '''Stream of training samples read sequentially from the shards
+
+    The samples are (frame, augmentation recipe) pairs, as in 'ShardDataset'.
+    In each epoch, the order of the shards is shuffled, and the samples (in
+    shard order, with the samples of each frame together) are divided in
+    equal contiguous parts, one for each process and DataLoader worker, so
+    each worker reads large sequential chunks of one or two shards (and each
+    frame once). As in 'DistributedSampler', the last part is completed with
+    the first samples, so every sample is used in each epoch. The samples are
+    mixed by a shuffle buffer of 'shuffle_buffer' samples. Call 'set_epoch'
+    before each epoch.
+
+    index: 'ShardIndex' (input)
+        index of the shards;
+    split: str (input)
+        split of the frames (e.g. 'train');
+    transforms: list (input)
+        transforms of each augmentation recipe;
+    frames: ndarray (input)
+        frame of each sample (all the frames of the split if 'None');
+    recipes: ndarray (input)
+        augmentation recipe of each sample ('transforms[m]' for recipe 'm'),
+        if 'None', each frame gives 'copies' samples, with the recipes in
+        'range(copies)';
+    shuffle_buffer: int (input)
+        number of samples in the shuffle buffer (1 does not shuffle them);
+    chunk: int (input)
+        frames read at once from a shard;
+    rank, world_size: int (input)
+        rank and number of processes, in distributed training (every
+        process yields the same number of samples);
+    emit_recipe, label_mode: (input)
+        as in 'AugmentedDresdenDataset'.
+    '''
+    def __init__(self, index, split, transforms, frames=None, recipes=None, copies=1,
+                 shuffle_buffer=256, chunk=32, seed=0, rank=0, world_size=1,
+                 emit_recipe=False, label_mode='onehot'):
+        self.index = index
+        self.split = split
+        self.transforms = transforms
+        if frames is None:
+            frames = np.arange(index.frames(split))
+        frames = np.asarray(frames, dtype=np.int64)
+        if recipes is None:
+            recipes = np.tile(np.arange(copies), len(frames))
+            frames = np.repeat(frames, copies)
+        # sorted by frame, so the samples of a frame are read together
+        order = np.lexsort((recipes, frames))
+        self.frames = frames[order]
+        self.recipes = np.asarray(recipes, dtype=np.int64)[order]
+        self.shuffle_buffer = max(shuffle_buffer, 1)
+        self.chunk = chunk
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.emit_recipe = emit_recipe
+        self.label_mode = label_mode
+        self.epoch = 0
+        self.skip = (0, 1)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip_batches(self, batches, batch_size):
+        '''Skip the first 'batches' batches of the next epoch (to resume it)
+
+        The batches come from the workers in turns, so each worker skips its
+        samples of these batches (they are read, but not transformed).
+        '''
+        self.skip = (batches, batch_size)
+
+    def state_dict(self):
+        return {'seed': self.seed}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+
+    def __len__(self):
+        return -(-len(self.frames)//self.world_size)
+
+    def classes(self):
+        return torch.Tensor([0,1])
+
+    def worker_samples(self):
+        '''Return the frames and recipes of the samples of this process and
+        worker, in reading order'''
+        info = get_worker_info()
+        workers, worker = (info.num_workers, info.id) if info else (1, 0)
+        # every process and worker shuffles the shards in the same way
+        rng = np.random.default_rng([self.seed, self.epoch])
+        shard, _ = self.index.locate(self.split, self.frames)
+        order = rng.permutation(len(self.index.shards(self.split)))
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        sequence = np.argsort(rank[shard], kind='stable')
+        parts = self.world_size*workers
+        size = -(-len(sequence)//parts)
+        sequence = np.resize(sequence, size*parts)
+        part = self.rank*workers+worker
+        sequence = sequence[part*size:(part+1)*size]
+        return self.frames[sequence], self.recipes[sequence]
+
+    def read(self, frames):
+        '''Yield the (frame, label) arrays of 'frames' (in the same order),
+        reading in chunks'''
+        for start in range(0, len(frames), self.chunk):
+            shards, positions = self.index.locate(self.split, frames[start:start+self.chunk])
+            ranges = {}
+            for shard in np.unique(shards):
+                selected = positions[shards == shard]
+                low, high = selected.min(), selected.max()+1
+                images, labels = self.index.arrays(self.split, int(shard))
+                # one sequential read of the whole range (then the frames are
+                # copied, to not keep the chunk in memory)
+                ranges[shard] = (low, np.asarray(images[low:high]),
+                                 np.asarray(labels[low:high]))
+            last, arrays = None, None
+            for shard, position in zip(shards, positions):
+                # (the samples of the same frame share its arrays)
+                if (shard, position) != last:
+                    low, images, labels = ranges[shard]
+                    last = (shard, position)
+                    arrays = images[position-low].copy(), labels[position-low].copy()
+                yield arrays
+
+    def sample(self, image, label, recipe):
+        dictionary = shard_sample(image, label, self.label_mode)
+        transform = self.transforms[recipe]
+        if transform is not None:
+            dictionary = transform(dictionary)
+        if self.emit_recipe:
+            dictionary['recipe'] = recipe
+        return dictionary
+
+    def __iter__(self):
+        info = get_worker_info()
+        workers, worker = (info.num_workers, info.id) if info else (1, 0)
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker])
+        batches, batch_size = self.skip
+        skip = len(range(worker, batches, workers))*batch_size
+        buffer = []
+        def items():
+            frames, recipes = self.worker_samples()
+            for (image, label), recipe in zip(self.read(frames), recipes):
+                buffer.append((image, label, int(recipe)))
+                if len(buffer) >= self.shuffle_buffer:
+                    i = rng.integers(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield buffer.pop()
+            rng.shuffle(buffer)
+            yield from buffer
+        for n, item in enumerate(items()):
+            if n >= skip:
+                yield self.sample(*item)
@@ -0,0 +1,289 @@
+"""
+Multi-Process Data-Parallel Training (DistributedDataParallel with gloo)
+
+This file has the helpers used by 'train.py' and 'utils.py' to train with
+many processes (in one or more hosts), and a launcher to start them. Each
+process trains a copy of the model with a shard of the dataset, and the
+gradients are averaged by 'torch.nn.parallel.DistributedDataParallel', with
+the gloo backend (that works in CPU). The batch normalizations are
+synchronized between the processes ('DistributedBatchNorm2d', since
+'nn.SyncBatchNorm' only runs in GPU), and only the process with rank 0 saves
+checkpoints, the 'dictionary.csv' file and the images.
+
+Launching: 'python ddp.py --nproc 4 train.py' starts 4 processes running
+'train.py' in this host, with the environment variables read by 'setup' (the
+same as 'torchrun', which can also be used). For more hosts, run in each one:
+
+    python ddp.py --nproc 4 --nnodes 2 --node-rank 0 --master-addr host0 train.py
+    python ddp.py --nproc 4 --nnodes 2 --node-rank 1 --master-addr host0 train.py
+
+The CPU threads are divided between the processes of each host (see '--threads').
+
+Scaling benchmark: 'python ddp.py --benchmark --nproc 8' trains a UResNet with
+synthetic batches with 1, 2, 4 and 8 processes, and prints the samples/s.
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+#%% Process Group
+
+def setup(backend='gloo'):
+    '''Start the process group if launched with more than one process
+
+    Returns the rank of this process and the number of processes (the
+    'world size'), which are (0, 1) if not launched by 'ddp.py' or 'torchrun'.
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size < 2:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size()
+
+def cleanup():
+    if is_distributed():
+        dist.barrier()
+        dist.destroy_process_group()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    '''Return 'True' in the process that saves the results (rank 0)'''
+    return get_rank() == 0
+
+def unwrap(model):
+    '''Return the model inside 'DistributedDataParallel' (or 'model' itself)'''
+    return model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+
+def average_gradients(model):
+    '''Average the gradients of 'model' between the processes (as DDP does,
+    for backwards run inside 'no_sync')'''
+    if not is_distributed():
+        return
+    for p in model.parameters():
+        if p.grad is not None:
+            dist.all_reduce(p.grad)
+            p.grad.div_(get_world_size())
+
+
+class ShardSampler(Sampler):
+    '''Sampler of the indices 'rank', 'rank+world_size', ... (in order)
+
+    Used for evaluation: unlike 'DistributedSampler', no sample is repeated to
+    make the shards equal, so the metrics reduced from all the processes are
+    the ones of the whole dataset.
+    '''
+    def __init__(self, dataset, rank=None, world_size=None):
+        self.length = len(dataset)
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+
+    def __iter__(self):
+        return iter(range(self.rank, self.length, self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, self.length, self.world_size))
+
+
+#%% Synchronized Batch Normalization
+
+# sum of a tensor over all processes, with the gradient also summed (since
+# every process uses the result)
+class _AllReduce(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x):
+        x = x.clone()
+        dist.all_reduce(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.clone()
+        dist.all_reduce(grad)
+        return grad
+
+
+class DistributedBatchNorm2d(nn.BatchNorm2d):
+    '''Batch normalization with the statistics of the batches of all processes
+
+    In training (with more than one process), the sum and the sum of squares
+    of each channel are reduced with 'all_reduce' (with gradients), so the
+    result is the same as a 'nn.BatchNorm2d' with the whole global batch. In
+    evaluation, or with one process, it is a 'nn.BatchNorm2d' (and it has the
+    same parameters and buffers, so the checkpoints are the same).
+    '''
+    def forward(self, x):
+        if not (self.training and is_distributed()):
+            return super().forward(x)
+        # the statistics are computed in float32, also with autocast
+        dtype = x.dtype
+        x = x.float()
+        count = torch.tensor([x.numel()/x.shape[1]], device=x.device)
+        stats = torch.cat([x.sum((0, 2, 3)), (x*x).sum((0, 2, 3)), count])
+        stats = _AllReduce.apply(stats)
+        C = x.shape[1]
+        total = stats[-1]
+        mean = stats[:C]/total
+        var = (stats[C:2*C]/total-mean*mean).clamp(min=0)
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked.add_(1)
+                if self.momentum is None:
+                    momentum = 1.0/self.num_batches_tracked.item()
+                else:
+                    momentum = self.momentum
+                unbiased = var*total/(total-1).clamp(min=1)
+                self.running_mean.mul_(1-momentum).add_(momentum*mean)
+                self.running_var.mul_(1-momentum).add_(momentum*unbiased)
+
+        x = (x-mean[None,:,None,None])*torch.rsqrt(var+self.eps)[None,:,None,None]
+        if self.affine:
+            x = x*self.weight[None,:,None,None]+self.bias[None,:,None,None]
+        return x.to(dtype)
+
+
+def convert_batchnorm(model):
+    '''Replace the 'nn.BatchNorm2d' of 'model' by 'DistributedBatchNorm2d'
+
+    The modules are changed in place (keeping the parameters and buffers), so
+    shared modules (e.g. 'bn1' of the UResNets) stay shared.
+    '''
+    for module in model.modules():
+        if type(module) is nn.BatchNorm2d:
+            module.__class__ = DistributedBatchNorm2d
+    return model
+
+
+#%% Launcher
+
+def launch(script, args, nproc, nnodes=1, node_rank=0, master_addr='127.0.0.1',
+           master_port=29500, threads=None):
+    '''Run 'python script args' in 'nproc' processes, returning the exit code'''
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1)//nproc)
+    processes = []
+    for local_rank in range(nproc):
+        env = dict(os.environ,
+                   MASTER_ADDR=master_addr, MASTER_PORT=str(master_port),
+                   WORLD_SIZE=str(nproc*nnodes), RANK=str(node_rank*nproc+local_rank),
+                   LOCAL_RANK=str(local_rank), LOCAL_WORLD_SIZE=str(nproc),
+                   OMP_NUM_THREADS=str(threads))
+        processes.append(subprocess.Popen([sys.executable, script]+list(args), env=env))
+    code = 0
+    try:
+        # if one process fails, the others would wait for it forever in the
+        # collectives, so they are stopped (also on Ctrl+C)
+        while any(process.poll() is None for process in processes):
+            codes = [process.poll() for process in processes]
+            if any(c for c in codes if c is not None):
+                break
+            time.sleep(1)
+        for process in processes:
+            code = process.poll() or code
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+    return code
+
+
+#%% Scaling Benchmark
+
+def _benchmark_worker(rank, world_size, port, name, batch_size, size, steps,
+                      threads, results):
+    import model as models
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+                      WORLD_SIZE=str(world_size), RANK=str(rank))
+    torch.set_num_threads(threads)
+    setup()
+    torch.manual_seed(rank)
+    model = getattr(models, name)(in_channels=3, num_classes=2)
+    if world_size > 1:
+        model = nn.parallel.DistributedDataParallel(convert_batchnorm(model))
+    optimizer = torch.optim.Adam(model.parameters())
+    loss_fn = nn.L1Loss()
+    x = torch.randn(batch_size, 3, *size)
+    y = torch.rand(batch_size, 2, *size)
+    for step in range(steps+1):
+        # the first step is a warm-up
+        if step == 1:
+            if world_size > 1:
+                dist.barrier()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        loss_fn(model(x), y).backward()
+        optimizer.step()
+    if world_size > 1:
+        dist.barrier()
+    seconds = time.perf_counter()-start
+    if rank == 0:
+        results.put(world_size*batch_size*steps/seconds)
+    cleanup()
+
+
+def benchmark(max_procs, name='UResNet18', batch_size=2, size=(256, 320), steps=5,
+              threads=None, port=29600):
+    '''Return a list of (processes, samples/s) training with synthetic data'''
+    import torch.multiprocessing as mp
+    context = mp.get_context('spawn')
+    counts = [n for n in [1, 2, 4, 8, 16, 32, 64, 128] if n < max_procs]+[max_procs]
+    rows = []
+    for n in counts:
+        results = context.SimpleQueue()
+        per_process = threads or max(1, (os.cpu_count() or 1)//n)
+        mp.start_processes(_benchmark_worker, nprocs=n, start_method='spawn',
+                           args=(n, port+n, name, batch_size, size, steps,
+                                 per_process, results))
+        rows.append((n, results.get()))
+        print(f'{n} processes ({per_process} threads each): {rows[-1][1]:.2f} samples/s')
+    return rows
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Launch data-parallel training')
+    parser.add_argument('--nproc', type=int, default=os.cpu_count() or 1,
+                        help='processes per host')
+    parser.add_argument('--nnodes', type=int, default=1)
+    parser.add_argument('--node-rank', type=int, default=0)
+    parser.add_argument('--master-addr', default='127.0.0.1')
+    parser.add_argument('--master-port', type=int, default=29500)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='CPU threads per process (default: cores/nproc)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='measure the samples/s from 1 to nproc processes')
+    parser.add_argument('--model', default='UResNet18', help='model of the benchmark')
+    parser.add_argument('--batch-size', type=int, default=2,
+                        help='batch size per process in the benchmark')
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('script', nargs='?', default='train.py')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER)
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.benchmark:
+        benchmark(args.nproc, args.model, args.batch_size, (args.height, args.width),
+                  args.steps, args.threads)
+    else:
+        sys.exit(launch(args.script, args.script_args, args.nproc, args.nnodes,
+                        args.node_rank, args.master_addr, args.master_port,
+                        args.threads))
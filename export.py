@@ -0,0 +1,189 @@
+"""
+Export of the UResNet Models to TorchScript and ONNX
+
+This program exports the UResNets (from 18 to 152 layers, as specified in
+'model.py') to a TorchScript module ('.pt') and an ONNX file ('.onnx'), both
+with dynamic batch size, so they can be deployed without the source code (and,
+for ONNX, without PyTorch). After the export, the outputs of both files are
+compared with the eager model, and '--benchmark' measures the latency and the
+throughput of eager PyTorch, TorchScript and ONNX Runtime (CPU).
+
+Examples:
+    python export.py --model UResNet34 --checkpoint my_checkpoint30.pth.tar
+    python export.py --model all --benchmark --batch-sizes 1 4 --device cpu
+
+The exported models have the input named 'image' (normalized, with shape
+(N,3,height,width)) and the output named 'pred' (softmax, (N,classes,H,W)).
+Load them with 'torch.jit.load' or 'onnxruntime.InferenceSession'. With
+'--fuse', the batch normalizations are folded in the convolutions before the
+export (see 'model.fuse_for_inference'), and with '--no-softmax' the output
+has the scores before the softmax (with the same argmax).
+"""
+import os
+import time
+import inspect
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import model as models
+from utils import load_checkpoint
+
+MODELS = ['UResNet18', 'UResNet34', 'UResNet50', 'UResNet101', 'UResNet152']
+
+
+def export_torchscript(model, filename):
+    '''Script 'model' and save it in 'filename', returning the scripted model'''
+    scripted = torch.jit.script(model.eval())
+    scripted.save(filename)
+    return scripted
+
+
+def export_onnx(model, filename, height, width, opset=17):
+    '''Export 'model' to ONNX in 'filename', with dynamic batch size'''
+    x = torch.randn(1, 3, height, width, device=next(model.parameters()).device)
+    kwargs = {}
+    # the TorchScript based exporter supports 'dynamic_axes' in all versions
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    torch.onnx.export(model.eval(), (x,), filename, input_names=['image'],
+                      output_names=['pred'], opset_version=opset,
+                      dynamic_axes={'image': {0: 'batch'}, 'pred': {0: 'batch'}},
+                      **kwargs)
+
+
+def onnx_session(filename, threads=None):
+    '''Return an ONNX Runtime session (CPU) of the model in 'filename' '''
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    return onnxruntime.InferenceSession(filename, options,
+                                        providers=['CPUExecutionProvider'])
+
+
+def check_outputs(model, scripted, session, height, width, batch_sizes=(1, 2),
+                  atol=1e-4):
+    '''Compare the outputs of the exported models with the eager 'model'
+
+    Returns the maximum absolute differences, raising 'AssertionError' when one
+    is larger than 'atol' (the batch sizes are different from the one used
+    in the export, to check the dynamic batch).
+    '''
+    device = next(model.parameters()).device
+    errors = {'torchscript': 0.0, 'onnx': 0.0}
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, 3, height, width, device=device)
+            y = model(x)
+            errors['torchscript'] = max(errors['torchscript'],
+                                        (scripted(x)-y).abs().max().item())
+            if session is not None:
+                y_onnx = session.run(None, {'image': x.cpu().numpy()})[0]
+                errors['onnx'] = max(errors['onnx'],
+                                     float(np.abs(y_onnx-y.cpu().numpy()).max()))
+    for name, error in errors.items():
+        assert error <= atol, f'{name} output differs from eager by {error:.2e}'
+    return errors
+
+
+def measure(function, x, iterations=10, warmup=2):
+    '''Return the median time (in seconds) of 'function(x)' '''
+    times = []
+    for i in range(warmup+iterations):
+        start = time.perf_counter()
+        function(x)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if i >= warmup:
+            times.append(time.perf_counter()-start)
+    return float(np.median(times))
+
+
+def benchmark(model, scripted, session, height, width, batch_sizes=(1, 4),
+              iterations=10):
+    '''Return a list of dicts with the latency and throughput of each runtime'''
+    device = next(model.parameters()).device
+    rows = []
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, 3, height, width, device=device)
+            runtimes = {'eager': (model, x), 'torchscript': (scripted, x)}
+            if session is not None:
+                runtimes['onnxruntime'] = (lambda a: session.run(None, {'image': a}),
+                                           x.cpu().numpy())
+            for runtime, (function, inputs) in runtimes.items():
+                seconds = measure(function, inputs, iterations)
+                rows.append({'runtime': runtime, 'batch size': batch_size,
+                             'latency (ms)': 1000*seconds,
+                             'throughput (img/s)': batch_size/seconds})
+    return rows
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Export UResNets to TorchScript and ONNX')
+    parser.add_argument('--model', nargs='+', default=['UResNet34'],
+                        help='models in model.py, or "all"')
+    parser.add_argument('--checkpoint', default=None,
+                        help='checkpoint saved by train.py (random weights if not given)')
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--output', default='exported')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--fuse', action='store_true',
+                        help='fold the batch normalizations in the convolutions')
+    parser.add_argument('--no-softmax', action='store_true',
+                        help='remove the final softmax (with --fuse)')
+    parser.add_argument('--no-onnx', action='store_true',
+                        help='only export to TorchScript')
+    parser.add_argument('--benchmark', action='store_true')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='CPU threads of PyTorch and ONNX Runtime')
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    names = MODELS if args.model == ['all'] else args.model
+    if args.checkpoint and len(names) > 1:
+        raise SystemExit('a checkpoint can only be loaded in one model')
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.output, exist_ok=True)
+
+    results = []
+    for name in names:
+        print(f'\n- Exporting {name}...')
+        model = getattr(models, name)(in_channels=3, num_classes=args.num_classes)
+        if args.checkpoint:
+            load_checkpoint(torch.load(args.checkpoint, map_location='cpu'), model)
+        model = model.to(args.device).eval()
+        if args.fuse:
+            model = models.fuse_for_inference(model, drop_softmax=args.no_softmax)
+        filename = os.path.join(args.output, name)
+        scripted = export_torchscript(model, filename+'.pt')
+        session = None
+        if not args.no_onnx:
+            export_onnx(model, filename+'.onnx', args.height, args.width, args.opset)
+            session = onnx_session(filename+'.onnx', args.threads)
+        errors = check_outputs(model, scripted, session, args.height, args.width)
+        print('Maximum difference to eager: '+', '.join(
+            f'{key} {value:.2e}' for key, value in errors.items()))
+        if args.benchmark:
+            for row in benchmark(model, scripted, session, args.height, args.width,
+                                 args.batch_sizes, args.iterations):
+                results.append({'model': name, **row})
+
+    if results:
+        results = pd.DataFrame(results)
+        print('\n'+results.to_string(index=False, float_format='%.2f'))
+        results.to_csv(os.path.join(args.output, 'benchmark.csv'), index=False)
+
+
+if __name__ == '__main__':
+    main()
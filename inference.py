@@ -0,0 +1,447 @@
+'''
+This file is used together with 'model.py' and 'utils.py' to run trained models
+in new images, with functions that do not need labels or a training setup.
+
+Tiled Inference: the UResNets only accept sizes that survive their 32x down
+and up-sampling, and full-resolution frames do not fit in memory at once.
+'sliding_window_inference' splits frames of any size in overlapping tiles,
+runs the tiles in batches and blends their softmax outputs with a window.
+
+Offline Inference: 'list_images' and 'FrameDataset' load unlabeled frames to
+be segmented in batches (see 'predict.py').
+
+Video Streaming: 'VideoPipeline' segments videos read with OpenCV, with the
+decoding, the preprocessing, the forward pass and the mask encoding running
+in different threads, joined by bounded queues.
+'''
+import os
+import glob
+import math
+import time
+import queue
+import threading
+import cv2
+import numpy as np
+import torch
+import torchvision.transforms.functional as tf
+from torch.utils.data import Dataset
+from dataset import read_frame
+from utils import DRESDEN_MEAN, DRESDEN_STD, Precision
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+# weights to blend the tiles, higher in the center of the tile (where the
+# prediction has more context) and lower in the borders
+def window_weights(height, width, window='gaussian', sigma=0.125):
+    '''Return a (height,width) tensor of blending weights
+
+    window: str (input)
+        'gaussian' (with standard deviation 'sigma' times the tile size),
+        'hann' or 'constant';
+    sigma: float (input)
+        standard deviation of the gaussian, relative to the tile size.
+    '''
+    if window == 'constant':
+        return torch.ones(height, width)
+    if window == 'hann':
+        # 'periodic=False' makes it symmetric, and the small constant avoids
+        # zero weights in the border of the image
+        y = torch.hann_window(height+2, periodic=False)[1:-1]
+        x = torch.hann_window(width+2, periodic=False)[1:-1]
+    elif window == 'gaussian':
+        y = torch.arange(height, dtype=torch.float32)-(height-1)/2
+        x = torch.arange(width, dtype=torch.float32)-(width-1)/2
+        y = torch.exp(-0.5*(y/(sigma*height))**2)
+        x = torch.exp(-0.5*(x/(sigma*width))**2)
+    else:
+        raise ValueError('window has to be "gaussian", "hann" or "constant"')
+    weights = y[:,None]*x[None,:]
+    return (weights/weights.max()).clamp(min=1e-3)
+
+# start positions of the tiles in one dimension (the last tile ends in 'size')
+def tile_starts(size, tile, stride):
+    if size <= tile:
+        return [0]
+    count = math.ceil((size-tile)/stride)+1
+    return [min(i*stride, size-tile) for i in range(count)]
+
+# rough estimation of the memory needed to run one tile (without gradients)
+def estimate_tile_bytes(model, channels, tile_size, device='cpu'):
+    '''Return an estimation of the bytes of activations to run one tile
+
+    It runs a single tile, recording the size of the output of each module,
+    and returns three times the largest output (the input and output of a
+    convolution, and the skip tensors kept by the UResNets).
+    '''
+    largest = [0]
+    def hook(module, inputs, output):
+        if torch.is_tensor(output):
+            largest[0] = max(largest[0], output.nelement()*output.element_size())
+    hooks = [m.register_forward_hook(hook) for m in model.modules()
+             if len(list(m.children())) == 0]
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, channels, *tile_size, device=device))
+    finally:
+        for h in hooks:
+            h.remove()
+    return 3*largest[0]
+
+
+def sliding_window_inference(model, image, tile_size=(512, 640), overlap=0.25,
+                             batch_size=4, window='gaussian', memory_budget=None,
+                             device='cuda' if torch.cuda.is_available() else 'cpu',
+                             output_device='cpu'):
+    '''Segment an image of any size with overlapping tiles
+
+    The tiles are run in batches of 'batch_size' (or as many as fit in
+    'memory_budget'), so the memory used by the model does not depend on the
+    image size, and their outputs (softmax probabilities for the UResNets) are
+    blended with the weights of 'window_weights'.
+
+    model: 'torch.nn.Module' (input)
+        segmentation model (e.g. a 'UResNet34');
+    image: tensor (input)
+        normalized image with shape (C,H,W) or (1,C,H,W);
+    tile_size: list (input)
+        height and width of the tiles (multiples of 32 for the UResNets);
+    overlap: float (input)
+        fraction of overlap between neighbour tiles (from 0.0 to 1.0);
+    batch_size: int (input)
+        maximum number of tiles per forward pass;
+    window: str (input)
+        blending window ('gaussian', 'hann' or 'constant');
+    memory_budget: int (input)
+        bytes available for the activations (reduces 'batch_size' if needed);
+    output_device: str (input)
+        device where the blended output is accumulated.
+
+    output: tensor
+        blended output with shape (num_classes,H,W).
+    '''
+    if image.dim() == 4:
+        image = image[0]
+    channels, height, width = image.shape
+    tile_h, tile_w = tile_size
+    if tile_h % 32 or tile_w % 32:
+        raise ValueError('tile_size has to be a multiple of 32 for the UResNets')
+    model.eval()
+    # images smaller than one tile are padded (and cropped in the end)
+    pad_h, pad_w = max(tile_h-height, 0), max(tile_w-width, 0)
+    if pad_h or pad_w:
+        image = torch.nn.functional.pad(image[None], (0, pad_w, 0, pad_h),
+                                        mode='reflect' if pad_h < height and pad_w < width else 'constant')[0]
+    H, W = image.shape[1:]
+    stride_h = max(int(tile_h*(1-overlap)), 1)
+    stride_w = max(int(tile_w*(1-overlap)), 1)
+    positions = [(top, left) for top in tile_starts(H, tile_h, stride_h)
+                 for left in tile_starts(W, tile_w, stride_w)]
+    if memory_budget is not None:
+        tile_bytes = estimate_tile_bytes(model, channels, tile_size, device)
+        batch_size = max(1, min(batch_size, int(memory_budget//max(tile_bytes, 1))))
+
+    weights = window_weights(tile_h, tile_w, window).to(output_device)
+    output = None
+    normalization = torch.zeros(H, W, device=output_device)
+    with torch.no_grad():
+        for i in range(0, len(positions), batch_size):
+            batch = positions[i:i+batch_size]
+            tiles = torch.stack([image[:, top:top+tile_h, left:left+tile_w]
+                                 for top, left in batch]).to(device)
+            pred = model(tiles).float().to(output_device)
+            if output is None:
+                output = torch.zeros(pred.shape[1], H, W, device=output_device)
+            for (top, left), tile in zip(batch, pred):
+                output[:, top:top+tile_h, left:left+tile_w] += tile*weights
+                normalization[top:top+tile_h, left:left+tile_w] += weights
+            del tiles, pred
+    output /= normalization
+    return output[:, :height, :width]
+
+
+#%% Offline Inference
+
+def list_images(inputs):
+    '''Return the sorted image paths from a list of directories or globs
+
+    In directories, only image files are used, and the DSAD masks ('maskXX.png'
+    files) are skipped.
+    '''
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            names = sorted(name for name in os.listdir(pattern)
+                           if name.lower().endswith(IMAGE_EXTENSIONS)
+                           and not name.startswith('mask'))
+            paths += [os.path.join(pattern, name) for name in names]
+        else:
+            paths += sorted(glob.glob(pattern))
+    return paths
+
+
+class FrameDataset(Dataset):
+    '''Dataset of unlabeled frames, resized and normalized as in training
+
+    path: list (input)
+        paths of the images;
+    size: list (input)
+        height and width to resize the frames ('None' keeps the original
+        size, e.g. for 'sliding_window_inference');
+    cache: 'FrameCache' (input)
+        optional cache of decoded frames.
+
+    Each sample is a dictionary with the normalized 'image', the 'index' of
+    the frame and its original 'size' (height, width).
+    '''
+    def __init__(self, paths, size=None, cache=None,
+                 mean=DRESDEN_MEAN, std=DRESDEN_STD):
+        self.paths = list(paths)
+        self.size = size
+        self.cache = cache
+        self.mean = mean
+        self.std = std
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        directory, filename = os.path.split(self.paths[idx])
+        image = read_frame(directory, filename, self.cache)
+        size = torch.tensor(image.shape[:2])
+        image = torch.from_numpy(image).permute(2, 0, 1).float()/255
+        if self.size is not None:
+            image = tf.resize(image, self.size, antialias=True)
+        image = tf.normalize(image, self.mean, self.std)
+
+        return {'image': image, 'index': idx, 'size': size}
+
+
+#%% Video Streaming
+
+# marks the end of the stream in the queues of 'VideoPipeline'
+_END = None
+
+
+class VideoPipeline(object):
+    '''Segment the frames of a video in a pipeline of threads
+
+    The stages are: decoding (OpenCV), preprocessing (resize and normalize, as
+    in the training), batched forward pass (with 'torch.no_grad') and mask
+    encoding, each in its own thread. The queues between them hold at most
+    'queue_size' items, so the memory does not depend on the video length.
+
+    With 'stride' larger than 1, only one in 'stride' frames is segmented (a
+    keyframe), and the other frames reuse the mask of the last keyframe (they
+    are not even converted by OpenCV). With 'threshold', a frame is a keyframe
+    when the mean absolute difference of its grayscale thumbnail (in [0,255])
+    to the one of the last keyframe is larger than 'threshold', and 'stride'
+    is the maximum distance between keyframes.
+
+    model: 'torch.nn.Module' (input)
+        segmentation model (e.g. a 'UResNet34');
+    size: list (input)
+        height and width to resize the frames (multiples of 32);
+    batch_size: int (input)
+        number of keyframes per forward pass;
+    stride: int (input)
+        distance between keyframes (maximum distance, with 'threshold');
+    threshold: float (input)
+        difference to the last keyframe that makes a new keyframe;
+    queue_size: int (input)
+        maximum number of items between two stages;
+    keep_size: bool (input)
+        if 'True', the masks are resized to the size of the video;
+    precision: 'utils.Precision' (input)
+        precision of the forward passes ('None' for float32).
+    '''
+    def __init__(self, model, size=(512, 640), batch_size=8, stride=1,
+                 threshold=None, queue_size=16, keep_size=True,
+                 device='cuda' if torch.cuda.is_available() else 'cpu',
+                 mean=DRESDEN_MEAN, std=DRESDEN_STD, precision=None):
+        self.model = model.eval()
+        self.size = list(size)
+        self.batch_size = batch_size
+        self.stride = max(int(stride), 1)
+        self.threshold = threshold
+        self.queue_size = queue_size
+        self.keep_size = keep_size
+        self.device = device
+        # (the autocast is set in the thread of the forward passes)
+        self.precision = precision if precision is not None else Precision('fp32')
+        self.mean = np.array(mean, np.float32)*255
+        self.std = np.array(std, np.float32)*255
+
+    def _put(self, outbox, item):
+        # 'put' with timeout, to stop when another stage failed
+        while not self.stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, inbox):
+        while not self.stop.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _stage(self, function, *args):
+        # running a stage, saving its error to be raised in 'run'
+        try:
+            function(*args)
+        except BaseException as error:
+            self.errors.append(error)
+            self.stop.set()
+
+    def _decode(self, capture, outbox):
+        index, since, last = 0, 0, None
+        while not self.stop.is_set():
+            if self.threshold is None and index % self.stride:
+                # 'grab' skips the conversion of frames that are not used
+                if not capture.grab():
+                    break
+                self._put(outbox, (index, None))
+            else:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                key = True
+                if self.threshold is not None:
+                    thumb = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+                                       (64, 36), interpolation=cv2.INTER_AREA)
+                    thumb = thumb.astype(np.float32)
+                    key = (last is None or since+1 >= self.stride or
+                           np.abs(thumb-last).mean() > self.threshold)
+                    if key:
+                        last, since = thumb, 0
+                    else:
+                        since += 1
+                self._put(outbox, (index, frame if key else None))
+            index += 1
+        self._put(outbox, _END)
+
+    def _preprocess(self, inbox, outbox):
+        while True:
+            item = self._get(inbox)
+            if item is _END:
+                break
+            index, frame = item
+            if frame is not None:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                frame = cv2.resize(frame, (self.size[1], self.size[0]),
+                                   interpolation=cv2.INTER_AREA)
+                frame = (frame.astype(np.float32)-self.mean)/self.std
+                frame = torch.from_numpy(frame).permute(2, 0, 1)
+            self._put(outbox, (index, frame))
+        self._put(outbox, _END)
+
+    def _forward(self, inbox, outbox):
+        # 'pending' keeps the order of the frames until their keyframes run
+        pending, keys, mask = [], [], None
+        while True:
+            item = self._get(inbox)
+            if item is not _END:
+                index, frame = item
+                if frame is None and not keys:
+                    self._put(outbox, (index, mask))
+                    continue
+                pending.append(item)
+                if frame is not None:
+                    keys.append(frame)
+                if len(keys) < self.batch_size:
+                    continue
+            if keys:
+                x = torch.stack(keys).to(self.device)
+                with torch.no_grad(), self.precision.autocast():
+                    pred = self.model(x)
+                self.keyframes += len(keys)
+                masks = iter((255*(pred.argmax(dim=1) == 0)).to(torch.uint8).cpu().numpy())
+                for index, frame in pending:
+                    if frame is not None:
+                        mask = next(masks)
+                    self._put(outbox, (index, mask))
+                pending, keys = [], []
+            if item is _END:
+                break
+        self._put(outbox, _END)
+
+    def _encode(self, inbox, sink, frame_size):
+        while True:
+            item = self._get(inbox)
+            if item is _END:
+                break
+            index, mask = item
+            if self.keep_size and mask.shape != frame_size:
+                mask = cv2.resize(mask, (frame_size[1], frame_size[0]),
+                                  interpolation=cv2.INTER_NEAREST)
+            sink(index, mask)
+            self.frames += 1
+
+    def run(self, source, sink):
+        '''Segment the video 'source', calling 'sink(index, mask)' per frame
+
+        The masks are 'uint8' arrays, with the first class (the liver) in
+        white, given to 'sink' in the order of the frames. Returns a dict with
+        the number of 'frames' and 'keyframes', the 'seconds' spent, the 'fps'
+        of the segmentation and the 'video_fps'.
+        '''
+        capture = cv2.VideoCapture(source)
+        if not capture.isOpened():
+            raise IOError('could not open the video '+str(source))
+        frame_size = (int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                      int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        video_fps = capture.get(cv2.CAP_PROP_FPS)
+        self.stop = threading.Event()
+        self.errors = []
+        self.frames, self.keyframes = 0, 0
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(3)]
+        stages = [(self._decode, capture, queues[0]),
+                  (self._preprocess, queues[0], queues[1]),
+                  (self._forward, queues[1], queues[2])]
+        threads = [threading.Thread(target=self._stage, args=stage, daemon=True)
+                   for stage in stages]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        # the encoding (and 'sink') runs in the calling thread
+        try:
+            self._stage(self._encode, queues[2], sink, frame_size)
+        finally:
+            for thread in threads:
+                thread.join()
+            capture.release()
+        if self.errors:
+            raise self.errors[0]
+        seconds = time.perf_counter()-start
+        return {'frames': self.frames, 'keyframes': self.keyframes, 'seconds': seconds,
+                'fps': self.frames/max(seconds, 1e-9), 'video_fps': video_fps}
+
+
+def segment_video(model, source, filename, **kwargs):
+    '''Segment the video 'source' and save the masks in the video 'filename'
+
+    The keyword arguments are passed to 'VideoPipeline', and the returned
+    dict is the one of 'VideoPipeline.run'.
+    '''
+    pipeline = VideoPipeline(model, **kwargs)
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30
+    if pipeline.keep_size:
+        size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    else:
+        size = (pipeline.size[1], pipeline.size[0])
+    capture.release()
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                             size, isColor=False)
+    try:
+        return pipeline.run(source, lambda index, mask: writer.write(mask))
+    finally:
+        writer.release()
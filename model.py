@@ -1,17 +1,68 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
+import contextlib
+import copy
+from typing import Optional, Tuple
 import time
 
+
+# during the recomputation of a checkpointed forward, the batch normalizations
+# have to use the batch statistics again, without updating the running ones
+# (a momentum of 0 keeps them, and the same tensors are saved for the backward)
+@contextlib.contextmanager
+def _frozen_batchnorm(module):
+    batchnorms = [m for m in module.modules() if isinstance(m, nn.BatchNorm2d)
+                  and m.track_running_stats]
+    state = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in batchnorms]
+    for bn in batchnorms:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, (momentum, tracked) in zip(batchnorms, state):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(tracked)
+
+def _checkpoint(function, module, *inputs):
+    return checkpoint(function, *inputs, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(),
+                                          _frozen_batchnorm(module)))
+
+
 # Since nn.Sequential does not handle multiple inputs, create mySequential to
-# handle it, inhiriting from nn.Sequential
+# handle it, inhiriting from nn.Sequential. Its modules are the residual blocks,
+# which receive and return '(x, long_skip)'. The inputs have fixed types (and
+# no dispatch on 'type(inputs)'), so the models can be scripted, exported and
+# compiled by 'torch.compile' (without graph breaks)
 class mySequential(nn.Sequential):
-    def forward(self, *inputs):
-        for module in self._modules.values():
-            if type(inputs) == tuple:
-                inputs = module(*inputs)
-            else:
-                inputs = module(inputs)
-        return inputs
+    # gradient checkpointing in training: '' (off), 'stage' or 'block'
+    checkpointing: str = ''
+
+    def forward(self, x: torch.Tensor, long_skip: Optional[torch.Tensor] = None
+                ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        if (self.checkpointing and self.training and torch.is_grad_enabled()
+                and not torch.jit.is_scripting()):
+            return self._forward_checkpointed(x, long_skip)
+        return self._forward_blocks(x, long_skip)
+
+    def _forward_blocks(self, x: torch.Tensor, long_skip: Optional[torch.Tensor] = None
+                        ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        for module in self:
+            x, long_skip = module(x, long_skip)
+        return x, long_skip
+
+    @torch.jit.unused
+    def _forward_checkpointed(self, x: torch.Tensor, long_skip: Optional[torch.Tensor]
+                              ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        # only the inputs of the stage (or of each block) are kept for the
+        # backward, and the rest of the activations are computed again
+        if self.checkpointing == 'stage':
+            return _checkpoint(self._forward_blocks, self, x, long_skip)
+        for module in self:
+            x, long_skip = _checkpoint(module, module, x, long_skip)
+        return x, long_skip
 
 
 class block_standard(nn.Module):
@@ -42,7 +93,8 @@ class block_standard(nn.Module):
         self.relu = nn.ReLU()
         self.identity_downsample = identity_downsample
 
-    def forward(self, x, long_skip=None):
+    def forward(self, x: torch.Tensor, long_skip: Optional[torch.Tensor] = None
+                ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         identity = x
         x = self.conv1(x)
         x = self.bn1(x)
@@ -57,8 +109,6 @@ class block_standard(nn.Module):
         x += identity
         x = self.relu(x)
 
-        del identity
-
         return x, long_skip
 
 
@@ -102,7 +152,8 @@ class block_bottleneck(nn.Module):
         self.relu = nn.ReLU()
         self.identity_scale = identity_scale
 
-    def forward(self, x, long_skip=None):
+    def forward(self, x: torch.Tensor, long_skip: Optional[torch.Tensor] = None
+                ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         identity = x
         x = self.conv1(x)
         x = self.bn1(x)
@@ -121,8 +172,6 @@ class block_bottleneck(nn.Module):
         x += identity
         x = self.relu(x)
 
-        del identity
-
         return x, long_skip
 
 class UResNet(nn.Module): # [3, 4, 6, 3]
@@ -136,7 +185,6 @@ class UResNet(nn.Module): # [3, 4, 6, 3]
         self.bn1 = nn.BatchNorm2d(64)
         self.relu = nn.ReLU()
         self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
-        self.long_skip = []
 
         # ResNet Layers  [3, 4, 6, 3]
         self.layer1 = self._make_layer(block, layers[0], out_channels=64, stride=1)
@@ -156,41 +204,64 @@ class UResNet(nn.Module): # [3, 4, 6, 3]
         self.bn2 = nn.BatchNorm2d(num_classes)
         self.Softmax = nn.Softmax(dim=1)
 
-    def forward(self, x):
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
-        self.long_skip = [0, 0, 0, 0]
-        self.long_skip[0] = x
+        # the long skips are local variables (not attributes of the model), so
+        # they are freed when not needed and the graph can be exported
+        long_skip0 = x
         x = self.maxpool(x)
 
-        x, temp = self.layer1(x, None)
-        self.long_skip[1] = x
-        x, temp = self.layer2(x, None)
-        self.long_skip[2] = x
-        x, temp = self.layer3(x, None)
-        self.long_skip[3] = x
-        x, temp = self.layer4(x, None)
-
-        self.long_skip = self.long_skip[::-1]
-
-        x, temp = self.layer5(x, self.long_skip[0])
-        x, temp = self.layer6(x, self.long_skip[1])
-        x, temp = self.layer7(x, self.long_skip[2])
-        x, temp = self.layer8(x, None)
+        x, _ = self.layer1(x, None)
+        long_skip1 = x
+        x, _ = self.layer2(x, None)
+        long_skip2 = x
+        x, _ = self.layer3(x, None)
+        long_skip3 = x
+        x, _ = self.layer4(x, None)
+
+        x, _ = self.layer5(x, long_skip3)
+        x, _ = self.layer6(x, long_skip2)
+        x, _ = self.layer7(x, long_skip1)
+        x, _ = self.layer8(x, None)
         x = self.conv_last1(x)
         x = self.bn1(x)
-        x = torch.cat((x, self.long_skip[3]), dim=1)
+        x = torch.cat((x, long_skip0), dim=1)
         x = self.relu(x)
         x = self.conv_last2(x)
         x = self.bn2(x)
         x = self.Softmax(x)
 
-        del self.long_skip, temp
-
         return x
 
 
+    def set_checkpointing(self, granularity='stage', layers=None):
+        '''Enable (or disable) gradient checkpointing in training
+
+        With checkpointing, only the inputs of each checkpointed part are kept
+        for the backward, and its activations are computed again (with the
+        running statistics of the batch normalizations not updated twice),
+        which saves memory for the deeper UResNets at the cost of one more
+        forward pass per step.
+
+        granularity: str (input)
+            'stage' (one checkpoint per layer, saving more memory), 'block'
+            (one per residual block, with a lower peak during the backward) or
+            'None' to disable it;
+        layers: list (input)
+            names of the layers to checkpoint, e.g. ['layer1', 'layer2',
+            'layer3', 'layer4'] for the encoder ('None' for all the layers).
+        '''
+        if granularity not in (None, 'stage', 'block'):
+            raise ValueError('granularity has to be "stage", "block" or None')
+        if layers is None:
+            layers = ['layer'+str(i) for i in range(1, 9)]
+        for name in ['layer'+str(i) for i in range(1, 9)]:
+            getattr(self, name).checkpointing = (granularity or '') if name in layers else ''
+        return self
+
+
     def _make_layer(self, block, num_residual_blocks,
                          out_channels, stride, up=False):
         identity_scale = None
@@ -198,11 +269,11 @@ class UResNet(nn.Module): # [3, 4, 6, 3]
 
         if up==False:
             if stride != 1 or self.in_channels != out_channels*block.expansion:
-                identity_scale = mySequential(nn.Conv2d(self.in_channels,
-                                                        out_channels*block.expansion,
-                                                        kernel_size=1,
-                                                        stride=stride),
-                                              nn.BatchNorm2d(out_channels*block.expansion))
+                identity_scale = nn.Sequential(nn.Conv2d(self.in_channels,
+                                                         out_channels*block.expansion,
+                                                         kernel_size=1,
+                                                         stride=stride),
+                                               nn.BatchNorm2d(out_channels*block.expansion))
 
             layers.append(block(self.in_channels, out_channels,
                                 identity_scale, stride))
@@ -213,11 +284,11 @@ class UResNet(nn.Module): # [3, 4, 6, 3]
 
         else:
             if stride != 1 or self.in_channels != out_channels*block.expansion:
-                identity_scale = mySequential(nn.ConvTranspose2d(self.in_channels,
-                                                                 out_channels*block.expansion,
-                                                                 kernel_size=stride,
-                                                                 stride=stride),
-                                              nn.BatchNorm2d(out_channels*block.expansion))
+                identity_scale = nn.Sequential(nn.ConvTranspose2d(self.in_channels,
+                                                                  out_channels*block.expansion,
+                                                                  kernel_size=stride,
+                                                                  stride=stride),
+                                               nn.BatchNorm2d(out_channels*block.expansion))
             # This is to devide the 'out_channels' by 2 in the standard block
             # if you see, the output channels is really half of the value in
             # this block.
@@ -253,6 +324,67 @@ def UResNet152(in_channels=3, num_classes=1000):
     return UResNet(block_bottleneck, [3, 8, 36, 3], in_channels, num_classes)
 
 
+# fusing a convolution (or transposed convolution) and a batch normalization
+def _fuse(conv, bn):
+    return fuse_conv_bn_eval(conv, bn, transpose=isinstance(conv, nn.ConvTranspose2d))
+
+def fuse_for_inference(model, drop_softmax=False, atol=1e-4):
+    '''Return a copy of a UResNet with the batch normalizations folded
+
+    In evaluation, a batch normalization is only a scale and a shift of each
+    channel, so it can be folded in the weights of the previous convolution
+    (or transposed convolution), which saves one pass through the memory per
+    layer. The batch normalizations are replaced by 'nn.Identity', and the
+    shared 'bn1' of the UResNets is folded in both 'conv1' and 'conv_last1'.
+    The fused model can only be used in evaluation (it cannot be trained).
+
+    model: 'UResNet' (input)
+        model to fuse (it is not changed);
+    drop_softmax: bool (input)
+        if 'True', the final softmax is removed, which does not change the
+        argmax of the output (use it when only the masks are needed);
+    atol: float (input)
+        maximum difference to the outputs of 'model' (checked with a random
+        image), or 'None' to skip the check.
+    '''
+    fused = copy.deepcopy(model).eval()
+    for module in fused.modules():
+        if isinstance(module, (block_standard, block_bottleneck)):
+            module.conv1 = _fuse(module.conv1, module.bn1)
+            module.conv2 = _fuse(module.conv2, module.bn2)
+            module.bn1, module.bn2 = nn.Identity(), nn.Identity()
+            if isinstance(module, block_bottleneck):
+                module.conv3 = _fuse(module.conv3, module.bn3)
+                module.bn3 = nn.Identity()
+            projection = (module.identity_downsample if isinstance(module, block_standard)
+                          else module.identity_scale)
+            if projection is not None:
+                projection[0] = _fuse(projection[0], projection[1])
+                projection[1] = nn.Identity()
+    fused.conv1 = _fuse(fused.conv1, fused.bn1)
+    fused.conv_last1 = _fuse(fused.conv_last1, fused.bn1)
+    fused.conv_last2 = _fuse(fused.conv_last2, fused.bn2)
+    fused.bn1, fused.bn2 = nn.Identity(), nn.Identity()
+    if drop_softmax:
+        fused.Softmax = nn.Identity()
+
+    if atol is not None:
+        parameter = next(model.parameters())
+        x = torch.randn(2, fused.conv1.in_channels, 64, 64,
+                        device=parameter.device, dtype=parameter.dtype)
+        training = model.training
+        model.eval()
+        with torch.no_grad():
+            y, y_fused = model(x), fused(x)
+        model.train(training)
+        if drop_softmax:
+            y_fused = torch.softmax(y_fused, dim=1)
+        error = (y-y_fused).abs().max().item()
+        if error > atol:
+            raise RuntimeError(f'fused model differs from the original by {error:.2e}')
+    return fused
+
+
 def test():
     net = UResNet18()
     # working sizes 224, 256, 288
@@ -0,0 +1,212 @@
+"""
+Batched Offline Inference of Segmentation Models
+
+This program segments frames with a trained model, saving one mask per frame,
+without labels, notebooks or a Drive mount. It runs together with the files
+'model.py', 'utils.py', 'dataset.py' and 'inference.py'. The frames are
+decoded and resized in DataLoader workers, segmented in batches without
+gradients, and the masks are encoded and written in a thread pool, while the
+next batch is processed.
+
+The masks are saved with the DSAD convention (white for the first class, i.e.
+the liver), in the folder of the frame inside 'output' (relative to the
+common folder of the frame directories), and with 'image' replaced by 'mask'
+in the file name. E.g. from 'liver/01' and 'liver/02', 'liver/01/image03.png'
+is saved as 'output/01/mask03.png', and from 'liver/01' and 'pancreas/01', as
+'output/liver/01/mask03.png'.
+
+Example:
+    python predict.py DSAD/liver/03 "DSAD/liver/2*/image0*.png" \\
+        --checkpoint my_checkpoint30.pth.tar --model UResNet34 --output masks
+
+Use '--tile' to segment the frames in their original size with overlapping
+tiles (see 'inference.sliding_window_inference'), instead of resizing them.
+
+Use '--video' to segment video files (e.g. the DSAD recordings) without saving
+their frames, with the masks saved in 'output/<video name>_mask.mp4' (see
+'inference.VideoPipeline'). With '--stride', only one in 'stride' frames is
+segmented, and with '--threshold' a new frame is segmented when the scene
+changes (or after 'stride' frames), while the others reuse the last mask.
+
+Use '--precision bf16' to run the forward passes in bfloat16 (faster in CPUs
+with AVX-512 BF16 or AMX, see 'utils.Precision' and 'benchmark.py --precision').
+Use '--compile' to compile the model with 'torch.compile' in the channels_last
+layout (see 'utils.CompiledMode' and 'benchmark.py --compile'), which pays off
+for many frames (the compile time is printed apart).
+"""
+import os
+import glob
+import time
+import argparse
+import torch
+from torch.utils.data import DataLoader
+import model as models
+from utils import ImageWriter, load_checkpoint, FrameCache, Precision, CompiledMode
+from inference import FrameDataset, list_images, sliding_window_inference
+from inference import segment_video
+
+
+def mask_root(paths):
+    '''Return the folder to which the mask folders are relative: the common
+    folder of the frame directories (or its parent, with only one directory)'''
+    directories = sorted(set(os.path.dirname(os.path.abspath(path)) for path in paths))
+    root = os.path.commonpath(directories)
+    return os.path.dirname(root) if len(directories) == 1 else root
+
+def mask_path(output, path, root):
+    '''Return the path to save the mask of the frame in 'path' '''
+    directory, filename = os.path.split(os.path.abspath(path))
+    stem = os.path.splitext(filename)[0]
+    if stem.startswith('image'):
+        stem = 'mask'+stem[5:]
+    else:
+        stem = stem+'_mask'
+    return os.path.join(output, os.path.relpath(directory, root), stem+'.png')
+
+def mask_paths(output, paths):
+    '''Return the mask path of each frame, failing if two are the same (e.g.
+    'image03.png' and 'image03.jpg' in the same directory)'''
+    root = mask_root(paths)
+    masks = [mask_path(output, path, root) for path in paths]
+    seen = {}
+    for path, mask in zip(paths, masks):
+        if mask in seen:
+            raise SystemExit(f"'{seen[mask]}' and '{path}' would both be saved in '{mask}'")
+        seen[mask] = path
+    return masks
+
+# masks with the first class in white (as the DSAD masks), in 'uint8'
+def encode_masks(pred):
+    return (255*(pred.argmax(dim=1) == 0)).to(torch.uint8)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Segment frames with a trained model')
+    parser.add_argument('inputs', nargs='+',
+                        help='directories or globs of the frames to segment')
+    parser.add_argument('--checkpoint', required=True,
+                        help='checkpoint saved by train.py')
+    parser.add_argument('--model', default='UResNet34',
+                        help='model in model.py (default: UResNet34)')
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--output', default='predictions',
+                        help='directory to save the masks')
+    parser.add_argument('--height', type=int, default=512,
+                        help='height to resize the frames (multiple of 32)')
+    parser.add_argument('--width', type=int, default=640,
+                        help='width to resize the frames (multiple of 32)')
+    parser.add_argument('--keep-size', action='store_true',
+                        help='resize the masks back to the size of the frames')
+    parser.add_argument('--tile', action='store_true',
+                        help='segment the original frames with overlapping '
+                        'tiles of height x width')
+    parser.add_argument('--overlap', type=float, default=0.25)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=4,
+                        help='threads to encode and write the masks')
+    parser.add_argument('--cache-bytes', type=int, default=0,
+                        help='bytes of decoded frames cached in memory')
+    parser.add_argument('--video', action='store_true',
+                        help='the inputs are video files (or globs)')
+    parser.add_argument('--stride', type=int, default=1,
+                        help='distance between segmented video frames')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='scene change (mean difference in [0,255]) that '
+                        'makes a video frame be segmented')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16', 'auto'],
+                        help='dtype of the forward passes (see utils.Precision)')
+    parser.add_argument('--compile', action='store_true',
+                        help='torch.compile the model, in channels_last (see utils.CompiledMode)')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.video:
+        return main_video(args)
+    paths = list_images(args.inputs)
+    if not paths:
+        raise SystemExit('no images found in '+', '.join(args.inputs))
+
+    # loading the model
+    model = getattr(models, args.model)(in_channels=3, num_classes=args.num_classes)
+    load_checkpoint(torch.load(args.checkpoint, map_location='cpu'), model)
+    model = model.to(args.device).eval()
+    # folding the batch normalizations (the softmax is only needed to blend
+    # the tiles, the masks only use the argmax)
+    model = models.fuse_for_inference(model, drop_softmax=not args.tile)
+    compiled = CompiledMode(args.compile)
+    compiled.model(model)
+
+    size = None if args.tile else [args.height, args.width]
+    cache = FrameCache(max_bytes=args.cache_bytes) if args.cache_bytes > 0 else None
+    dataset = FrameDataset(paths, size=size, cache=cache)
+    # with '--tile' the frames can have different sizes, and the batches are
+    # made of tiles instead (in 'sliding_window_inference')
+    loader = DataLoader(dataset, batch_size=1 if args.tile else args.batch_size,
+                        num_workers=args.num_workers,
+                        pin_memory=args.device.startswith('cuda'))
+    outputs = mask_paths(args.output, paths)
+    for output in outputs:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    print(f'\n- Segmenting {len(paths)} frames...\n')
+    writer = ImageWriter(workers=args.writers)
+    precision = Precision(args.precision, args.device)
+    start = time.perf_counter()
+    with torch.no_grad(), precision.autocast():
+        for batch in loader:
+            x = batch['image']
+            if args.tile:
+                pred = sliding_window_inference(model, x, [args.height, args.width],
+                                                overlap=args.overlap,
+                                                batch_size=args.batch_size,
+                                                device=args.device)[None]
+            else:
+                pred = model(x.to(args.device, non_blocking=True))
+            masks = encode_masks(pred)
+            for mask, idx, frame_size in zip(masks, batch['index'], batch['size']):
+                if args.keep_size and list(mask.shape) != frame_size.tolist():
+                    mask = torch.nn.functional.interpolate(mask[None,None].float(),
+                                                           size=frame_size.tolist(),
+                                                           mode='nearest')[0,0].to(torch.uint8)
+                writer.save_array(mask.cpu().numpy(), outputs[idx])
+    writer.close()
+    elapsed = time.perf_counter()-start
+    print(f'Segmented {len(paths)} frames in {elapsed:.1f} s '
+          f'({len(paths)/elapsed:.2f} frames/s)')
+    if args.compile:
+        print(f'({compiled.report()}, included above)')
+
+
+def main_video(args):
+    paths = sorted(path for pattern in args.inputs for path in glob.glob(pattern))
+    if not paths:
+        raise SystemExit('no videos found in '+', '.join(args.inputs))
+    model = getattr(models, args.model)(in_channels=3, num_classes=args.num_classes)
+    load_checkpoint(torch.load(args.checkpoint, map_location='cpu'), model)
+    model = model.to(args.device).eval()
+    model = models.fuse_for_inference(model, drop_softmax=True)
+    compiled = CompiledMode(args.compile)
+    compiled.model(model)
+    os.makedirs(args.output, exist_ok=True)
+
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        print(f'\n- Segmenting {path}...')
+        stats = segment_video(model, path, os.path.join(args.output, stem+'_mask.mp4'),
+                              size=[args.height, args.width], batch_size=args.batch_size,
+                              stride=args.stride, threshold=args.threshold,
+                              keep_size=args.keep_size, device=args.device,
+                              precision=Precision(args.precision, args.device))
+        print(f"Segmented {stats['frames']} frames ({stats['keyframes']} keyframes) "
+              f"in {stats['seconds']:.1f} s ({stats['fps']:.2f} frames/s, "
+              f"{stats['fps']/(stats['video_fps'] or 1):.2f}x real time)")
+    if args.compile:
+        print(f'({compiled.report()}, included in the first video)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Post-Training INT8 Quantization of the UResNet Models for CPU Inference
+
+This program quantizes a trained UResNet (weights and activations in INT8),
+to run faster in CPU-only hosts. It runs together with 'model.py', 'utils.py'
+and 'dataset.py', and the steps are:
+
+    1. the batch normalizations are folded in the convolutions (see 'model.
+       fuse_for_inference'), and the model is traced with 'torch.fx';
+    2. observers are inserted in the traced graph, and the activation ranges
+       are calibrated with the first '--calibration-frames' frames of the
+       '--calibration-dirs' (by default, the validation directories), only
+       resized and normalized (see 'utils.eval_loader');
+    3. the model is converted to INT8 (the last convolution and the softmax
+       stay in float, since quantizing the class scores changes the masks);
+    4. the float and the INT8 models are evaluated with 'check_accuracy', and
+       the program fails (exit code 1) if the Dice score drops more than
+       '--max-dice-drop' (in percentage points);
+    5. the speedup and the size reduction are reported, and the INT8 model
+       is saved with TorchScript (load it with 'torch.jit.load').
+
+Example:
+    python quantize.py --checkpoint my_checkpoint30.pth.tar --model UResNet34 \\
+        --calibration-dirs DSAD/liver/01 DSAD/liver/02 --val-dirs DSAD/liver/03 \\
+        --output UResNet34_int8.pt
+"""
+import io
+import copy
+import argparse
+import torch
+import torch.nn as nn
+import torch.fx as fx
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+import model as models
+from utils import eval_loader, load_checkpoint, check_accuracy
+from export import measure
+
+
+def trace_for_quantization(model):
+    '''Return a 'torch.fx.GraphModule' of 'model' with the BNs folded
+
+    The 'nn.Identity' left by 'fuse_for_inference' are removed from the graph,
+    so the (convolution, ReLU) pairs can be fused by 'prepare_fx'.
+    '''
+    graph = fx.symbolic_trace(models.fuse_for_inference(model))
+    for node in list(graph.graph.nodes):
+        if node.op == 'call_module' and isinstance(graph.get_submodule(node.target),
+                                                   nn.Identity):
+            node.replace_all_uses_with(node.args[0])
+            graph.graph.erase_node(node)
+    graph.graph.lint()
+    graph.recompile()
+    graph.delete_all_unused_submodules()
+    return graph
+
+
+def quantize_model(model, loader, frames=256, backend=None, float_head=True):
+    '''Return an INT8 copy of 'model', calibrated with the frames of 'loader'
+
+    model: 'UResNet' (input)
+        float model (it is not changed);
+    loader: 'DataLoader' (input)
+        loader used to calibrate the activation ranges;
+    frames: int (input)
+        number of frames used in the calibration;
+    backend: str (input)
+        quantized engine ('x86', 'fbgemm' or 'qnnpack' for ARM), the default
+        is 'x86' if available;
+    float_head: bool (input)
+        if 'True', 'conv_last2' and the softmax are kept in float.
+    '''
+    if backend is None:
+        engines = torch.backends.quantized.supported_engines
+        backend = 'x86' if 'x86' in engines else 'fbgemm'
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    if float_head:
+        qconfig_mapping = (qconfig_mapping.set_module_name('conv_last2', None)
+                                          .set_module_name('Softmax', None))
+
+    graph = trace_for_quantization(model)
+    example = next(iter(loader))
+    example = example[list(example)[0]][:1]
+    prepared = prepare_fx(graph, qconfig_mapping, (example,))
+    count = 0
+    with torch.no_grad():
+        for dictionary in loader:
+            image, label = dictionary
+            prepared(dictionary[image])
+            count += len(dictionary[image])
+            if count >= frames:
+                break
+    print(f'\n- Calibrated with {count} frames')
+    return convert_fx(prepared)
+
+
+def model_bytes(model):
+    '''Return the size in bytes of the serialized 'state_dict' of 'model' '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Quantize a UResNet to INT8')
+    parser.add_argument('--checkpoint', required=True,
+                        help='checkpoint saved by train.py')
+    parser.add_argument('--model', default='UResNet34',
+                        help='model in model.py (default: UResNet34)')
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--val-dirs', nargs='+', required=True,
+                        help='validation directories (to evaluate)')
+    parser.add_argument('--calibration-dirs', nargs='+', default=None,
+                        help='directories to calibrate (default: --val-dirs)')
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--calibration-frames', type=int, default=256)
+    parser.add_argument('--max-dice-drop', type=float, default=1.0,
+                        help='maximum Dice drop (percentage points)')
+    parser.add_argument('--backend', default=None,
+                        help='quantized engine (x86, fbgemm or qnnpack)')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='iterations to measure the latency')
+    parser.add_argument('--output', default=None,
+                        help='file to save the INT8 model (TorchScript)')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    # quantized models only run in CPU
+    device = 'cpu'
+    model = getattr(models, args.model)(in_channels=3, num_classes=args.num_classes)
+    load_checkpoint(torch.load(args.checkpoint, map_location='cpu'), model)
+    model.eval()
+
+    valid_loader = eval_loader(args.val_dirs, args.height, args.width,
+                               args.batch_size, args.num_workers)
+    calibration_loader = valid_loader
+    if args.calibration_dirs:
+        calibration_loader = eval_loader(args.calibration_dirs, args.height, args.width,
+                                         args.batch_size, args.num_workers)
+
+    quantized = quantize_model(model, calibration_loader, args.calibration_frames,
+                               args.backend)
+
+    loss_fn = nn.L1Loss()
+    _, _, dice = check_accuracy(valid_loader, model, loss_fn, device=device,
+                                title='FP32')
+    _, _, dice_int8 = check_accuracy(valid_loader, quantized, loss_fn, device=device,
+                                     title='INT8')
+
+    x = torch.randn(1, 3, args.height, args.width)
+    with torch.no_grad():
+        latency = measure(model, x, args.iterations)
+        latency_int8 = measure(quantized, x, args.iterations)
+    size, size_int8 = model_bytes(model), model_bytes(quantized)
+    print(f'Dice score: FP32 {dice:.4f}, INT8 {dice_int8:.4f} '
+          f'(drop of {dice-dice_int8:.4f})')
+    print(f'Latency (batch 1): FP32 {1000*latency:.1f} ms, INT8 {1000*latency_int8:.1f} ms '
+          f'({latency/latency_int8:.2f}x speedup)')
+    print(f'Size: FP32 {size/1e6:.1f} MB, INT8 {size_int8/1e6:.1f} MB '
+          f'({size/size_int8:.2f}x smaller)')
+
+    if dice-dice_int8 > args.max_dice_drop:
+        raise SystemExit(f'INT8 Dice score dropped {dice-dice_int8:.4f} points '
+                         f'(more than {args.max_dice_drop})')
+    if args.output:
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(quantized, x), args.output)
+        print(f'\n- Saved {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Offline Conversion of the DSAD Directories to Pre-Resized Shards
+
+In training, each sample is decoded from a PNG in the original resolution and
+only then resized (every epoch), and reading thousands of small PNGs from a
+network mount (e.g. Google Drive) is slow random I/O. This program decodes and
+resizes the frames once, and writes them in a few large shards:
+
+    output/train-00000.images.npy   'uint8' frames, (N,height,width,3)
+    output/train-00000.labels.npy   'uint8' 'index' labels, (N,height,width,1)
+    ...
+    output/manifest.json            size, shards and the source of each frame
+
+The frames are resized as in 'get_loaders' (bilinear with antialias for the
+frames, nearest for the labels), and the labels are stored as class indices
+plus one (see 'dataset.read_sample'). The manifest is written at the end, so
+an interrupted conversion is never used.
+
+Example:
+    python shards.py --train-dirs DSAD/liver/01 DSAD/liver/02 \\
+        --val-dirs DSAD/liver/03 --output DSAD_shards --height 512 --width 640
+
+To train with the shards, set 'shards_manifest' in 'train.py' to the path of
+'manifest.json' (the directories of the shards replace 'train_image_dir' and
+'val_image_dir'), see 'dataset.ShardStream'.
+"""
+import os
+import json
+import argparse
+import collections
+from multiprocessing import Pool
+import numpy as np
+import torch
+from torchvision.transforms import Compose
+from dataset import DresdenIndex, read_sample
+from utils import ToTensor, Resize
+
+
+def prepare_frame(job):
+    '''Decode and resize one frame, returning (frame, label, original size)'''
+    directory, image_name, label_name, size = job
+    sample = read_sample(directory, image_name, label_name, label_mode='index')
+    source = list(sample['image0'].shape[:2])
+    sample = Compose([ToTensor(n=1), Resize(size=size, n=1)])(sample)
+    image = (255*sample['image0']).round().clamp(0, 255).to(torch.uint8)
+    return (image.permute(1, 2, 0).numpy(), sample['image1'].permute(1, 2, 0).numpy(),
+            source)
+
+
+def write_shards(image_dirs, split, output, size, shard_frames=256, workers=1):
+    '''Write the frames of 'image_dirs' in shards, returning their entries
+    in the manifest (and the original size of each frame)'''
+    index = DresdenIndex(image_dirs)
+    jobs = [(index.image_dirs[index.directory[f]], index.image_names[f],
+             index.label_names[f], list(size)) for f in range(len(index))]
+    entries, sources = [], []
+    height, width = size
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        for start in range(0, len(jobs), shard_frames):
+            stop = min(start+shard_frames, len(jobs))
+            name = '%s-%05d' % (split, len(entries))
+            images = np.lib.format.open_memmap(os.path.join(output, name+'.images.npy'),
+                                               mode='w+', dtype=np.uint8,
+                                               shape=(stop-start, height, width, 3))
+            labels = np.lib.format.open_memmap(os.path.join(output, name+'.labels.npy'),
+                                               mode='w+', dtype=np.uint8,
+                                               shape=(stop-start, height, width, 1))
+            results = (pool.imap(prepare_frame, jobs[start:stop], chunksize=4) if pool
+                       else map(prepare_frame, jobs[start:stop]))
+            for i, (image, label, source) in enumerate(results):
+                images[i], labels[i] = image, label
+                sources.append(source)
+            images.flush()
+            labels.flush()
+            del images, labels
+            entries.append({'images': name+'.images.npy', 'labels': name+'.labels.npy',
+                            'frames': stop-start,
+                            'directory': index.directory[start:stop].tolist(),
+                            'files': [job[1:3] for job in jobs[start:stop]]})
+            print(f'{name}: {stop-start} frames')
+    finally:
+        if pool is not None:
+            pool.close()
+    return entries, sources
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Convert DSAD directories to shards')
+    parser.add_argument('--train-dirs', nargs='+', required=True,
+                        help='training directories (as in train.py)')
+    parser.add_argument('--val-dirs', nargs='*', default=[],
+                        help='validation directories')
+    parser.add_argument('--output', required=True, help='folder of the shards')
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--shard-frames', type=int, default=256,
+                        help='frames per shard (256 frames of 512x640 are ~320 MB)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes decoding the frames')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    os.makedirs(args.output, exist_ok=True)
+    size = [args.height, args.width]
+    manifest = {'version': 1, 'size': size, 'label_mode': 'index',
+                'directories': {}, 'splits': {}}
+    sources = []
+    for split, image_dirs in [('train', args.train_dirs), ('valid', args.val_dirs)]:
+        if not image_dirs:
+            continue
+        print(f'\n- Writing the {split} shards...')
+        entries, split_sources = write_shards(image_dirs, split, args.output, size,
+                                              args.shard_frames, args.workers)
+        manifest['directories'][split] = list(image_dirs)
+        manifest['splits'][split] = entries
+        sources += split_sources
+    # the original size (the most common one) scales the augmentations
+    manifest['source size'] = list(collections.Counter(map(tuple, sources)).most_common(1)[0][0])
+    path = os.path.join(args.output, 'manifest.json')
+    with open(path+'.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(path+'.tmp', path)
+    print(f'\n- Saved {path}')
+
+
+if __name__ == '__main__':
+    main()
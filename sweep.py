@@ -0,0 +1,238 @@
+"""
+Parallel Evaluation of the Checkpoints of a Training (Checkpoint Sweep)
+
+To choose the best epoch of a training, all its checkpoints are evaluated in
+the same frames. Instead of decoding, resizing and normalizing the frames
+again for each checkpoint, this program prepares the evaluation set once, as
+'uint8' tensors in shared memory, and a pool of processes evaluates the
+checkpoints in parallel (all of them reading the same frames). The results
+are written to a 'csv' table ranked by the mean Dice score:
+
+    rank, checkpoint, dice, iou, accuracy, dice class 0, ..., latency (ms/image)
+
+where the latency is the forward time per frame (in batches of '--batch-size'
+frames, with the threads of one process).
+
+Example:
+    python sweep.py results --val-dirs DSAD/liver/03 DSAD/liver/22 \\
+        --model UResNet34 --height 512 --width 640 --processes 4
+
+The checkpoints are the files 'my_checkpoint*.pth.tar' of the given folders
+(or the given files). The frames can also be read from the 'valid' split of
+the shards of 'shards.py' (with '--shards DSAD_shards/manifest.json'). The
+metrics are the ones of 'train.py' (the frames are only resized, without
+random transforms, see 'utils.MetricSink').
+"""
+import os
+import re
+import glob
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, DataLoader
+import model as models
+from dataset import DresdenIndex, ShardIndex
+from shards import prepare_frame
+from utils import load_checkpoint, evaluate, MetricSink, StageTimer, Precision
+from utils import DRESDEN_MEAN, DRESDEN_STD
+
+
+def list_checkpoints(inputs, pattern='my_checkpoint*.pth.tar'):
+    '''Return the checkpoints in 'inputs' (folders, files or globs), sorted by
+    the epoch number in their names'''
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths += glob.glob(os.path.join(item, pattern))
+        else:
+            paths += glob.glob(item)
+    def epoch(path):
+        numbers = re.findall(r'\d+', os.path.basename(path))
+        return (int(numbers[-1]) if numbers else -1, path)
+    return sorted(set(paths), key=epoch)
+
+
+#%% Shared Evaluation Set
+
+def load_frames(image_dirs, size, workers=1):
+    '''Decode and resize the frames of 'image_dirs' once, returning 'uint8'
+    tensors (N,3,height,width) and 'index' labels (N,1,height,width) in
+    shared memory'''
+    index = DresdenIndex(image_dirs)
+    jobs = [(index.image_dirs[index.directory[f]], index.image_names[f],
+             index.label_names[f], list(size)) for f in range(len(index))]
+    images = torch.empty(len(jobs), 3, *size, dtype=torch.uint8).share_memory_()
+    labels = torch.empty(len(jobs), 1, *size, dtype=torch.uint8).share_memory_()
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        results = pool.imap(prepare_frame, jobs, chunksize=4) if pool else map(prepare_frame, jobs)
+        for i, (image, label, _) in enumerate(results):
+            images[i] = torch.from_numpy(image).permute(2, 0, 1)
+            labels[i] = torch.from_numpy(label).permute(2, 0, 1)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return images, labels
+
+def load_shard_frames(manifest, split='valid'):
+    '''Return the frames of 'split' of the shards of 'manifest', as
+    'load_frames' (the shards are already resized)'''
+    index = ShardIndex(manifest)
+    frames = index.frames(split)
+    images = torch.empty(frames, 3, index.height, index.width, dtype=torch.uint8).share_memory_()
+    labels = torch.empty(frames, 1, index.height, index.width, dtype=torch.uint8).share_memory_()
+    for shard in range(len(index.shards(split))):
+        start = index.offsets[split][shard]
+        shard_images, shard_labels = index.arrays(split, shard)
+        stop = start+len(shard_images)
+        images[start:stop] = torch.from_numpy(np.asarray(shard_images)).permute(0, 3, 1, 2)
+        labels[start:stop] = torch.from_numpy(np.asarray(shard_labels)).permute(0, 3, 1, 2)
+    return images, labels
+
+
+class SharedFrames(Dataset):
+    '''Dataset of the (already resized) frames of 'load_frames', normalized
+    when read (the tensors are shared, and not copied, between processes)'''
+    def __init__(self, images, labels, mean=DRESDEN_MEAN, std=DRESDEN_STD):
+        self.images = images
+        self.labels = labels
+        self.mean = torch.tensor(mean).view(3, 1, 1)
+        self.std = torch.tensor(std).view(3, 1, 1)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        image = (self.images[idx].float()/255-self.mean)/self.std
+        return {'image0': image, 'image1': self.labels[idx]}
+
+
+#%% Sweep
+
+# state of each process of the pool (set once by '_init_worker')
+_worker = {}
+
+def _init_worker(images, labels, name, num_classes, batch_size, threads, device,
+                 precision):
+    if threads:
+        torch.set_num_threads(threads)
+    model = getattr(models, name)(in_channels=3, num_classes=num_classes)
+    _worker.update(model=model.to(device).eval(), device=device,
+                   precision=Precision(precision, device),
+                   loader=DataLoader(SharedFrames(images, labels), batch_size=batch_size))
+
+def evaluate_checkpoint(path):
+    '''Evaluate the checkpoint in 'path' with the model and frames of this
+    process, returning a row of the sweep table'''
+    model, device, loader = _worker['model'], _worker['device'], _worker['loader']
+    load_checkpoint(torch.load(path, map_location='cpu'), model)
+    metric = MetricSink()
+    timer = StageTimer(device)
+    evaluate({'sweep': loader}, model, [metric], device=device, timer=timer,
+             progress=False, precision=_worker['precision'])
+    acc, _, dice, metrics = metric.results['sweep']
+    forward = sum(timer.times['eval forward'])
+    row = {'checkpoint': os.path.basename(path), 'dice': dice,
+           'iou': 100*metrics['mean iou'], 'accuracy': acc}
+    for c, value in enumerate(metrics['dice']):
+        row['dice class '+str(c)] = 100*value
+    row['latency (ms/image)'] = 1000*forward/len(loader.dataset)
+    row['path'] = path
+    print(f"{row['checkpoint']}: Dice {dice:.4f}, accuracy {acc:.4f}")
+    return row
+
+def sweep(checkpoints, images, labels, name='UResNet34', num_classes=2,
+          processes=1, threads=None, batch_size=8, device='cpu', precision='fp32'):
+    '''Evaluate 'checkpoints' in the frames 'images' and 'labels' (tensors of
+    'load_frames') with 'processes' processes, returning the ranked table
+
+    name: str (input)
+        model in 'model.py' of the checkpoints;
+    threads: int (input)
+        CPU threads per process (default: cores/processes);
+    precision: str (input)
+        dtype of the forward passes (see 'utils.Precision').
+    '''
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1)//processes)
+    args = (images, labels, name, num_classes, batch_size, threads, device, precision)
+    if processes > 1:
+        # with 'spawn', the shared tensors are sent to the processes by their
+        # handles (and not copied)
+        pool = mp.get_context('spawn').Pool(processes, initializer=_init_worker,
+                                            initargs=args)
+        try:
+            rows = pool.map(evaluate_checkpoint, checkpoints, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*args)
+        rows = [evaluate_checkpoint(path) for path in checkpoints]
+    return rank_results(rows)
+
+def rank_results(rows, key='dice'):
+    '''Return the rows sorted by 'key' (higher is better), with their rank'''
+    table = pd.DataFrame(rows).sort_values(key, ascending=False, kind='stable')
+    table.insert(0, 'rank', np.arange(1, len(table)+1))
+    return table.reset_index(drop=True)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Evaluate many checkpoints in parallel')
+    parser.add_argument('checkpoints', nargs='+',
+                        help='folders (with my_checkpoint*.pth.tar), files or globs')
+    parser.add_argument('--pattern', default='my_checkpoint*.pth.tar',
+                        help='checkpoints of the folders')
+    parser.add_argument('--val-dirs', nargs='*', default=[],
+                        help='directories of the evaluation frames')
+    parser.add_argument('--shards', default=None,
+                        help="'manifest.json' of shards.py (instead of --val-dirs)")
+    parser.add_argument('--split', default='valid', help='split of the shards')
+    parser.add_argument('--model', default='UResNet34',
+                        help='model in model.py (default: UResNet34)')
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=1,
+                        help='checkpoints evaluated in parallel')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='CPU threads per process (default: cores/processes)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes decoding the frames')
+    parser.add_argument('--output', default='sweep.csv', help='csv of the ranked table')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16', 'auto'],
+                        help='dtype of the forward passes (see utils.Precision)')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    checkpoints = list_checkpoints(args.checkpoints, args.pattern)
+    if not checkpoints:
+        raise SystemExit('no checkpoints found in '+', '.join(args.checkpoints))
+    if args.shards:
+        images, labels = load_shard_frames(args.shards, args.split)
+    elif args.val_dirs:
+        print(f'\n- Decoding the frames of {len(args.val_dirs)} directories...')
+        images, labels = load_frames(args.val_dirs, [args.height, args.width], args.workers)
+    else:
+        raise SystemExit('give the evaluation frames with --val-dirs or --shards')
+    print(f'\n- Evaluating {len(checkpoints)} checkpoints in {len(images)} frames...\n')
+    table = sweep(checkpoints, images, labels, args.model, args.num_classes,
+                  args.processes, args.threads, args.batch_size, args.device,
+                  args.precision)
+    table.to_csv(args.output, index=False, float_format='%.4f')
+    print('\n'+table.drop(columns='path').head(10).to_string(index=False))
+    print(f'\n- Saved {args.output}')
+    return table
+
+
+if __name__ == '__main__':
+    main()
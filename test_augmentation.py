@@ -0,0 +1,100 @@
+'''
+Equivalence of the batched augmentations ('utils.BatchAugment') and the
+per-sample transforms they replace (the pipeline of 'utils.recipe_transform')
+
+The per-sample transforms draw their parameters from 'random', and
+'BatchAugment' from 'torch', so the same seed does not give the same random
+parameters. The recipes here have fixed outcomes (a fixed angle and flip
+probabilities of 0 or 1), so both paths apply the same transformation with
+any seed. The per-sample transforms of the pre-resized frames of the shards
+('shards.py') are also compared with the ones of the original frames. Run
+with 'python -m pytest test_augmentation.py' (or directly).
+'''
+import random
+import numpy as np
+import torch
+from torchvision.transforms import Compose
+from utils import ToTensor, Rotate, Resize, FlipVertical, FlipHorizontal, Normalize
+from utils import AugmentRecipe, BatchAugment, DRESDEN_MEAN, DRESDEN_STD
+from utils import recipe_transform
+
+
+SIZE = [64, 80]
+
+def fixed_frame(height=96, width=128):
+    # a smooth image and an 'index' label with an ellipse (as the liver)
+    rows, cols = np.mgrid[0:height, 0:width]
+    image = np.stack([np.sin(rows/9+c)*60+np.cos(cols/13)*60+128 for c in range(3)], -1)
+    label = ((rows-height/2)/(0.3*height))**2+((cols-width/2)/(0.3*width))**2 < 1
+    return image.astype(np.uint8), label.astype(np.uint8)[:,:,None]
+
+def per_sample(image, label, angle, flip_v, flip_h):
+    transform = Compose([ToTensor(n=1),
+                         Rotate(limit=[angle, angle], p=1.0),
+                         Resize(size=SIZE, n=1),
+                         FlipVertical(p=flip_v),
+                         FlipHorizontal(p=flip_h),
+                         Normalize(n=1, mean=DRESDEN_MEAN, std=DRESDEN_STD)])
+    out = transform({'image0': image.copy(), 'image1': label.copy()})
+    return out['image0'], out['image1']
+
+def batched(image, label, angle, flip_v, flip_h):
+    recipe = AugmentRecipe(rotate_limit=[angle, angle], rotate_p=1.0,
+                           flip_v=flip_v, flip_h=flip_h)
+    augment = BatchAugment([recipe], SIZE, n=1, mean=DRESDEN_MEAN, std=DRESDEN_STD)
+    out = augment({'image0': torch.from_numpy(image).permute(2, 0, 1)[None],
+                   'image1': torch.from_numpy(label).permute(2, 0, 1)[None]})
+    return out['image0'][0], out['image1'][0]
+
+def compare(angle, flip_v, flip_h, seed=0):
+    image, label = fixed_frame()
+    random.seed(seed)
+    torch.manual_seed(seed)
+    image_ref, label_ref = per_sample(image, label, angle, flip_v, flip_h)
+    image_out, label_out = batched(image, label, angle, flip_v, flip_h)
+    assert image_out.shape == image_ref.shape and label_out.dtype == label_ref.dtype
+    # the labels only differ in the border of the ellipse (both are nearest,
+    # but the pixels are rounded differently)
+    agreement = (label_out == label_ref).double().mean().item()
+    return (image_out-image_ref).abs(), agreement
+
+
+def test_resize_and_flips():
+    # without rotation, both are the same resize (with antialias) and flips
+    for flip_v, flip_h in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+        difference, agreement = compare(0, flip_v, flip_h)
+        assert difference.max().item() < 1e-4
+        assert agreement > 0.98
+
+def test_rotation():
+    # the per-sample rotation is nearest, and the batched one is bilinear
+    for angle, flip_v, flip_h in [(72, 0, 1), (144, 1, 1)]:
+        difference, agreement = compare(angle, flip_v, flip_h)
+        assert difference.mean().item() < 0.05
+        assert agreement > 0.98
+
+def test_shard_frames():
+    # the frames of the shards are resized before the augmentations (here to
+    # half of the size, keeping the aspect ratio), and only the interpolations
+    # differ from the augmentations of the original frames
+    image, label = fixed_frame(192, 256)
+    stored = Compose([ToTensor(n=1), Resize(size=[96, 128], n=1)])(
+        {'image0': image.copy(), 'image1': label.copy()})
+    stored_image = (255*stored['image0']).round().to(torch.uint8).permute(1, 2, 0).numpy()
+    stored_label = stored['image1'].permute(1, 2, 0).numpy()
+    for m in range(1, 5):
+        random.seed(m)
+        out_ref = recipe_transform(m, *SIZE, label_n=1)(
+            {'image0': image.copy(), 'image1': label.copy()})
+        random.seed(m)
+        out = recipe_transform(m, *SIZE, label_n=1, source_scale=[0.5, 0.5])(
+            {'image0': stored_image.copy(), 'image1': stored_label.copy()})
+        assert (out['image0']-out_ref['image0']).abs().mean().item() < 0.1
+        assert (out['image1'] == out_ref['image1']).double().mean().item() > 0.98
+
+
+if __name__ == '__main__':
+    test_resize_and_flips()
+    test_rotation()
+    test_shard_frames()
+    print('ok')
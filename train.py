@@ -41,11 +41,52 @@ Testing models: If you only want to test one or more models, just set
 'test_models = True', and specify the directory where the models to be tested
 are as a string in the variable 'test_models_dir'. If other options are also
 chosen, the test will take place in the and, after the other options finish.
+The frames of 'val_image_dir' are decoded once, and the checkpoints are
+evaluated in 'test_models_processes' processes, with the results ranked by
+Dice score in 'sweep.csv' (the same of 'python sweep.py', see 'sweep.py').
 
 Loading and Testing One Model: if you want to test a model before continue a
 training, or just wants to load and test one model, choose 'load_model = True'.
 This will test the model chekpoint_dir stored in the 'root_folder'.
 
+Distributed Training: to train with many processes (in one or more hosts,
+with the gloo backend), launch this file with 'python ddp.py --nproc 4 train.
+py' (see 'ddp.py'). Each process trains with a shard of the datasets, and only
+the first one saves the checkpoints, the 'dictionary.csv' and the images.
+
+Timing and Profiling: with 'record_timing = True', the time of each stage of
+the epoch (waiting for the loader, forward, backward, optimizer, each
+evaluation sink and checkpointing) and the peak memory are appended to
+'timing.csv', next to 'dictionary.csv' (see 'utils.StageTimer'). To see what
+happens inside the stages, set 'profile_epoch' to trace 'profile_steps' steps
+of that epoch with 'torch.profiler', saved in 'trace-<epoch>.json'.
+
+Evaluation Schedule: the validation and test sets are evaluated without
+random transforms. With 'full_eval_every = K', the whole sets are evaluated
+every K epochs (and in the last one), and in the other epochs only a fixed
+subset with 'eval_fraction' of the frames of each directory, with the 95%
+confidence intervals of the metrics printed and saved in 'evaluation.csv'
+(the best checkpoints are chosen only by the full evaluations).
+
+Precision: 'precision' selects the dtype of the forward passes in the
+training and in the evaluations ('fp32', 'bf16' or 'fp16', see 'utils.
+Precision'), with 'auto' being 'fp16' in CUDA and 'bf16' in CPU. The loss is
+scaled with a 'GradScaler' only with 'fp16'.
+
+Compiled Mode: with 'compile_model = True', the forward (and backward) of the
+model, the loss and the optimizer step are compiled by 'torch.compile' in
+their first call, with the model and the images in the channels_last layout
+(see 'utils.CompiledMode'). The first steps, which compile them, are recorded
+as the 'compile' stage in 'timing.csv' (apart from the steady-state steps),
+and if a compilation fails, that part runs in eager mode.
+
+Resuming: every 'checkpoint_every' optimizer steps (and at the end of each
+epoch), the whole training state is saved in 'last_checkpoint.pth.tar' in the
+'save_results_dir' (model, optimizer, scheduler, GradScaler, random generators,
+the epoch and batch, and the metrics of 'dictionary.csv'). With 'resume = True',
+an interrupted training (e.g. a Colab disconnection) continues from the batch
+where it stopped, just running this file again (no other option is needed).
+
 
 Find more on the GitHub Repository:
 https://github.com/MarlonGarcia/attacking-white-blood-cells
@@ -66,6 +107,7 @@ import torchvision.transforms.functional as tf
 import numpy as np
 import pandas as pd
 import time
+import contextlib
 # If running on Colabs, mounting drive
 run_on_colabs = True
 if run_on_colabs:
@@ -94,6 +136,8 @@ from model import *
 from utils import *
 from model import *
 from utils import *
+from ddp import setup, cleanup, is_main_process, unwrap, convert_batchnorm
+from ddp import average_gradients
 
 
 #%% Defining Parameters and Path
@@ -116,8 +160,34 @@ load_model = True       # 'true' to load a model and test it, or use it
 save_model = True       # 'true' to save model trained after epoches
 continue_training = True # 'true' to load and continue training a model
 save_images = True      # saving example from predicted and original
-test_models = False     # true: test all the models saved in 'save_results_dir'
+save_images_every = 1   # epochs between saving image examples
+save_images_batches = 4 # number of validation batches saved as images
+save_scores = False     # saving per-image scores in 'scores-*.csv' files
+test_models = False     # true: test all the models saved in 'test_models_dir'
+test_models_processes = 1 # checkpoints tested in parallel (the processes import
+                          # this file again, so prefer 'python sweep.py' for >1)
 last_epoch = 6        # when 'continue_training', it has to be the last epoch
+keep_last_checkpoints = 3 # number of last checkpoints kept (None keeps all)
+keep_best_checkpoints = 3 # number of best checkpoints kept (by valid. dice)
+cache_bytes = 0         # bytes of decoded frames kept in memory (e.g. 8*1024**3)
+cache_dir = None        # folder of the frame cache (None: '/dev/shm', removed at exit)
+batched_augmentation = True # augment collated batches (frames of equal size)
+manifest_file = os.path.join(root_folder, 'dsad_manifest.json') # cached listing (dirs changed are listed again)
+label_mode = 'index'    # 'index' (1 byte per pixel) or 'onehot' labels
+checkpointing = None    # gradient checkpointing: None, 'stage' or 'block'
+accumulation_steps = 1  # micro-batches (of 'batch_size') per optimizer step
+accumulation_bn = True  # BN momentum per micro-batch (see 'accumulation_momentum')
+record_timing = True    # time of each stage per epoch, saved in 'timing.csv'
+profile_epoch = None    # epoch traced with 'torch.profiler' (None disables)
+profile_steps = 3       # micro-batches in the trace (after 2 warm-up ones)
+shards_manifest = None  # 'manifest.json' of 'shards.py' (None reads the PNGs)
+resume = True           # continue from 'last_checkpoint.pth.tar', if it exists
+checkpoint_every = 200  # optimizer steps between saves of 'last_checkpoint.pth.tar'
+full_eval_every = 1     # epochs between evaluations of the whole valid./test sets
+eval_fraction = 0.1     # fraction of each directory evaluated in other epochs
+precision = 'auto'      # 'fp32', 'bf16', 'fp16' or 'auto' (see 'utils.Precision')
+compile_model = False   # torch.compile of the model, loss and optimizer step
+channels_last = None    # channels_last layout (None: only with 'compile_model')
 
 # defining the paths to datasets
 train_image_dir = ['/content/gdrive/Shareddrives/Lab. de Óptica Biomédica/Datasets/DSAD/liver/01',
@@ -161,51 +231,114 @@ val_image_dir = ['/content/gdrive/Shareddrives/Lab. de Óptica Biomédica/Data
 #%% Training Function
 
 # defining the training function
-def train_fn(loader, model, optimizer, loss_fn, scaler, schedule, epoch, last_lr):
-    loop = tqdm(loader, desc='Epoch '+str(epoch+1))
-
-    for batch_idx, (dictionary) in enumerate(loop):
+def train_fn(loader, model, optimizer, loss_fn, scaler, schedule, epoch, last_lr,
+             accumulation_steps=1, timer=None, profiler=None, start_batch=0,
+             step_fn=None, precision=None, compiled=None):
+    loop = tqdm(loader, desc='Epoch '+str(epoch+1), disable=not is_main_process())
+    # the time of each stage is recorded by 'timer' (a 'StageTimer'), and
+    # 'profiler' (a 'torch.profiler.profile', already started) steps with
+    # each micro-batch. 'step_fn(batches)' is called after each optimizer
+    # step, with the number of batches trained in the epoch (counting the
+    # 'start_batch' batches skipped by the loader when resuming an epoch).
+    # The forward runs with the 'Precision' 'precision', and the loss is
+    # scaled by 'scaler' if it is not 'None' (see 'Precision.scaler'). With a
+    # 'CompiledMode' 'compiled', the images are in its layout, and the stages
+    # of the steps until its functions are compiled are recorded as 'compile'
+    if timer is None:
+        timer = StageTimer(enabled=False)
+    if precision is None:
+        precision = Precision(device=device)
+    if compiled is None:
+        compiled = CompiledMode(enabled=False)
+    # training mode (for the batch normalizations and the gradient checkpoints)
+    model.train()
+    # each batch is a micro-batch, and the optimizer is stepped once every
+    # 'accumulation_steps' micro-batches (the effective batch size is
+    # 'batch_size*accumulation_steps')
+    optimizer.zero_grad()
+    pending, steps = 0, 0
+
+    for batch_idx, (dictionary) in enumerate(timer.iterate(loop, 'data'), start_batch):
         image, label = dictionary
-        x, y = dictionary[image], dictionary[label]
-        x, y = x.to(device=device), y.to(device=device)
-        y = y.float()
-        # forward
-        with torch.cuda.amp.autocast() if torch.cuda.is_available() else torch.autocast('cpu'):
-            pred = model(x)
-            # cropping 'pred' for when the model changes the image dimensions
-            y = tf.center_crop(y, pred.shape[2:])
-            # calculating loss
-            loss = loss_fn(pred, y)
-
-        # backward
-        optimizer.zero_grad()
-        if device == 'cuda':
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scale = scaler.get_scale()
-            scaler.update()
-        # if device='cpu', we cannot use 'scaler=torch.cuda.amp.GradScaler()':
-        else:
-            loss.backward()
-            optimizer.step()
+        with timer.stage('transfer'):
+            x, y = dictionary[image], dictionary[label]
+            x, y = compiled.inputs(x.to(device=device)), y.to(device=device)
+        compiling = compiled.compiling
+        # with 'DistributedDataParallel', the gradients are only averaged
+        # between the processes in the backward of the last micro-batch of
+        # each step
+        sync = pending+1 == accumulation_steps
+        with model.no_sync() if not sync and hasattr(model, 'no_sync') else contextlib.nullcontext():
+            # forward
+            with timer.stage('compile' if compiling else 'forward'), precision.autocast():
+                pred = model(x)
+                # expanding 'index' labels to one-hot only here, on the device
+                y = expand_labels(y, pred.shape[1])
+                # cropping 'pred' for when the model changes the image dimensions
+                y = tf.center_crop(y, pred.shape[2:])
+                # calculating loss
+                loss = loss_fn(pred, y)
+
+            # backward (the gradients of 'accumulation_steps' micro-batches are
+            # summed, so the loss is divided to give their mean)
+            with timer.stage('compile' if compiling else 'backward'):
+                if scaler is not None:
+                    scaler.scale(loss/accumulation_steps).backward()
+                else:
+                    (loss/accumulation_steps).backward()
+        pending += 1
+        if pending == accumulation_steps:
+            with timer.stage('compile' if compiling else 'optimizer'):
+                steps += optimizer_step(optimizer, scaler)
+            pending = 0
+            if step_fn is not None:
+                step_fn(batch_idx+1)
         # freeing space by deliting variables
         loss_item = loss.item()
         del loss, pred, y, x, image, label, dictionary
         # updating tgdm loop
         loop.set_postfix(loss=loss_item)
+        if profiler is not None:
+            profiler.step()
+    # the last micro-batches of the epoch are also used, with their gradients
+    # rescaled to the mean of only 'pending' micro-batches (and averaged
+    # between the processes here, since their backwards did not sync)
+    if pending:
+        with timer.stage('optimizer'):
+            if hasattr(model, 'no_sync'):
+                average_gradients(model)
+            for group in optimizer.param_groups:
+                for p in group['params']:
+                    if p.grad is not None:
+                        p.grad.mul_(accumulation_steps/pending)
+            steps += optimizer_step(optimizer, scaler)
+        # (it is a step as the others, also counted by 'step_fn')
+        if step_fn is not None:
+            step_fn(batch_idx+1)
     # deliting loader and loop
     del loader, loop
-    # scheduling the learning rate and saving its last value
-    if scaler:
-        if scale >= scaler.get_scale():
-            schedule.step()
-            last_lr = schedule.get_last_lr()
-    else:
+    # scheduling the learning rate and saving its last value (only if the
+    # optimizer was stepped, since 'scaler' skips steps with 'inf' gradients)
+    if schedule is not None and steps > 0:
         schedule.step()
         last_lr = schedule.get_last_lr()
 
     return loss_item, last_lr
 
+# updating the weights with the accumulated gradients, returning 1 if the step
+# was taken, or 0 if 'scaler' skipped it (when the gradients have 'inf'/'nan')
+def optimizer_step(optimizer, scaler):
+    if scaler is not None:
+        scale = scaler.get_scale()
+        scaler.step(optimizer)
+        scaler.update()
+        taken = int(scaler.get_scale() >= scale)
+    else:
+        optimizer.step()
+        taken = 1
+    optimizer.zero_grad()
+    return taken
+
 
 class CustomCrossEntropyLoss(nn.Module):
     def __init__(self):
@@ -229,8 +362,24 @@ class CustomCrossEntropyLoss(nn.Module):
 
 #%% Defining The main() Function
 def main():
-        # defining the model and casting to device
+    # starting the process group, if launched with more processes by 'ddp.py'
+    # (or 'torchrun'), each one with a shard of the datasets
+    rank, world_size = setup()
+    if device == 'cuda' and world_size > 1:
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    # defining the model and casting to device
     model = UResNet34(in_channels=3, num_classes=2).to(device)
+    # recomputing activations in the backward, to save memory (deeper models)
+    model.set_checkpointing(checkpointing)
+    # with gradient accumulation, the BN running statistics are updated once
+    # per micro-batch, so the momentum is reduced to keep the same decay per
+    # optimizer step
+    if accumulation_bn and accumulation_steps > 1:
+        accumulation_momentum(model, accumulation_steps)
+    # with 'compile_model', the model, the loss and the optimizer step are
+    # compiled in their first call (in eager mode if it fails), in channels_last
+    compiled = CompiledMode(compile_model, channels_last)
+    compiled.model(model)
     # if binary classification, use BCEWithLogitsLoss and do not use logistic
     # function inside the model (this loss has logistic already).
     # loss_fn = nn.BCEWithLogitsLoss()
@@ -240,6 +389,7 @@ def main():
     loss_fn = nn.L1Loss()
     # loss_fn = nn.CrossEntropyLoss()
     # loss_fn = CustomCrossEntropyLoss()
+    compiled.loss(loss_fn)
     # pass 'lr=learning_rate' to Adam optim. to consider it, but it ahs its own
     # way to schedule learning rate, so here it is not considered.
     optimizer = optim.Adam(model.parameters())
@@ -248,6 +398,7 @@ def main():
     schedule = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.9)
     # if schedule is not used, please refer it as 'None'
     # schedule = None
+    compiled.optimizer(optimizer)
 
     # loading dataLoaders
     train_loader, test_loader, valid_loader = get_loaders(
@@ -261,9 +412,20 @@ def main():
         pin_memory=pin_memory,
         val_image_dir=val_image_dir,
         clip_valid=clip_valid,
-        clip_train=clip_train
+        clip_train=clip_train,
+        cache_bytes=cache_bytes,
+        cache_dir=cache_dir,
+        batched_augmentation=batched_augmentation,
+        manifest=manifest_file,
+        label_mode=label_mode,
+        distributed=world_size > 1,
+        shards=shards_manifest
     )
 
+    # dtype of the forward passes in the training and in the evaluations (and
+    # if the loss is scaled, only with 'fp16')
+    precision_policy = Precision(precision, device)
+
     # if this program is just to load and test a model, next it loads a model
     if load_model:
         # loading checkpoint
@@ -274,22 +436,53 @@ def main():
         else:
             load_checkpoint(torch.load(chekpoint_dir,
                                        map_location=torch.device('cpu')), model)
-        check_accuracy(valid_loader, model, loss_fn, device=device)
-
-    if not load_model or continue_training:
+        check_accuracy(valid_loader, model, loss_fn, device=device,
+                       precision=precision_policy)
+
+    # in distributed training, the BNs use the statistics of the batches of
+    # all processes, and the gradients are averaged by DDP ('model' is only
+    # used unwrapped to evaluate and save, so the checkpoints are the same)
+    if world_size > 1:
+        model = nn.parallel.DistributedDataParallel(convert_batchnorm(model))
+
+    # the full state of an interrupted training (saved every 'checkpoint_every'
+    # optimizer steps, and at the end of each epoch) is used if it exists
+    resume_file = os.path.join(save_results_dir, 'last_checkpoint.pth.tar')
+    resume_state = None
+    if resume and os.path.isfile(resume_file):
+        resume_state = torch.load(resume_file, map_location=torch.device('cpu'))
+
+    if not load_model or continue_training or resume_state is not None:
         # changing folder to save dictionary
         os.chdir(save_results_dir)
+        # the 'GradScaler' is only used with 'fp16' (see 'Precision.scaler')
+        scaler = precision_policy.scaler()
+        # epoch and batch to start, and optimizer steps already taken
+        first_epoch, start_batch, steps = last_epoch, 0, 0
+        # if there is a 'last_checkpoint.pth.tar', we continue from the batch
+        # where the training stopped (with the epoch and the metric history)
+        if resume_state is not None:
+            print('\n- Resuming Training...\n')
+            restore_training_state(resume_state, unwrap(model), optimizer,
+                                   schedule, scaler, train_loader)
+            dictionary = resume_state['dictionary']
+            last_time = resume_state['last_time']
+            first_epoch = resume_state['epoch']
+            start_batch = resume_state['batches']
+            steps = resume_state['steps']
+            print('- Epoch', first_epoch+1, 'from batch', start_batch)
+            del resume_state
         # if 'continue_training==True', we load the model and continue training
-        if continue_training:
+        elif continue_training:
             print('\n- Continue Training...\n')
             start = time.time()
             if device == 'cuda':
-                load_checkpoint(torch.load(chekpoint_dir), model,
+                load_checkpoint(torch.load(chekpoint_dir), unwrap(model),
                                 optimizer=optimizer)
             else:
                 load_checkpoint(torch.load(chekpoint_dir,
                                            map_location=torch.device('cpu')),
-                                           model, optimizer=optimizer)
+                                           unwrap(model), optimizer=optimizer)
             # reading the csv 'dictionary.csv' as a dictionary
             df = pd.read_csv('dictionary.csv')
             temp = df.to_dict('split')
@@ -310,8 +503,14 @@ def main():
             start = time.time()
             # opening a 'loss' and 'acc' list, to save the data
             dictionary = {'acc-valid':[], 'acc-test':[], 'loss':[], 'dice score-valid':[], 'dice score-test':[], 'time taken':[]}
-            acc_item_valid, loss_item, dice_score_valid = check_accuracy(valid_loader, model, loss_fn, device=device, title='Validating')
-            acc_item_test, _, dice_score_test = check_accuracy(test_loader, model, loss_fn, device=device, title='Testing')
+            metric = MetricSink(loss_fn)
+            evaluate({'Validating': valid_loader, 'Testing': test_loader},
+                     unwrap(model), [metric], device=device,
+                     precision=precision_policy)
+            acc_item_valid, loss_item, dice_score_valid, _ = metric.results['Validating']
+            acc_item_test, _, dice_score_test, _ = metric.results['Testing']
+            print_metrics('Validating', acc_item_valid, dice_score_valid)
+            print_metrics('Testing', acc_item_test, dice_score_test)
             print('\n')
             dictionary['acc-valid'].append(acc_item_valid)
             dictionary['acc-test'].append(acc_item_test)
@@ -324,67 +523,149 @@ def main():
             last_time = (time.time()-start)/60
             dictionary['time taken'].append(last_time)
 
-        # with 'cpu' we can't use 'torch.cuda.amp.GradScaler()'
-        if device == 'cuda':
-            scaler = torch.cuda.amp.GradScaler()
-        else:
-            scaler = None
+        # the loaded optimizer states have float learning rates again
+        compiled.optimizer(optimizer)
         # to use 'last_lr' in 'train_fn', we have to define it first
         last_lr = schedule.get_last_lr()
+        # only the first process saves checkpoints, images and the results
+        main_process = is_main_process()
         # begining image printing
-        fig, ax = plt.subplots()
+        if main_process:
+            fig, ax = plt.subplots()
+        # checkpoints are saved in background, keeping only the last and best
+        if save_model and main_process:
+            checkpoint_writer = CheckpointWriter(save_results_dir,
+                                                 keep_last=keep_last_checkpoints,
+                                                 keep_best=keep_best_checkpoints)
+            # checkpoints of the previous training also count for the policy
+            for n in range(1, min(first_epoch+1, len(dictionary['dice score-valid']))):
+                if os.path.isfile(os.path.join(save_results_dir, 'my_checkpoint'+str(n)+'.pth.tar')):
+                    checkpoint_writer.register('my_checkpoint'+str(n)+'.pth.tar',
+                                               dictionary['dice score-valid'][n])
+        # image examples are encoded and written in background threads
+        image_writer = ImageWriter()
+        # recording the time of each stage (data loading, forward, backward,
+        # optimizer, evaluation, checkpointing), and the peak memory
+        timer = StageTimer(device, enabled=record_timing)
+        # the whole validation and test sets are evaluated every 'full_eval_
+        # every' epochs, and a fixed subset of them in the other epochs
+        eval_schedule = EvaluationSchedule({'Validating': valid_loader,
+                                            'Testing': test_loader},
+                                           full_every=full_eval_every,
+                                           fraction=eval_fraction)
         # Criating a new start time (we have to sum this to 'last_time')
         start = time.time()
 
+        # saving the full training state in 'last_checkpoint.pth.tar' (it is
+        # overwritten, and is not in the policy of 'keep_last_checkpoints')
+        def save_training_state(epoch, batches):
+            if not (save_model and main_process):
+                return
+            state = training_state(unwrap(model), optimizer, schedule, scaler,
+                                   train_loader, epoch=epoch, batches=batches,
+                                   steps=steps, dictionary=dictionary,
+                                   last_lr=last_lr,
+                                   last_time=(time.time()-start)/60+last_time)
+            with timer.stage('checkpoint'):
+                checkpoint_writer.save(state, 'last_checkpoint.pth.tar', retain=False)
+        # counting the optimizer steps, to save every 'checkpoint_every'
+        def on_step(epoch, batches):
+            nonlocal steps
+            steps += 1
+            if checkpoint_every and steps % checkpoint_every == 0:
+                save_training_state(epoch, batches)
+
         # running epochs
-        for epoch in range(last_epoch, num_epochs):
+        for epoch in range(first_epoch, num_epochs):
+            # shuffling the training dataset differently in each epoch (and
+            # skipping the batches already trained, when resuming an epoch)
+            epoch_batch = start_batch if epoch == first_epoch else 0
+            set_loader_position(train_loader, epoch, epoch_batch)
+            # tracing some steps with 'torch.profiler' in 'profile_epoch'
+            profiler = None
+            if profile_epoch == epoch+1 and main_process:
+                profiler = make_profiler(os.path.join(save_results_dir,
+                                                      'trace-'+str(epoch+1)+'.json'),
+                                         steps=profile_steps, device=device)
             # calling training function
-            loss_item, last_lr = train_fn(train_loader, model, optimizer,
-                                          loss_fn, scaler, schedule, epoch,
-                                          last_lr)
+            with profiler if profiler is not None else contextlib.nullcontext():
+                loss_item, last_lr = train_fn(train_loader, model, optimizer,
+                                              loss_fn, scaler, schedule, epoch,
+                                              last_lr, accumulation_steps,
+                                              timer=timer, profiler=profiler,
+                                              precision=precision_policy,
+                                              compiled=compiled,
+                                              start_batch=epoch_batch,
+                                              step_fn=lambda batches: on_step(epoch, batches))
             # appending resulted loss from training
             dictionary['loss'].append(loss_item)
-            # saveing model
-            if save_model and epoch >= start_save -1:
-                # changing folder to save dictionary
-                os.chdir(save_results_dir)
-                checkpoint = {
-                    'state_dict': model.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                }
-                save_checkpoint(checkpoint, filename='my_checkpoint'+str(epoch+1)+'.pth.tar')
-            # check accuracy
-            print('\nValidating:')
-            acc_item_valid, _, dice_score_valid = check_accuracy(valid_loader, model, loss_fn, device=device)
-            print('Testing:')
-            acc_item_test, _, dice_score_test = check_accuracy(test_loader, model, loss_fn, device=device)
+            # check accuracy and save image examples in a single pass (images
+            # are saved only every 'save_images_every' epochs)
+            full_eval = eval_schedule.is_full(epoch, last=epoch+1 == num_epochs)
+            sinks = [MetricSink(loss_fn)]
+            if not full_eval:
+                sinks.append(eval_schedule.interval_sink())
+            if save_images and main_process and (epoch+1) % save_images_every == 0:
+                # criating directory, if it does not exist
+                os.makedirs(os.path.join(root_folder,'saved_images'), exist_ok=True)
+                sinks.append(ImageSink(os.path.join(root_folder,'saved_images'),
+                                       loaders=['Validating'],
+                                       max_batches=save_images_batches,
+                                       writer=image_writer))
+            if save_scores:
+                sinks.append(ScoreSink(os.path.join(save_results_dir,
+                                                    'scores-{name}-'+str(epoch+1)+'.csv')))
+            evaluate(eval_schedule.loaders(epoch, last=epoch+1 == num_epochs),
+                     unwrap(model), sinks, device=device, timer=timer,
+                     precision=precision_policy)
+            intervals = None if full_eval else sinks[1].intervals
+            acc_item_valid, _, dice_score_valid, _ = sinks[0].results['Validating']
+            acc_item_test, _, dice_score_test, _ = sinks[0].results['Testing']
+            print_metrics('Validating', acc_item_valid, dice_score_valid,
+                          intervals and intervals['Validating'])
+            print_metrics('Testing', acc_item_test, dice_score_test,
+                          intervals and intervals['Testing'])
             stop = time.time()
             dictionary['acc-valid'].append(acc_item_valid)
             dictionary['acc-test'].append(acc_item_test)
             dictionary['dice score-valid'].append(dice_score_valid)
             dictionary['dice score-test'].append(dice_score_test)
             dictionary['time taken'].append((stop-start)/60+last_time)
-            # saving some image examples to specified folder
-            if save_images:
-                # criating directory, if it does not exist
-                os.chdir(root_folder)
-                try: os.mkdir('saved_images')
-                except: pass
-                save_predictions_as_imgs(
-                    valid_loader, model, folder=os.path.join(root_folder,'saved_images'),
-                    device=device
-                )
+            # saveing model (written in background, after the validation, to
+            # keep the best checkpoints by validation dice score, only of the
+            # full evaluations)
+            if save_model and main_process and epoch >= start_save -1:
+                checkpoint = {
+                    'state_dict': unwrap(model).state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                }
+                with timer.stage('checkpoint'):
+                    checkpoint_writer.save(checkpoint, 'my_checkpoint'+str(epoch+1)+'.pth.tar',
+                                           score=dice_score_valid if full_eval else None)
             # saving dictionary to a csv file
-            if save_model:
+            if save_model and main_process:
                 # changing folder to save dictionary
                 os.chdir(save_results_dir)
                 df = pd.DataFrame(dictionary, columns = ['acc-valid', 'acc-test',
                                                          'loss', 'dice score-valid',
                                                          'dice score-test', 'time taken'])
                 df.to_csv('dictionary.csv', index = False)
+                # and the kind of evaluation of each epoch, with the intervals
+                eval_schedule.to_csv(os.path.join(save_results_dir, 'evaluation.csv'),
+                                     epoch+1, sinks[0].results, intervals)
+            # the state to continue from the next epoch
+            save_training_state(epoch+1, 0)
+            # saving the time of each stage in this epoch (next to the csv)
+            if record_timing and main_process:
+                timer.to_csv(os.path.join(save_results_dir, 'timing.csv'), epoch+1)
+            else:
+                timer.reset()
 
-            print('\n- Time taken:',round((stop-start)/60+last_time,3),'min')
-            print('\n- Last Learning rate:', round(last_lr[0],8),'\n\n')
+            if main_process:
+                print('\n- Time taken:',round((stop-start)/60+last_time,3),'min')
+                if compiled.enabled and epoch == first_epoch:
+                    print('\n- Compiled mode:', compiled.report())
+                print('\n- Last Learning rate:', round(float(last_lr[0]),8),'\n\n')
             # deleting variables for freeing space
             del dice_score_test, dice_score_valid, acc_item_test, acc_item_valid,
             loss_item, stop
@@ -392,7 +673,9 @@ def main():
             except: pass
 
             # continue image printing
-            if epoch == last_epoch:
+            if not main_process:
+                continue
+            if epoch == first_epoch:
                 ax.plot(np.asarray(dictionary['acc-valid']), 'C1', label ='accuracy-validation')
                 ax.plot(np.asarray(dictionary['acc-test']), 'C2', label ='accuracy-test')
                 ax.plot(np.asarray(dictionary['dice score-valid']), 'C4', label = 'dice score-validation')
@@ -411,50 +694,36 @@ def main():
             plt.show()
             plt.pause(0.5)
 
+        # waiting the last checkpoint to be written
+        if save_model and main_process:
+            checkpoint_writer.close()
+        image_writer.close()
+    cleanup()
+
 
 if __name__ == '__main__':
     main()
 
 #%% Defining test function
 
-def testing_models():
-
-    model = UResNet50(in_channels=3, num_classes=2).to(device)
-    loss_fn = nn.CrossEntropyLoss()
-    optimizer = optim.SGD(model.parameters(), lr=learning_rate, momentum=0.9)
-    schedule = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.8)
-    # getting the 'valid_loader'
-    e, train_loader, valid_loader = get_loaders(
-        train_image_dir=train_image_dir,
-        # csv_file_train=csv_file_train,
-        valid_percent=valid_percent,
-        test_percent=test_percent,
-        batch_size=batch_size,
-        image_height=image_height,
-        image_width=image_width,
-        num_workers=num_workers,
-        pin_memory=pin_memory,
-        clip_valid=clip_valid,
-        clip_train=clip_train
-    )
-
-    loss_fn = nn.CrossEntropyLoss()
-
-    os.chdir(test_models_dir)
-    for file in os.listdir(test_models_dir):
-        print('\n\n')
-        if 'my_checkpoint' in file:
-            # checking accuracy
-            if device == 'cuda':
-                load_checkpoint(torch.load(file), model)
-            else:
-                load_checkpoint(torch.load(file,
-                                           map_location=torch.device('cpu')),
-                                           model)
-            print('\n- Model:', file)
-            acc, loss,dice = check_accuracy(valid_loader, model, loss_fn, device=device)
-            # acc_item_test, _, dice_score_test = check_accuracy(test_loader, model, loss_fn, device=device)
-            print('\n- Acc:',round(acc,3),'; loss:',round(loss,3),'; dice:',round(dice,3))
-
-# if (__name__ == '__main__') and (test_models == True):
-#     testing_models()
+# evaluating all the checkpoints in 'test_models_dir' (in the frames of
+# 'val_image_dir', decoded only once), with 'test_models_processes' processes,
+# and saving the ranked results in 'sweep.csv' (see 'sweep.py')
+def testing_models(model_name='UResNet34'):
+    import sweep
+    checkpoints = sweep.list_checkpoints([test_models_dir])
+    if shards_manifest:
+        images, labels = sweep.load_shard_frames(shards_manifest, 'valid')
+    else:
+        images, labels = sweep.load_frames(val_image_dir, [image_height, image_width],
+                                           workers=num_workers)
+    table = sweep.sweep(checkpoints, images, labels, model_name, num_classes=2,
+                        processes=test_models_processes, batch_size=batch_size,
+                        device=device, precision=precision)
+    table.to_csv(os.path.join(test_models_dir, 'sweep.csv'), index=False,
+                 float_format='%.4f')
+    print('\n'+table.drop(columns='path').to_string(index=False))
+    return table
+
+if (__name__ == '__main__') and (test_models == True):
+    testing_models()
@@ -3,15 +3,32 @@ This file is used together with the 'train.py' file to help in the training and
 testing process with util functions.
 '''
 import torch
-from dataset import DresdenDataset
-from torch.utils.data import DataLoader, random_split
+from dataset import DresdenDataset, DresdenIndex, AugmentedDresdenDataset, FrameCache
+from dataset import ShardIndex, ShardDataset, ShardStream
+from torch.utils.data import DataLoader, Sampler, random_split, default_collate
+import torch.distributed as dist
+import ddp
 import torchvision.transforms.functional as tf
 from torchvision.transforms import Compose
 from torchvision.utils import save_image
 from tqdm import tqdm
+import os
+import math
+import time
+import statistics
+import queue
+import threading
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 import random
-from torchmetrics import Dice
+import numpy as np
+import pandas as pd
 
+# mean and std of the Dresden Dataset images (used to normalize them)
+DRESDEN_MEAN = [0.4338, 0.31936, 0.312387]
+DRESDEN_STD = [0.1904, 0.15638, 0.15657]
 
 # The next functions are functional transforms, used to apply functions in a way
 # controled by the user. So we can apply, for example, in the data image and in
@@ -95,15 +112,26 @@ class Resize(object):
 
     size: 'list' (input)
         input list with size (e.g. '[400,200]');
+    n: int (input)
+        if given, only the first 'n' images are resized with bilinear inter-
+        polation, the rest (labels) are resized with nearest interpolation;
     images: 'dictionary' (input) (output)
         dictionary with images.
     '''
-    def __init__(self, size):
+    def __init__(self, size, n=None):
         self.size = size
+        self.n = n
 
     def __call__(self, images):
-        for image in images:
-            images[image] = tf.resize(images[image], self.size)
+        for i, image in enumerate(images):
+            # frames already in the size (e.g. from the shards) are kept
+            if list(images[image].shape[-2:]) == list(self.size):
+                continue
+            if self.n is not None and i >= self.n:
+                images[image] = tf.resize(images[image], self.size,
+                                          interpolation=tf.InterpolationMode.NEAREST)
+            else:
+                images[image] = tf.resize(images[image], self.size)
 
         return images
 
@@ -191,12 +219,321 @@ class Affine(object):
         return images
 
 
+#%% Batched Transforms
+
+# The next classes apply the same augmentations of the transforms above, but
+# to a whole collated batch at once. For each sample, one affine matrix is
+# built combining affine, rotation, resize and flips, and all the samples are
+# then resampled with a single 'grid_sample' call (bilinear for images and
+# nearest for labels). The per-sample classes above are kept as reference.
+
+class AugmentRecipe(object):
+    '''Parameters of one augmentation pipeline, to be used in 'BatchAugment'
+
+    It reproduces the pipeline 'Affine' -> 'Rotate' -> 'Resize' ->
+    'FlipVertical' -> 'FlipHorizontal', with the same random parameters.
+
+    rotate_limit: list (input)
+        lower and upper angles to rotate ('None' to not rotate);
+    rotate_p: float (input)
+        probability to rotate;
+    affine_size: list (input)
+        maximum higher and width to translate in the affine ('None' for no
+        affine);
+    affine_scale: float (input)
+        scale to perform affine (between 0 and 1.0);
+    affine_p: float (input)
+        probability to perform the affine;
+    flip_v: float (input)
+        probability to flip vertically;
+    flip_h: float (input)
+        probability to flip horizontally.
+    '''
+    def __init__(self, rotate_limit=None, rotate_p=1.0, affine_size=None,
+                 affine_scale=0.0, affine_p=0.5, flip_v=0.5, flip_h=0.5):
+        self.rotate_limit = rotate_limit
+        self.rotate_p = rotate_p if rotate_limit else 0.0
+        self.affine_size = affine_size if affine_size else [0, 0]
+        self.affine_scale = affine_scale
+        self.affine_p = affine_p if affine_size else 0.0
+        self.flip_v = flip_v
+        self.flip_h = flip_h
+
+
+# maximum translations of the affine of 'get_loaders', in pixels of the input
+# frames. For frames already resized (e.g. from the shards), 'source_scale' is
+# their '[height, width]' ratio to the original size, and the first entry
+# translates along the width (see 'Affine'), so it is scaled by the width ratio
+def affine_size(image_height, image_width, source_scale=(1.0, 1.0)):
+    scale_height, scale_width = source_scale
+    return [0.5*image_height*scale_width, 0.5*image_width*scale_height]
+
+def augmentation_recipe(m, image_height, image_width, source_scale=(1.0, 1.0)):
+    '''Return the 'AugmentRecipe' of the 'm'-th augmentation in 'get_loaders'
+
+    'm = 0' are the original images (only flips), 'm = 1' adds a rotation and
+    'm > 1' adds an affine and a rotation (see 'get_loaders'). The affine
+    translations are in pixels of the input frames, so for frames already
+    resized (e.g. from the shards) 'source_scale' is their '[height, width]'
+    ratio to the original size (see 'affine_size').
+    '''
+    if m == 0:
+        return AugmentRecipe()
+    if m < 2:
+        return AugmentRecipe(rotate_limit=[(m-1)*72, m*72], rotate_p=1.0)
+    return AugmentRecipe(rotate_limit=[(m-1)*72, m*72], rotate_p=1.0,
+                         affine_size=affine_size(image_height, image_width,
+                                                 source_scale),
+                         affine_scale=0.01*(m-1), affine_p=0.5)
+
+
+class BatchAugment(object):
+    '''Augment, resize and normalize a collated batch in a vectorized way
+
+    The batch is a dictionary like the ones of 'DresdenDataset', but with
+    batched tensors, and with a key 'recipe' with the index of the recipe to be
+    applied in each sample (all samples use recipe 0 if it is missing). Images
+    can be 'uint8' (they are scaled to [0.0,1.0]) or 'float' in [0.0,1.0].
+
+    recipes: list (input)
+        list of 'AugmentRecipe' (indexed by the 'recipe' key of the batch);
+    size: list (input)
+        output size (e.g. '[512,640]');
+    n: int (input)
+        number of images (the rest are labels, with nearest interpolation);
+    mean: list (input)
+        mean to normalize;
+    std: list (input)
+        stadard deviation to normalize;
+    antialias: bool (input)
+        low-pass the images before sampling when downscaling them.
+    '''
+    def __init__(self, recipes, size, n=1, mean=0.5, std=0.5, antialias=True):
+        self.recipes = recipes
+        self.size = size
+        self.n = n
+        self.mean = mean
+        self.std = std
+        self.antialias = antialias
+        # parameters of all the recipes, to be indexed per sample
+        limits = [r.rotate_limit if r.rotate_limit else [0, 0] for r in recipes]
+        self.rotate_low = torch.tensor([l[0] for l in limits], dtype=torch.float64)
+        self.rotate_high = torch.tensor([l[1] for l in limits], dtype=torch.float64)
+        self.rotate_p = torch.tensor([r.rotate_p for r in recipes], dtype=torch.float64)
+        self.affine_size = torch.tensor([r.affine_size for r in recipes], dtype=torch.float64)
+        self.affine_scale = torch.tensor([r.affine_scale for r in recipes], dtype=torch.float64)
+        self.affine_p = torch.tensor([r.affine_p for r in recipes], dtype=torch.float64)
+        self.flip_v = torch.tensor([r.flip_v for r in recipes], dtype=torch.float64)
+        self.flip_h = torch.tensor([r.flip_h for r in recipes], dtype=torch.float64)
+
+    def matrices(self, recipe, height, width, generator=None):
+        '''Return the '(N,2,3)' matrices for 'torch.nn.functional.affine_grid'
+
+        recipe: tensor (input)
+            recipe index of each sample;
+        height, width: int (input)
+            size of the input images.
+        '''
+        N = len(recipe)
+        rand = torch.rand(N, 9, dtype=torch.float64, generator=generator)
+        eye = torch.eye(3, dtype=torch.float64).repeat(N, 1, 1)
+        # affine: the angle, shear and translation are chosen as in 'Affine'
+        scale = self.affine_scale[recipe]
+        on = rand[:,0] < self.affine_p[recipe]
+        angle = torch.deg2rad(rand[:,1]*scale*360)
+        shear = torch.deg2rad(rand[:,2]*scale*360)
+        affine = eye.clone()
+        affine[:,0,0] = torch.cos(angle)
+        affine[:,0,1] = -torch.cos(angle)*torch.tan(shear)-torch.sin(angle)
+        affine[:,1,0] = torch.sin(angle)
+        affine[:,1,1] = -torch.sin(angle)*torch.tan(shear)+torch.cos(angle)
+        affine[:,:2,:2] *= (1-scale)[:,None,None]
+        # as in 'Affine', the first 'size' entry translates along the width
+        affine[:,0,2] = self.affine_size[recipe,0]*rand[:,3]*scale
+        affine[:,1,2] = self.affine_size[recipe,1]*rand[:,4]*scale
+        affine[~on] = eye[~on]
+        # rotation: integer angle in the limits, as in 'Rotate'
+        low, high = self.rotate_low[recipe], self.rotate_high[recipe]
+        angle = torch.floor(low+rand[:,5]*(high-low+1)).clamp(max=high)
+        angle = torch.deg2rad(-angle*(rand[:,6] < self.rotate_p[recipe]))
+        rotate = eye.clone()
+        rotate[:,0,0] = torch.cos(angle)
+        rotate[:,0,1] = -torch.sin(angle)
+        rotate[:,1,0] = torch.sin(angle)
+        rotate[:,1,1] = torch.cos(angle)
+        # resize and flips (in coordinates centered in the image)
+        final = eye.clone()
+        final[:,0,0] = self.size[1]/width
+        final[:,1,1] = self.size[0]/height
+        final[:,0,0] *= 1-2*(rand[:,7] < self.flip_h[recipe]).double()
+        final[:,1,1] *= 1-2*(rand[:,8] < self.flip_v[recipe]).double()
+        # 'grid_sample' needs the inverse (output to input), in [-1,1] units
+        inverse = torch.linalg.inv(final @ rotate @ affine)
+        output = torch.diag(torch.tensor([self.size[1]/2, self.size[0]/2, 1],
+                                         dtype=torch.float64))
+        source = torch.diag(torch.tensor([2/width, 2/height, 1],
+                                         dtype=torch.float64))
+        return (source @ inverse @ output)[:,:2,:]
+
+    def __call__(self, images):
+        keys = [key for key in images if key != 'recipe']
+        first = images[keys[0]]
+        N, _, height, width = first.shape
+        recipe = images.pop('recipe', None)
+        if recipe is None:
+            recipe = torch.zeros(N, dtype=torch.long)
+        theta = self.matrices(recipe.long().cpu(), height, width)
+        theta = theta.to(device=first.device, dtype=torch.float32)
+        grid = torch.nn.functional.affine_grid(theta, [N, 1]+list(self.size),
+                                               align_corners=False)
+        for i, key in enumerate(keys):
+            image = images[key]
+            if i < self.n:
+                if image.dtype == torch.uint8:
+                    image = image.float()/255
+                # low-pass filter, since 'grid_sample' only samples the pixels
+                if self.antialias and (height > self.size[0] or width > self.size[1]):
+                    image = torch.nn.functional.interpolate(
+                        image, size=list(self.size), mode='bilinear',
+                        align_corners=False, antialias=True)
+                image = torch.nn.functional.grid_sample(image, grid, mode='bilinear',
+                                                        padding_mode='zeros',
+                                                        align_corners=False)
+                images[key] = tf.normalize(image, self.mean, self.std)
+            else:
+                dtype = image.dtype
+                image = torch.nn.functional.grid_sample(image.float(), grid,
+                                                        mode='nearest',
+                                                        padding_mode='zeros',
+                                                        align_corners=False)
+                images[key] = image.to(dtype)
+
+        return images
+
+
+class BatchCollate(object):
+    '''Collate function that applies a 'BatchAugment' to the collated batch
+
+    augment: 'BatchAugment' (input)
+        batched transform to apply after collating the samples.
+    '''
+    def __init__(self, augment):
+        self.augment = augment
+
+    def __call__(self, samples):
+        return self.augment(default_collate(samples))
+
+
 #%% Util Functions to be Used During Training or Testing
 
-# saving checkpoints
+# saving checkpoints (in a temporary file renamed at the end, so an interrup-
+# ted save never leaves a broken checkpoint)
 def save_checkpoint(state, filename='my_checkpoint.pth.tar'):
     print('\n- Saving Checkpoint...')
-    torch.save(state, filename)
+    temp = filename+'.tmp'
+    torch.save(state, temp)
+    os.replace(temp, filename)
+
+# copying all tensors of a (nested) state to the cpu memory
+def state_to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: state_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(value) for value in state)
+    return state
+
+
+class CheckpointWriter(object):
+    '''Save checkpoints in a background thread, with a retention policy
+
+    'save' copies the state to the cpu memory in the calling thread (so the
+    training can continue changing the model), and the serialization and
+    writing are done in a worker thread, with 'save_checkpoint'. After each
+    write, only the last 'keep_last' checkpoints and the best 'keep_best' by
+    score (e.g. the validation Dice) are kept, the others are deleted.
+
+    folder: str (input)
+        folder to save the checkpoints;
+    keep_last: int (input)
+        number of most recent checkpoints to keep ('None' to keep all);
+    keep_best: int (input)
+        number of checkpoints with the higher scores to keep.
+    '''
+    def __init__(self, folder='.', keep_last=None, keep_best=0):
+        self.folder = folder
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        # list of [filename, score] of the checkpoints, from older to newer
+        # (changed by the worker and by 'register', always with 'lock')
+        self.history = []
+        self.lock = threading.Lock()
+        self.error = None
+        # only one pending checkpoint, to bound the memory with snapshots
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def register(self, filename, score=None):
+        '''Add an existing checkpoint (e.g. of a previous training) to the
+        retention policy'''
+        with self.lock:
+            self.history.append([filename, score])
+
+    def save(self, state, filename, score=None, retain=True):
+        '''Snapshot 'state' and write it to 'filename' in the background (with
+        'retain=False', the file is not in the retention policy, e.g. the
+        'last_checkpoint.pth.tar' overwritten during the training)'''
+        self._raise()
+        self.queue.put((state_to_cpu(state), filename, score if retain else False))
+
+    def wait(self):
+        '''Wait until all the pending checkpoints are written'''
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        '''Write the pending checkpoints and stop the worker thread'''
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            state, filename, score = item
+            try:
+                save_checkpoint(state, os.path.join(self.folder, filename))
+                if score is not False:
+                    with self.lock:
+                        self.history = [h for h in self.history if h[0] != filename]
+                        self.history.append([filename, score])
+                        self._retain()
+            except Exception as error:
+                self.error = error
+            del state, item
+            self.queue.task_done()
+
+    def _retain(self):
+        if self.keep_last is None:
+            return
+        keep = set(h[0] for h in self.history[-self.keep_last:]) if self.keep_last else set()
+        scored = [h for h in self.history if h[1] is not None]
+        scored.sort(key=lambda h: h[1], reverse=True)
+        keep |= set(h[0] for h in scored[:self.keep_best])
+        for filename, _ in [h for h in self.history if h[0] not in keep]:
+            try: os.remove(os.path.join(self.folder, filename))
+            except FileNotFoundError: pass
+        self.history = [h for h in self.history if h[0] in keep]
 
 # loading checkpoints
 def load_checkpoint(checkpoint, model, optimizer=None):
@@ -205,6 +542,50 @@ def load_checkpoint(checkpoint, model, optimizer=None):
     if optimizer:
         optimizer.load_state_dict(checkpoint['optimizer'])
 
+# per-sample transform of the 'm'-th augmentation (for m > 0) in 'get_loaders'
+# ('source_scale' as in 'augmentation_recipe')
+def recipe_transform(m, image_height, image_width, label_n=None, source_scale=(1.0, 1.0)):
+    if m < 2:
+        return Compose([ToTensor(n=1),
+                        Rotate(limit=[(m-1)*72,m*72], p=1.0),
+                        Resize(size=[image_height, image_width], n=label_n),
+                        FlipVertical(p=0.5),
+                        FlipHorizontal(p=0.5),
+                        # Mean and std, obtained from the dataset
+                        Normalize(n=1, mean=DRESDEN_MEAN,
+                                  std=DRESDEN_STD)]
+                        )
+    return Compose([ToTensor(n=1),
+                    Affine(size=affine_size(image_height, image_width, source_scale),
+                           scale=0.01*(m-1), p=0.5),
+                    Rotate(limit=[(m-1)*72,m*72], p=1.0),
+                    Resize(size=[image_height, image_width], n=label_n),
+                    FlipVertical(p=0.5),
+                    FlipHorizontal(p=0.5),
+                    # Mean and std, obtained from the dataset
+                    Normalize(n=1, mean=DRESDEN_MEAN,
+                              std=DRESDEN_STD)]
+                    )
+
+# resizing and normalizing the validation and testing images (without random
+# transforms, so the evaluations are the same in every epoch)
+def eval_transform(image_height, image_width, label_n=None):
+    return Compose([ToTensor(n=1),
+                    Resize(size=[image_height, image_width], n=label_n),
+                    Normalize(n=1, mean=DRESDEN_MEAN, std=DRESDEN_STD)])
+
+def eval_loader(image_dirs, image_height, image_width, batch_size, num_workers=1,
+                pin_memory=False, label_mode='index', manifest=None):
+    '''Return a loader of the frames of 'image_dirs' as in the validation
+    loader of 'get_loaders' (only resized and normalized), without building
+    the training datasets'''
+    index = DresdenIndex(image_dirs, manifest=manifest)
+    label_n = 1 if label_mode == 'index' else None
+    dataset = AugmentedDresdenDataset(index, [eval_transform(image_height, image_width, label_n)],
+                                      np.arange(len(index)), label_mode=label_mode)
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                      pin_memory=pin_memory)
+
 # getting loaders given directories and other informations
 def get_loaders(train_image_dir,
                 valid_percent,
@@ -216,30 +597,58 @@ def get_loaders(train_image_dir,
                 pin_memory=True,
                 val_image_dir=None,
                 clip_valid=1.0,
-                clip_train=1.0):
+                clip_train=1.0,
+                cache_bytes=0,
+                cache_dir=None,
+                batched_augmentation=False,
+                manifest=None,
+                label_mode='onehot',
+                distributed=False,
+                shards=None,
+                shuffle_buffer=256):
+
+    # optional cache of decoded frames, shared by all datasets and workers, so
+    # PNGs are decoded only once (and not once per augmentation and epoch)
+    if cache_bytes > 0:
+        frame_cache = FrameCache(root=cache_dir, max_bytes=cache_bytes)
+    else:
+        frame_cache = None
+
+    # with 'index' labels, they have to be resized with nearest interpolation
+    label_n = 1 if label_mode == 'index' else None
+
+    # with 'shards' (the 'manifest.json' written by 'shards.py'), the frames
+    # are read from pre-resized shards instead of the directories, and the
+    # translations of the augmentations are scaled to the stored size. The
+    # rotations and affines are then applied to the resized frames, which is
+    # the same geometry of the directories only if the resize keeps the
+    # aspect ratio (e.g. 1280x1024 to 640x512), apart from the interpolation
+    if shards:
+        shard_index = ShardIndex(shards)
+        source_scale = shard_index.scale
+        if abs(source_scale[0]/source_scale[1]-1) > 0.01:
+            print('\n- Warning: the shards do not keep the aspect ratio of the '
+                  'frames, so the rotations and affines differ from the ones of '
+                  'the directories')
+    else:
+        source_scale = [1.0, 1.0]
 
     # first, defining transformations to be applied in the train images to be loaded
     transform_train_0 = Compose([ToTensor(n=1),
-                                 Resize(size=[image_height, image_width]),
+                                 Resize(size=[image_height, image_width], n=label_n),
                                  FlipVertical(p=0.5),
                                  FlipHorizontal(p=0.5),
                                  # mean and std, obtained from Dresden Dataset
                                  # for segmentation
-                                 Normalize(n=1, mean=[0.4338, 0.31936, 0.312387],
-                                           std=[0.1904, 0.15638, 0.15657])]
+                                 Normalize(n=1, mean=DRESDEN_MEAN,
+                                           std=DRESDEN_STD)]
 #as funções feitas aqui foram feitas pelo marlon ,explicar no testo que essas biblitecas pode ser chamadas de function trasnforms, ele significa
                                 # não usar uma transformação do pytorchm, mas sim uma propria sua
 # essas trasnformações
                                 )
-    # defining the same, but for validation and testing images (can be different)
-    transform_valid_0 = Compose([ToTensor(n=1),
-                                 Resize(size=[image_height, image_width]),
-                                 FlipVertical(p=0.5),
-                                 FlipHorizontal(p=0.5),
-                                 # defining again if validation dataset is dif.
-                                 Normalize(n=1, mean=[0.4338, 0.31936, 0.312387],
-                                           std=[0.1904, 0.15638, 0.15657])]
-                                )
+    # defining the same, but for validation and testing images (without the
+    # random flips, so the evaluations are the same in every epoch)
+    transform_valid_0 = eval_transform(image_height, image_width, label_n)
 
     # second, defining the number of transformations per directory in
     # 'train_image_dir' defines the data augmantation (1 for no augmentation
@@ -247,21 +656,50 @@ def get_loaders(train_image_dir,
     transformations_per_dataset = [5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5,
                                    5, 5, 5, 5, 5, 5]
 
-    # third, reading the dataset in a as a 'torch.utils.data.Dataset' instance.
-    # it is only for images in 'train_image_dir[0]', further we will accounts
-    # for the rest of the directories
-    train_dataset = DresdenDataset(image_dir=train_image_dir[0],
-                                  transform=transform_train_0)
-    print("train_dataset:",train_dataset)
-
-    # concatenate the other directories in 'train_image_dir[:]' in a larger
-    # 'torhc.utils.data.Dataset'. after we will concatenate more for augmentat.
-    for n in range(1, len(train_image_dir)):
-        dataset_train_temp = DresdenDataset(image_dir=train_image_dir[n],
-                                           transform=transform_train_0)
-        # to use 'train_dataset' here in right, we have to define it before
-        train_dataset = torch.utils.data.ConcatDataset([train_dataset,
-                                                        dataset_train_temp])
+    # with 'batched_augmentation', samples are only converted to 'uint8'
+    # tensors, and the augmentations are applied to each collated batch by
+    # 'BatchAugment' (the 'recipe' of each sample selects its augmentation)
+    if batched_augmentation:
+        transform_train_0 = Compose([ToTensor(n=0)])
+        transform_valid_0 = transform_train_0
+        recipes = [augmentation_recipe(m, image_height, image_width, source_scale)
+                   for m in range(max(transformations_per_dataset))]
+        collate_fn = BatchCollate(BatchAugment(recipes, [image_height, image_width],
+                                               n=1, mean=DRESDEN_MEAN,
+                                               std=DRESDEN_STD))
+        # (the evaluation samples are only resized and normalized)
+        eval_collate_fn = BatchCollate(BatchAugment([AugmentRecipe(flip_v=0.0, flip_h=0.0)],
+                                                    [image_height, image_width],
+                                                    n=1, mean=DRESDEN_MEAN,
+                                                    std=DRESDEN_STD))
+    else:
+        collate_fn = None
+        eval_collate_fn = None
+
+    # the augmentation copies of each frame are (frame, recipe) pairs in one
+    # flat dataset, with recipe 'm' using the transform 'transforms[m]'
+    if batched_augmentation:
+        transforms = [transform_train_0]*max(transformations_per_dataset)
+    else:
+        transforms = [transform_train_0]+[recipe_transform(m, image_height, image_width,
+                                                           label_n, source_scale)
+                                          for m in range(1, max(transformations_per_dataset))]
+    if shards:
+        return shard_loaders(shard_index, transforms, transform_valid_0, collate_fn,
+                             eval_collate_fn,
+                             batch_size, num_workers, pin_memory, valid_percent,
+                             test_percent, clip_valid, clip_train, label_mode,
+                             batched_augmentation, distributed, shuffle_buffer,
+                             transformations_per_dataset)
+
+    # third, indexing all the frames in 'train_image_dir' (each directory is
+    # listed only once, or read from the 'manifest' file if it is given)
+    train_index = DresdenIndex(train_image_dir, manifest=manifest)
+    train_dataset = AugmentedDresdenDataset(train_index, transforms,
+                                            np.arange(len(train_index)),
+                                            cache=frame_cache,
+                                            emit_recipe=batched_augmentation,
+                                            label_mode=label_mode)
 
     # using part of the training data as test dataset
     test_dataset_size = int(test_percent*len(train_dataset))
@@ -270,6 +708,7 @@ def get_loaders(train_image_dir,
         rest_size += 1
     (test_dataset, _) = random_split(train_dataset, [test_dataset_size, rest_size],
                                      generator=(torch.Generator().manual_seed(40)))
+    test_dataset = train_dataset.subset(test_dataset.indices, [transform_valid_0])
 
     # defining the validation dataset, using part of the 'train_dataset', or
     # using a specific dataset for validation, if 'val_image_dir' is not 'None'
@@ -279,48 +718,34 @@ def get_loaders(train_image_dir,
         # adding one to train_dataset_size if 'int' operation removed it
         if valid_dataset_size+train_dataset_size != len(train_dataset):
             train_dataset_size += 1
-        (train_dataset, valid_dataset) = random_split(train_dataset,
+        (train_split, valid_split) = random_split(train_dataset,
                                          [train_dataset_size, valid_dataset_size],
                                          generator=torch.Generator().manual_seed(20))
+        valid_dataset = train_dataset.subset(valid_split.indices, [transform_valid_0])
+        frames = [train_dataset.frames[train_split.indices]]
     else:
-        valid_dataset = DresdenDataset(image_dir=val_image_dir[0],
-                                      transform=transform_valid_0)
-        for n in range(1, len(val_image_dir)):
-            dataset_val_temp = DresdenDataset(image_dir=val_image_dir[n],
-                                             transform=transform_valid_0)
-            valid_dataset = torch.utils.data.ConcatDataset([valid_dataset,
-                                                            dataset_val_temp])
-
-    # concatenating the augmented data, in case 'transf..._per_dataset' > 1
+        valid_index = DresdenIndex(val_image_dir, manifest=manifest)
+        valid_dataset = AugmentedDresdenDataset(valid_index, [transform_valid_0],
+                                                np.arange(len(valid_index)),
+                                                cache=frame_cache,
+                                                emit_recipe=batched_augmentation,
+                                                label_mode=label_mode)
+        frames = [train_dataset.frames]
+    recipes = [np.zeros(len(frames[0]), dtype=np.int64)]
+
+    # adding the augmented data, in case 'transf..._per_dataset' > 1 (only the
+    # indices are added, in the same order of the former concatenation)
     for n in range(0,len(train_image_dir)):
+        directory_frames = train_index.frames(n)
         for m in range(1, transformations_per_dataset[n]):
-            # first we specify the transformation (depending on the 'm' value)
-            if m < 2:
-                transformation = Compose([ToTensor(n=1),
-                                          Rotate(limit=[(m-1)*72,m*72], p=1.0),
-                                          Resize(size=[image_height, image_width]),
-                                          FlipVertical(p=0.5),
-                                          FlipHorizontal(p=0.5),
-                                          # Mean and std, obtained from the dataset
-                                          Normalize(n=1, mean=[0.4338, 0.31936, 0.312387],
-                                                    std=[0.1904, 0.15638, 0.15657])]
-                                          )
-            else:
-                transformation = Compose([ToTensor(n=1),
-                                          Affine(size=[0.5*image_height, 0.5*image_width],
-                                                 scale=0.01*(m-1), p=0.5),
-                                          Rotate(limit=[(m-1)*72,m*72], p=1.0),
-                                          Resize(size=[image_height, image_width]),
-                                          FlipVertical(p=0.5),
-                                          FlipHorizontal(p=0.5),
-                                          # Mean and std, obtained from the dataset
-                                          Normalize(n=1, mean=[0.4338, 0.31936, 0.312387],
-                                                    std=[0.1904, 0.15638, 0.15657])]
-                                          )
-            # then we apply this transformation to read the dataset as 'torch.utils.data.Dataset'
-            dataset_train_temp = DresdenDataset(image_dir=train_image_dir[n],
-                                               transform=transformation)
-            train_dataset = torch.utils.data.ConcatDataset([train_dataset, dataset_train_temp])
+            frames.append(directory_frames)
+            recipes.append(np.full(len(directory_frames), m, dtype=np.int64))
+    train_dataset = AugmentedDresdenDataset(train_index, transforms,
+                                            np.concatenate(frames),
+                                            np.concatenate(recipes),
+                                            cache=frame_cache,
+                                            emit_recipe=batched_augmentation,
+                                            label_mode=label_mode)
 
     # splitting the dataset, to deminish if 'clip_valid'<1 for fast testing
     if clip_train < 1:
@@ -329,78 +754,1124 @@ def get_loaders(train_image_dir,
         temp_mini = int((1-clip_train)*len(train_dataset))
         if train_mini+temp_mini != len(train_dataset):
             temp_mini += 1
-        (train_dataset, _) = random_split(train_dataset,[train_mini, temp_mini],
-                                          generator=torch.Generator().manual_seed(40))
+        (train_split, _) = random_split(train_dataset,[train_mini, temp_mini],
+                                        generator=torch.Generator().manual_seed(40))
+        train_dataset = train_dataset.subset(train_split.indices)
     if clip_valid < 1:
         print('\n- Splitting Validation Dataset ',clip_valid*100,'%')
         valid_mini = int(clip_valid*len(valid_dataset))
         temp_mini = int((1-clip_valid)*len(valid_dataset))
         if valid_mini+temp_mini != len(valid_dataset):
             temp_mini += 1
-        (valid_dataset, _) = random_split(valid_dataset,[valid_mini, temp_mini],
-                                          generator=torch.Generator().manual_seed(30))
-        (test_dataset, _) = random_split(test_dataset, [valid_mini, temp_mini],
-                                         generator=torch.Generator().manual_seed(50))
+        (valid_split, _) = random_split(valid_dataset,[valid_mini, temp_mini],
+                                        generator=torch.Generator().manual_seed(30))
+        valid_dataset = valid_dataset.subset(valid_split.indices)
+        (test_split, _) = random_split(test_dataset, [valid_mini, temp_mini],
+                                       generator=torch.Generator().manual_seed(50))
+        test_dataset = test_dataset.subset(test_split.indices)
+
+    # the training set is shuffled by a 'ResumableSampler' (call 'set_loader_
+    # position' in each epoch), and with 'distributed', each process uses a
+    # shard of the datasets (the evaluation ones split without repetitions)
+    if distributed and ddp.is_distributed():
+        train_sampler = ResumableSampler(train_dataset, seed=0, rank=ddp.get_rank(),
+                                         world_size=ddp.get_world_size())
+        test_sampler = ddp.ShardSampler(test_dataset)
+        valid_sampler = ddp.ShardSampler(valid_dataset)
+    else:
+        train_sampler = ResumableSampler(train_dataset)
+        test_sampler, valid_sampler = None, None
 
     # obtaining dataloader from the datasets defined above
     train_loader = DataLoader(train_dataset, batch_size=batch_size,
                               num_workers=num_workers,
-                              pin_memory=pin_memory, shuffle=True)
+                              pin_memory=pin_memory, sampler=train_sampler,
+                              collate_fn=collate_fn, generator=torch.Generator())
     test_loader = DataLoader(test_dataset, batch_size=batch_size,
                               num_workers=num_workers,
-                              pin_memory=pin_memory)
+                              pin_memory=pin_memory, sampler=test_sampler,
+                              collate_fn=eval_collate_fn)
     valid_loader = DataLoader(valid_dataset, batch_size=batch_size,
                               num_workers=num_workers,
-                              pin_memory=pin_memory)
+                              pin_memory=pin_memory, sampler=valid_sampler,
+                              collate_fn=eval_collate_fn)
 
     return train_loader, test_loader, valid_loader
 
-# functino to check accuracy
-def check_accuracy(loader, model, loss_fn, device='cuda' if torch.cuda.is_available() else 'cpu', **kwargs):
-    num_correct = 0
-    num_pixels = 0
-    dice_score = 0
+# loaders of 'get_loaders' reading from the shards of 'shards.py'
+def shard_loaders(shard_index, transforms, transform_valid_0, collate_fn,
+                  eval_collate_fn, batch_size, num_workers, pin_memory,
+                  valid_percent, test_percent, clip_valid, clip_train, label_mode,
+                  batched_augmentation, distributed, shuffle_buffer,
+                  transformations_per_dataset):
+    '''Return the loaders of 'get_loaders' with the frames of 'shard_index'
+
+    The datasets have the same (frame, recipe) samples of the datasets of the
+    directories (with the same random splits, augmentation copies and clips),
+    but the training set is a 'ShardStream' (each DataLoader worker reads its
+    part of the shards sequentially, so the samples come in another order).
+    The augmentations are applied to the stored frames, already resized (see
+    'get_loaders' for when they have the same geometry).
+    '''
+    frames = np.arange(shard_index.frames('train'))
+    # the test set is a part of the training frames (still used to train)
+    test_size = int(test_percent*len(frames))
+    rest_size = int((1-test_percent)*len(frames))
+    if test_size+rest_size != len(frames):
+        rest_size += 1
+    (test_split, _) = random_split(frames, [test_size, rest_size],
+                                   generator=(torch.Generator().manual_seed(40)))
+    test_dataset = ShardDataset(shard_index, 'train', [transform_valid_0],
+                                frames[test_split.indices],
+                                emit_recipe=batched_augmentation, label_mode=label_mode)
+    if not shard_index.frames('valid'):
+        valid_size = int(valid_percent*len(frames))
+        train_size = int((1-valid_percent)*len(frames))
+        if valid_size+train_size != len(frames):
+            train_size += 1
+        (train_split, valid_split) = random_split(frames, [train_size, valid_size],
+                                         generator=torch.Generator().manual_seed(20))
+        valid_dataset = ShardDataset(shard_index, 'train', [transform_valid_0],
+                                     frames[valid_split.indices],
+                                     emit_recipe=batched_augmentation, label_mode=label_mode)
+        train_frames = [frames[train_split.indices]]
+    else:
+        valid_dataset = ShardDataset(shard_index, 'valid', [transform_valid_0],
+                                     emit_recipe=batched_augmentation, label_mode=label_mode)
+        train_frames = [frames]
+    recipes = [np.zeros(len(train_frames[0]), dtype=np.int64)]
+
+    # the augmented copies are all the frames of each directory (also the
+    # validation ones), in the same order of the directory path
+    directory = shard_index.directory('train')
+    for n in range(directory.max()+1 if len(directory) else 0):
+        directory_frames = np.flatnonzero(directory == n)
+        for m in range(1, transformations_per_dataset[n]):
+            train_frames.append(directory_frames)
+            recipes.append(np.full(len(directory_frames), m, dtype=np.int64))
+    train_frames, recipes = np.concatenate(train_frames), np.concatenate(recipes)
+
+    if clip_train < 1:
+        print('\n- Splitting Training Dataset ',clip_train*100,'%')
+        train_mini = int(clip_train*len(train_frames))
+        temp_mini = int((1-clip_train)*len(train_frames))
+        if train_mini+temp_mini != len(train_frames):
+            temp_mini += 1
+        (train_split, _) = random_split(train_frames, [train_mini, temp_mini],
+                                        generator=torch.Generator().manual_seed(40))
+        train_frames = train_frames[train_split.indices]
+        recipes = recipes[train_split.indices]
+    if clip_valid < 1:
+        print('\n- Splitting Validation Dataset ',clip_valid*100,'%')
+        valid_mini = int(clip_valid*len(valid_dataset))
+        temp_mini = int((1-clip_valid)*len(valid_dataset))
+        if valid_mini+temp_mini != len(valid_dataset):
+            temp_mini += 1
+        (valid_split, _) = random_split(valid_dataset, [valid_mini, temp_mini],
+                                        generator=torch.Generator().manual_seed(30))
+        valid_dataset = valid_dataset.subset(valid_split.indices)
+        (test_split, _) = random_split(test_dataset, [valid_mini, temp_mini],
+                                       generator=torch.Generator().manual_seed(50))
+        test_dataset = test_dataset.subset(test_split.indices)
+
+    distributed = distributed and ddp.is_distributed()
+    train_dataset = ShardStream(shard_index, 'train', transforms, train_frames,
+                                recipes, shuffle_buffer=shuffle_buffer,
+                                rank=ddp.get_rank() if distributed else 0,
+                                world_size=ddp.get_world_size() if distributed else 1,
+                                emit_recipe=batched_augmentation, label_mode=label_mode)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size,
+                              num_workers=num_workers, pin_memory=pin_memory,
+                              collate_fn=collate_fn, generator=torch.Generator())
+    test_loader = DataLoader(test_dataset, batch_size=batch_size,
+                             num_workers=num_workers, pin_memory=pin_memory,
+                             sampler=ddp.ShardSampler(test_dataset) if distributed else None,
+                             collate_fn=eval_collate_fn)
+    valid_loader = DataLoader(valid_dataset, batch_size=batch_size,
+                              num_workers=num_workers, pin_memory=pin_memory,
+                              sampler=ddp.ShardSampler(valid_dataset) if distributed else None,
+                              collate_fn=eval_collate_fn)
+    return train_loader, test_loader, valid_loader
+
+# batch normalization momentum for gradient accumulation
+def accumulation_momentum(model, accumulation_steps, momentum=0.1):
+    '''Set the BN momentum of 'model' for 'accumulation_steps' micro-batches
+
+    The running statistics are updated once per micro-batch, so the momentum
+    'm' is changed to '1-(1-m)**(1/accumulation_steps)', which gives the same
+    decay of the old statistics per optimizer step as 'm' without accumulation.
+    '''
+    for module in model.modules():
+        if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+            module.momentum = 1-(1-momentum)**(1/accumulation_steps)
+    return model
+
+# expanding labels to float one-hot targets (on the labels' device)
+def expand_labels(y, num_classes):
+    '''Return float one-hot labels with 'num_classes' channels
+
+    y: tensor (input)
+        'onehot' labels (returned as float) or 'index' labels with one channel
+        and the class index plus one (0 is no class, see 'dataset.read_sample');
+    num_classes: int (input)
+        number of classes (channels in the output of the model).
+    '''
+    if y.shape[1] == num_classes or num_classes == 1:
+        return y.float()
+    y = torch.nn.functional.one_hot(y[:,0].long(), num_classes+1)[..., 1:]
+    return y.permute(0, 3, 1, 2).float()
+
+# streaming confusion matrix, to compute the metrics over a whole dataset
+class ConfusionMatrix(object):
+    '''Per-class confusion matrix accumulated on the compute device
+
+    Each 'update' costs a single 'torch.bincount' on the device, and nothing
+    is copied to the host until 'compute' is called.
+
+    num_classes: int (input)
+        number of classes;
+    device: str (input)
+        device to accumulate the matrix (the same of the predictions).
+
+    The entry '[i, j]' counts the pixels of class 'i' predicted as class 'j'.
+    '''
+    def __init__(self, num_classes, device='cpu'):
+        self.num_classes = num_classes
+        self.matrix = torch.zeros(num_classes, num_classes, dtype=torch.int64,
+                                  device=device)
+
+    def update(self, pred, target):
+        '''Accumulate class indices 'pred' and 'target' (negative targets are
+        ignored, e.g. pixels with no class)'''
+        valid = target >= 0
+        index = target[valid]*self.num_classes+pred[valid]
+        self.matrix += torch.bincount(index, minlength=self.num_classes**2).view(
+            self.num_classes, self.num_classes)
+
+    def all_reduce(self):
+        '''Sum the matrices of all processes (in distributed training)'''
+        if ddp.is_distributed():
+            dist.all_reduce(self.matrix)
+        return self
+
+    def accuracy(self):
+        '''Return the pixel accuracy as a 0-dim tensor (no host sync)'''
+        return self.matrix.diag().sum()/self.matrix.sum().clamp(min=1)
+
+    def compute(self):
+        '''Return a dictionary with the pixel accuracy and the per-class Dice,
+        IoU, precision and recall (lists of floats, in [0.0,1.0])'''
+        matrix = self.matrix.double()
+        tp = matrix.diag()
+        fp = matrix.sum(0)-tp
+        fn = matrix.sum(1)-tp
+        dice = 2*tp/(2*tp+fp+fn).clamp(min=1)
+        metrics = {'accuracy': (tp.sum()/matrix.sum().clamp(min=1)).item(),
+                   'dice': dice.tolist(),
+                   'iou': (tp/(tp+fp+fn).clamp(min=1)).tolist(),
+                   'precision': (tp/(tp+fp).clamp(min=1)).tolist(),
+                   'recall': (tp/(tp+fn).clamp(min=1)).tolist()}
+        metrics['mean dice'] = sum(metrics['dice'])/self.num_classes
+        metrics['mean iou'] = sum(metrics['iou'])/self.num_classes
+        return metrics
+
+# class indices of the model outputs and labels
+def prediction_classes(pred):
+    '''Return the predicted class of each pixel (threshold 0.5 for 1 channel)'''
+    if pred.shape[1] == 1:
+        return (pred[:,0] > 0.5).long()
+    return pred.argmax(1)
+
+def label_classes(y, num_classes):
+    '''Return the class of each pixel of 'onehot' or 'index' labels (see
+    'expand_labels'), with -1 in the pixels without class'''
+    if num_classes == 1:
+        return y[:,0].long()
+    if y.shape[1] == 1:
+        return y[:,0].long()-1
+    classes = y.argmax(1)
+    classes[y.amax(1) <= 0] = -1
+    return classes
+
+#%% Resumable Training
+
+# The state saved in 'last_checkpoint.pth.tar' (see 'training_state') has all
+# that is needed to continue an interrupted training from the same batch.
+
+class ResumableSampler(Sampler):
+    '''Random sampler of the training set that can resume inside an epoch
+
+    The permutation of each epoch only depends on 'seed' and on the epoch (set
+    by 'set_epoch'), so the order of an interrupted epoch can be made again,
+    and the first 'skip' samples (e.g. the ones already trained) are skipped
+    in the next iteration. With 'world_size' > 1, each process gets the
+    samples 'rank::world_size' of the permutation (padded to the same length
+    in all processes, as 'DistributedSampler').
+
+    seed: int (input)
+        seed of the permutations (random if 'None', it has to be the same in
+        all processes);
+    rank, world_size: int (input)
+        rank and number of processes.
+    '''
+    def __init__(self, dataset, seed=None, rank=0, world_size=1):
+        self.length = len(dataset)
+        if seed is None:
+            seed = int(torch.randint(0, 2**31-1, ()).item())
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.skip = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def indices(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed+self.epoch)
+        order = torch.randperm(self.length, generator=generator).tolist()
+        total = math.ceil(self.length/self.world_size)*self.world_size
+        order += order[:total-len(order)]
+        return order[self.rank:total:self.world_size]
+
+    def __iter__(self):
+        order = self.indices()[self.skip:]
+        self.skip = 0
+        return iter(order)
+
+    def __len__(self):
+        return max(math.ceil(self.length/self.world_size)-self.skip, 0)
+
+    def state_dict(self):
+        return {'seed': self.seed}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+
+
+def set_loader_position(loader, epoch, batches=0):
+    '''Set the epoch of the training 'loader' (for its shuffle), skipping its
+    first 'batches' batches in the next iteration (to resume an epoch)'''
+    if hasattr(loader.sampler, 'set_epoch'):
+        loader.sampler.set_epoch(epoch)
+        loader.sampler.skip = batches*loader.batch_size
+    # 'ShardStream' shuffles the shards itself
+    if hasattr(loader.dataset, 'set_epoch'):
+        loader.dataset.set_epoch(epoch)
+        loader.dataset.skip_batches(batches, loader.batch_size)
+    # the seeds of the workers are drawn from 'loader.generator', so they also
+    # depend only on the epoch (and the global generator is not used by the
+    # loader, so it is the same after resuming)
+    source = loader.sampler if hasattr(loader.sampler, 'seed') else loader.dataset
+    if loader.generator is not None and hasattr(source, 'seed'):
+        loader.generator.manual_seed(source.seed+epoch)
+
+def loader_state(loader):
+    for source in (loader.sampler, loader.dataset):
+        if hasattr(source, 'state_dict'):
+            return source.state_dict()
+    return None
+
+def load_loader_state(loader, state):
+    for source in (loader.sampler, loader.dataset):
+        if state is not None and hasattr(source, 'load_state_dict'):
+            source.load_state_dict(state)
+            return
+
+
+def rng_state():
+    '''Return the states of the Python, NumPy and torch random generators'''
+    numpy_state = np.random.get_state(legacy=False)
+    state = {'python': random.getstate(),
+             # as tensors and numbers, to be loaded with 'weights_only'
+             'numpy': {'key': torch.from_numpy(numpy_state['state']['key'].astype(np.int64)),
+                       'pos': int(numpy_state['state']['pos']),
+                       'has_gauss': int(numpy_state['has_gauss']),
+                       'gauss': float(numpy_state['gauss'])},
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    numpy_state = state['numpy']
+    np.random.set_state(('MT19937', numpy_state['key'].numpy().astype(np.uint32),
+                         numpy_state['pos'], numpy_state['has_gauss'],
+                         numpy_state['gauss']))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def training_state(model, optimizer, schedule=None, scaler=None, loader=None, **counters):
+    '''Return the full state of a training, to continue it from the same batch
+
+    Besides 'state_dict' and 'optimizer' (as the other checkpoints, so it can
+    also be loaded by 'load_checkpoint'), it has the states of 'schedule',
+    'scaler', the shuffle of 'loader' and the random generators, and the
+    'counters' (e.g. epoch, batches trained in the epoch, metric history).
+    '''
+    return {'state_dict': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'schedule': schedule.state_dict() if schedule is not None else None,
+            'scaler': scaler.state_dict() if scaler is not None else None,
+            'loader': loader_state(loader) if loader is not None else None,
+            'rng': rng_state(),
+            **counters}
+
+def restore_training_state(state, model, optimizer, schedule=None, scaler=None,
+                           loader=None):
+    '''Load a state of 'training_state' (the random generators last)'''
+    print('\n- Loading Training State...')
+    model.load_state_dict(state['state_dict'])
+    optimizer.load_state_dict(state['optimizer'])
+    if schedule is not None and state.get('schedule') is not None:
+        schedule.load_state_dict(state['schedule'])
+    if scaler is not None and state.get('scaler') is not None:
+        scaler.load_state_dict(state['scaler'])
+    if loader is not None:
+        load_loader_state(loader, state.get('loader'))
+    set_rng_state(state['rng'])
+
+
+#%% Image Output
+
+class ImageWriter(object):
+    '''Encode and write images in a thread pool, with a bounded queue
+
+    The PNG encoding and the disk writes run in 'workers' threads, concurrently
+    with the next forward pass. When 'max_pending' images are waiting, 'submit'
+    blocks, so the memory used by pending images is bounded.
+
+    workers: int (input)
+        number of threads;
+    max_pending: int (input)
+        maximum number of images waiting to be written.
+    '''
+    def __init__(self, workers=4, max_pending=32):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, function, *args, **kwargs):
+        '''Run 'function(*args, **kwargs)' in the pool (blocking if full)'''
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(function, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        # keeping only unfinished futures (and raising the first error of the
+        # others, after the new future is tracked, so 'wait' still awaits it)
+        pending = [f for f in self.futures if not f.done()]
+        errors = [f.exception() for f in self.futures if f.done() and f.exception()]
+        self.futures = pending+[future]
+        if errors:
+            raise errors[0]
+        return future
+
+    def save_image(self, tensor, filename):
+        '''Like 'torchvision.utils.save_image', but in the pool'''
+        return self.submit(save_image, tensor.detach().cpu(), filename)
+
+    def save_array(self, array, filename):
+        '''Save an 'uint8' 'ndarray' (HxW or HxWx3) as an image, in the pool'''
+        return self.submit(lambda: Image.fromarray(array).save(filename))
+
+    def wait(self):
+        '''Wait until all submitted images are written (raising the first
+        error only after all of them finished)'''
+        futures, self.futures = self.futures, []
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown()
+
+
+#%% Precision Policy
+
+# The same policy is used in the training ('train_fn'), the evaluation
+# ('evaluate', 'check_accuracy') and the inference ('predict.py', 'sweep.py'):
+# the forward passes run in 'torch.autocast' with its dtype, while the
+# weights, the gradients and the optimizer states stay in float32.
+
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+class Precision(object):
+    '''Precision of the forward passes (autocast dtype and loss scaling)
+
+    dtype: str (input)
+        'fp32' (no autocast), 'bf16', 'fp16' or 'auto' ('fp16' in CUDA and
+        'bf16' in CPU);
+    device: str (input)
+        device of the model.
+
+    The loss is only scaled (by a 'GradScaler', see 'scaler') with 'fp16',
+    whose small exponent range makes small gradients underflow ('bf16' has
+    the same range of 'fp32').
+    '''
+    def __init__(self, dtype='auto', device='cpu'):
+        self.device_type = 'cuda' if str(device).startswith('cuda') else 'cpu'
+        if dtype == 'auto':
+            dtype = 'fp16' if self.device_type == 'cuda' else 'bf16'
+        if dtype not in PRECISIONS:
+            raise ValueError(f"precision '{dtype}' is not 'auto' or one of "+
+                             ', '.join(PRECISIONS))
+        self.name = dtype
+        self.dtype = PRECISIONS[dtype]
+
+    @property
+    def enabled(self):
+        return self.dtype != torch.float32
+
+    def autocast(self):
+        '''Return the context of the forward passes'''
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def scaler(self):
+        '''Return a new 'GradScaler' if the loss has to be scaled, or 'None' '''
+        if self.name != 'fp16':
+            return None
+        if hasattr(torch.amp, 'GradScaler'):
+            return torch.amp.GradScaler(self.device_type)
+        if self.device_type == 'cuda':
+            return torch.cuda.amp.GradScaler()
+        raise ValueError("'fp16' in CPU needs the 'torch.amp.GradScaler' (torch 2.3 or newer)")
+
+    def __repr__(self):
+        return f"Precision('{self.name}', '{self.device_type}')"
+
+
+#%% Compiled Mode
+
+# In the compiled mode, the forward of the model (with its backward), the loss
+# and the optimizer step are compiled by 'torch.compile' in their first call,
+# and the model and its inputs use the channels_last layout (NHWC, faster for
+# the convolutions in CPU and in tensor cores). If a compilation fails, that
+# function runs in eager mode from then on (the error is kept in 'errors').
+
+class CompiledFunction(object):
+    '''Call 'function' compiled by 'torch.compile', or in eager mode after a
+    failure, recording the time of the first (compiling) call'''
+    def __init__(self, function, name, owner, **options):
+        # with the attributes of 'function' (e.g. the mark of the schedulers
+        # in the steps of the optimizers)
+        functools.update_wrapper(self, function)
+        self.function = function
+        self.name = name
+        self.owner = owner
+        try:
+            self.compiled = torch.compile(function, **options)
+        except Exception as error:
+            self.fallback(error)
+
+    def fallback(self, error):
+        message = str(error).splitlines()[0] if str(error) else ''
+        print(f"\n- Compilation of '{self.name}' failed, running it in eager mode "
+              f"({type(error).__name__}: {message})")
+        self.owner.errors[self.name] = error
+        self.compiled = None
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.function(*args, **kwargs)
+        first = self.name not in self.owner.compile_times
+        start = time.perf_counter()
+        try:
+            output = self.compiled(*args, **kwargs)
+        except Exception as error:
+            # the eager function runs again from the start (the compiled one
+            # fails before changing the weights, the gradients or the states)
+            self.fallback(error)
+            return self.function(*args, **kwargs)
+        if first:
+            self.owner.compile_times[self.name] = time.perf_counter()-start
+        return output
+
+
+class CompiledMode(object):
+    '''Opt-in 'torch.compile' and channels_last layout of the training and
+    inference steps
+
+    enabled: bool (input)
+        if 'False', the functions run in eager mode (only the layout changes);
+    channels_last: bool (input)
+        if 'True', the model and the inputs use 'torch.channels_last' ('None'
+        uses it only in the compiled mode);
+    mode: str (input)
+        mode of 'torch.compile' ('None', 'reduce-overhead', 'max-autotune');
+    dynamic: bool (input)
+        'dynamic' of 'torch.compile' ('False' compiles again for each new
+        batch shape, e.g. the last batch of an epoch).
+
+    The time of the first call of each compiled function (the compilation)
+    is in 'compile_times', apart from the steady-state steps (see 'report').
+    '''
+    def __init__(self, enabled=False, channels_last=None, mode=None, dynamic=False):
+        self.enabled = enabled
+        self.channels_last = enabled if channels_last is None else channels_last
+        self.options = {'mode': mode, 'dynamic': dynamic}
+        self.compile_times = {}
+        self.errors = {}
+        self.functions = {}
+
+    @property
+    def memory_format(self):
+        return torch.channels_last if self.channels_last else torch.contiguous_format
+
+    @property
+    def compiling(self):
+        '''If a function did not finish its first (compiling) call yet'''
+        return self.enabled and any(name not in self.compile_times and name not in self.errors
+                                    for name in self.functions)
+
+    def function(self, function, name):
+        '''Return 'function' compiled (the same object for the same 'name')'''
+        if not self.enabled:
+            return function
+        if name not in self.functions:
+            self.functions[name] = CompiledFunction(function, name, self, **self.options)
+        return self.functions[name]
+
+    def model(self, model):
+        '''Use channels_last in 'model' and compile its forward (in place, so
+        its 'state_dict' keeps the same keys)'''
+        model.to(memory_format=self.memory_format)
+        if self.enabled:
+            model.forward = self.function(model.forward, 'model')
+        return model
+
+    def loss(self, loss_fn):
+        '''Compile the forward of the loss 'loss_fn' (in place)'''
+        if self.enabled:
+            loss_fn.forward = self.function(loss_fn.forward, 'loss')
+        return loss_fn
+
+    def optimizer(self, optimizer):
+        '''Compile the step of 'optimizer' (in place, after creating its
+        scheduler, which also wraps the step). The learning rates are changed
+        to tensors, otherwise each new value of the scheduler would compile
+        the step again (call it again after loading a state of the optimizer,
+        with float rates)'''
+        if self.enabled:
+            for group in optimizer.param_groups:
+                if not torch.is_tensor(group['lr']):
+                    group['lr'] = torch.tensor(float(group['lr']))
+            if 'optimizer' not in self.functions:
+                optimizer.step = self.function(optimizer.step, 'optimizer')
+        return optimizer
+
+    def inputs(self, x):
+        '''Return 'x' (a batch of images) in the layout of the model'''
+        if x.dim() != 4:
+            return x
+        return x.contiguous(memory_format=self.memory_format)
+
+    def report(self):
+        '''Return a string with the compile time of each function'''
+        if not self.enabled:
+            return 'eager mode'
+        rows = [f'{name}: {seconds:.1f} s' for name, seconds in self.compile_times.items()]
+        rows += [f'{name}: eager ({type(error).__name__})' for name, error in self.errors.items()]
+        return 'compile time, '+', '.join(rows) if rows else 'not compiled yet'
+
+
+#%% Timing and Profiling
+
+# The time of each stage of the training and evaluation loops (data loading,
+# forward, backward, optimizer, metrics, image saving, checkpointing) is
+# recorded by a 'StageTimer', and written to 'timing.csv' at each epoch.
+
+class StageTimer(object):
+    '''Record the wall time of named stages, and the peak memory
+
+    Use 'with timer.stage(name):' around each stage, and 'timer.iterate(loader,
+    name)' to record the time waiting for the batches of a loader. With CUDA,
+    the device is synchronized at the end of each stage (if 'synchronize'),
+    otherwise the asynchronous kernels would be counted in the next stage.
+
+    device: str (input)
+        device used by the model (to synchronize and read its peak memory);
+    enabled: bool (input)
+        if 'False', nothing is recorded (and nothing is synchronized);
+    synchronize: bool (input)
+        if 'True', the CUDA device is synchronized after each stage.
+    '''
+    def __init__(self, device='cpu', enabled=True, synchronize=True):
+        self.device = str(device)
+        self.enabled = enabled
+        self.synchronize = synchronize and self.device.startswith('cuda')
+        self.reset()
+
+    def reset(self):
+        '''Clear the recorded times and restart the peak memory'''
+        self.times = {}
+        self.start = time.perf_counter()
+        if self.enabled:
+            reset_peak_memory(self.device)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            # the stages are also labeled in the 'torch.profiler' traces
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.times.setdefault(name, []).append(time.perf_counter()-start)
+
+    def iterate(self, iterable, name='data'):
+        '''Yield the items of 'iterable', recording the time waiting for them'''
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+            yield item
+
+    def summary(self):
+        '''Return a list of dicts with the statistics of each stage'''
+        elapsed = time.perf_counter()-self.start
+        memory = peak_memory(self.device)/1024**2
+        rows = []
+        for name, times in self.times.items():
+            times = np.asarray(times)
+            rows.append({'stage': name, 'calls': len(times),
+                         'seconds': times.sum(),
+                         'mean (ms)': 1000*times.mean(),
+                         'median (ms)': 1000*np.median(times),
+                         'max (ms)': 1000*times.max(),
+                         'share (%)': 100*times.sum()/elapsed,
+                         'peak memory (MB)': memory})
+        return rows
+
+    def to_csv(self, filename, epoch):
+        '''Append the summary of 'epoch' to 'filename' (and reset the timer)'''
+        rows = pd.DataFrame([{'epoch': epoch, **row} for row in self.summary()])
+        rows.to_csv(filename, mode='a', index=False, float_format='%.4f',
+                    header=not os.path.isfile(filename))
+        self.reset()
+        return rows
+
+
+def peak_memory(device='cpu'):
+    '''Return the peak memory (in bytes) since the last 'reset_peak_memory'
+
+    In CUDA it is the peak of the tensors allocated by torch, and in CPU the
+    peak resident memory of the process (in Linux, the 'VmHWM' of '/proc').
+    '''
+    if str(device).startswith('cuda'):
+        return torch.cuda.max_memory_allocated()
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        import resource
+        # 'ru_maxrss' is in kB in Linux (and in bytes in macOS), and is never reset
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    except ImportError:
+        return 0
+
+def reset_peak_memory(device='cpu'):
+    if str(device).startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats()
+        return
+    # writing '5' to 'clear_refs' resets 'VmHWM' to the current memory (Linux)
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+def make_profiler(filename, skip=2, steps=3, device='cpu'):
+    '''Return a 'torch.profiler.profile' that records 'steps' steps
+
+    After 'skip' steps (the first one is also a warm-up), 'steps' steps are
+    recorded, and the trace is exported to 'filename' (open it in 'chrome://
+    tracing' or 'https://ui.perfetto.dev'). Call 'profiler.step()' at the end
+    of each step, inside 'with profiler:'.
+    '''
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if str(device).startswith('cuda'):
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    schedule = torch.profiler.schedule(wait=max(skip-1, 0), warmup=min(skip, 1),
+                                       active=steps, repeat=1)
+    return torch.profiler.profile(activities=activities, schedule=schedule,
+                                  on_trace_ready=lambda p: p.export_chrome_trace(filename),
+                                  record_shapes=True, profile_memory=True)
+
+
+#%% Evaluation Runner
+
+# The evaluation runs one forward pass per sample, for a set of named loaders,
+# and gives the results to a set of sinks (metrics, images, per-image scores).
+
+class EvaluationSink(object):
+    '''Base class of the sinks used by 'evaluate' (all methods are optional)'''
+    def start(self, name, loader):
+        pass
+
+    def update(self, name, batch_idx, x, y, pred):
+        '''Called for each batch, with the input 'x', the label 'y' (cropped to
+        the prediction size, still 'onehot' or 'index') and the output 'pred' '''
+        pass
+
+    def finish(self, name):
+        pass
+
+    def progress(self, name):
+        '''Return a dictionary to show in the progress bar (or 'None')'''
+        return None
+
+
+class MetricSink(EvaluationSink):
+    '''Confusion matrix and loss of each loader (see 'ConfusionMatrix')
+
+    loss_fn: (input)
+        loss function, computed with the thresholded prediction ('None' to not
+        compute the loss).
+
+    After 'evaluate', 'results[name]' has the tuple (accuracy, loss of the
+    last batch, mean Dice score, metrics dictionary), with values in %. In
+    distributed training, the metrics are of the shards of all processes.
+    '''
+    def __init__(self, loss_fn=None):
+        self.loss_fn = loss_fn
+        self.confusion = {}
+        self.loss = {}
+        self.results = {}
+
+    def start(self, name, loader):
+        self.confusion[name] = None
+        self.loss[name] = torch.zeros(())
+
+    def update(self, name, batch_idx, x, y, pred):
+        if self.confusion[name] is None:
+            self.confusion[name] = ConfusionMatrix(max(pred.shape[1], 2), device=pred.device)
+        self.confusion[name].update(prediction_classes(pred), label_classes(y, pred.shape[1]))
+        if self.loss_fn is not None:
+            self.loss[name] = self.loss_fn((pred > 0.5).float(), expand_labels(y, pred.shape[1]))
+
+    def finish(self, name):
+        # only now the results are copied to the host
+        metrics = self.confusion.pop(name).all_reduce().compute()
+        self.results[name] = (100*metrics['accuracy'], self.loss.pop(name).item(),
+                              100*metrics['mean dice'], metrics)
+
+    def progress(self, name):
+        return {'acc': str(round(100*self.confusion[name].accuracy().item(),4))}
+
+
+class ImageSink(EvaluationSink):
+    '''Save predictions and labels as 'pred_{idx}.png' and 'y_{idx}.png'
+
+    folder: str (input)
+        folder to save the images;
+    loaders: list (input)
+        names of the loaders to save ('None' for all);
+    max_batches: int (input)
+        number of batches to save per loader ('None' for all);
+    gray: bool (input)
+        if 'True', the images are saved in three channels;
+    writer: 'ImageWriter' (input)
+        if given, the images are encoded and written in its thread pool.
+    '''
+    def __init__(self, folder, loaders=None, max_batches=None, gray=False,
+                 writer=None):
+        self.folder = folder
+        self.loaders = loaders
+        self.max_batches = max_batches
+        self.gray = gray
+        self.writer = writer
+
+    def update(self, name, batch_idx, x, y, pred):
+        if self.loaders is not None and name not in self.loaders:
+            return
+        if self.max_batches is not None and batch_idx >= self.max_batches:
+            return
+        save_prediction(pred, y, self.folder, batch_idx, gray=self.gray,
+                        writer=self.writer)
+
+
+class ScoreSink(EvaluationSink):
+    '''Per-image accuracy and Dice scores, optionally written to a 'csv' file
+
+    filename: str (input)
+        'csv' file to write (with '{name}' replaced by the loader name), or
+        'None' to only keep the scores in 'scores[name]'.
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.counts = {}
+        self.scores = {}
+
+    def start(self, name, loader):
+        self.counts[name] = []
+
+    def update(self, name, batch_idx, x, y, pred):
+        # one confusion matrix per image, with a single 'bincount'
+        C = max(pred.shape[1], 2)
+        target = label_classes(y, pred.shape[1])
+        index = prediction_classes(pred)+C*target
+        index = index+(C*C)*torch.arange(len(pred), device=pred.device)[:,None,None]
+        index = index[target >= 0]
+        counts = torch.bincount(index, minlength=len(pred)*C*C)
+        self.counts[name].append(counts.view(len(pred), C, C))
+
+    def gather(self, name):
+        '''Return the confusion matrices of the images of 'name', (N,C,C) '''
+        counts = torch.cat(self.counts.pop(name)).double().cpu()
+        # in distributed training, the scores of the shards ('ShardSampler')
+        # are gathered and put back in the order of the dataset
+        if ddp.is_distributed():
+            shards = [None]*ddp.get_world_size()
+            dist.all_gather_object(shards, counts)
+            counts = torch.zeros((sum(len(c) for c in shards),)+counts.shape[1:],
+                                 dtype=counts.dtype)
+            for rank, shard in enumerate(shards):
+                counts[rank::len(shards)] = shard
+        return counts
+
+    def finish(self, name):
+        counts = self.gather(name)
+        tp = counts.diagonal(dim1=1, dim2=2)
+        fp = counts.sum(1)-tp
+        fn = counts.sum(2)-tp
+        # if a class is absent in the label and prediction, its Dice is 1.0
+        dice = torch.where(2*tp+fp+fn > 0, 2*tp/(2*tp+fp+fn).clamp(min=1),
+                           torch.ones_like(tp))
+        accuracy = tp.sum(1)/counts.sum((1,2)).clamp(min=1)
+        self.scores[name] = {'index': list(range(len(counts))),
+                             'accuracy': (100*accuracy).tolist(),
+                             'dice': (100*dice.mean(1)).tolist()}
+        for c in range(dice.shape[1]):
+            self.scores[name]['dice class '+str(c)] = (100*dice[:,c]).tolist()
+        if self.filename and ddp.is_main_process():
+            pd.DataFrame(self.scores[name]).to_csv(self.filename.format(name=name),
+                                                   index=False)
+
+
+class IntervalSink(ScoreSink):
+    '''Confidence intervals of the accuracy and mean Dice score of each loader
+
+    The confusion matrices of the images (see 'ScoreSink') are resampled by
+    a bootstrap stratified by the directory of the images, and the metrics of
+    each resample are computed as in 'MetricSink' (from the summed matrix).
+    The interval is the metric plus or minus the normal quantile times their
+    standard deviation, with the finite population correction when the
+    loader is a subset of 'population' images (so the whole set has no
+    uncertainty).
+
+    population: dict (input)
+        number of images of the whole set of each loader name (optional);
+    level: float (input)
+        confidence level of the intervals (e.g. 0.95);
+    resamples: int (input)
+        number of bootstrap resamples;
+    seed: int (input)
+        seed of the resamples (the same images give the same intervals).
+
+    After 'evaluate', 'intervals[name]' has the dictionary {'accuracy': (low,
+    high), 'dice': (low, high), 'images': N, 'population': N or 'None',
+    'level': level}, with the metrics in %.
+    '''
+    def __init__(self, population=None, level=0.95, resamples=1000, seed=0):
+        super().__init__()
+        self.population = population or {}
+        self.level = level
+        self.resamples = resamples
+        self.seed = seed
+        self.strata = {}
+        self.intervals = {}
+
+    def start(self, name, loader):
+        super().start(name, loader)
+        dataset = loader.dataset
+        if hasattr(dataset, 'directory'):
+            self.strata[name] = np.asarray(dataset.directory())
+        else:
+            self.strata[name] = np.zeros(len(dataset), dtype=np.int64)
+
+    def finish(self, name):
+        counts = self.gather(name)
+        strata = self.strata.pop(name)
+        N, C = counts.shape[0], counts.shape[1]
+        # each resample is a weighted sum of the matrices of the images, with
+        # the number of times each one was drawn (in its own directory)
+        generator = torch.Generator().manual_seed(self.seed)
+        matrices = torch.zeros(self.resamples, C*C, dtype=counts.dtype)
+        for stratum in np.unique(strata):
+            members = torch.from_numpy(np.nonzero(strata == stratum)[0])
+            draws = torch.randint(len(members), (self.resamples, len(members)),
+                                  generator=generator)
+            weights = torch.zeros(self.resamples, len(members), dtype=counts.dtype)
+            weights.scatter_add_(1, draws, torch.ones_like(weights))
+            matrices += weights@counts[members].view(len(members), C*C)
+        accuracy, dice = pooled_metrics(matrices.view(-1, C, C))
+        point = pooled_metrics(counts.sum(0, keepdim=True))
+        population = self.population.get(name)
+        correction = math.sqrt(max(1-N/population, 0.0)) if population else 1.0
+        z = statistics.NormalDist().inv_cdf(0.5+self.level/2)
+        self.intervals[name] = {'images': N, 'population': population,
+                                'level': self.level}
+        for key, values, value in [('accuracy', accuracy, point[0]), ('dice', dice, point[1])]:
+            margin = z*correction*values.std().item()
+            value = value.item()
+            self.intervals[name][key] = (100*max(value-margin, 0.0),
+                                         100*min(value+margin, 1.0))
+
+
+# pooled metrics of a batch of confusion matrices (as 'ConfusionMatrix')
+def pooled_metrics(matrices):
+    '''Return the accuracy and mean Dice score of each matrix of 'matrices'
+    (B,C,C), in [0.0,1.0]'''
+    tp = matrices.diagonal(dim1=1, dim2=2)
+    fp = matrices.sum(1)-tp
+    fn = matrices.sum(2)-tp
+    accuracy = tp.sum(1)/matrices.sum((1,2)).clamp(min=1)
+    dice = (2*tp/(2*tp+fp+fn).clamp(min=1)).mean(1)
+    return accuracy, dice
+
+
+def evaluate(loaders, model, sinks, device='cuda' if torch.cuda.is_available() else 'cpu',
+             refresh=10, timer=None, progress=True, precision=None):
+    '''Run 'model' once over each loader, passing every batch to all 'sinks'
+
+    loaders: dict (input)
+        dictionary of named loaders (e.g. {'valid': valid_loader});
+    sinks: list (input)
+        list of 'EvaluationSink' (e.g. 'MetricSink', 'ImageSink');
+    refresh: int (input)
+        batches between progress bar updates (each update syncs the host);
+    timer: 'StageTimer' (input)
+        if given, records the time of the data loading, the forward and each
+        sink (as 'eval data', 'eval forward' and e.g. 'eval MetricSink');
+    progress: bool (input)
+        if 'False', the progress bar is not shown;
+    precision: 'Precision' (input)
+        precision of the forward passes ('None' for float32).
+    '''
+    if timer is None:
+        timer = StageTimer(enabled=False)
+    if precision is None:
+        precision = Precision('fp32')
+    # (the mode of the model is restored at the end, e.g. for training)
+    was_training = model.training
     model.eval()
+    try:
+        with torch.no_grad():
+            for name, loader in loaders.items():
+                for sink in sinks:
+                    sink.start(name, loader)
+                # using tqdm.tqdm to show a progress bar
+                loop = tqdm(loader, desc=(name+': ' if name else '')+'Check acc',
+                            disable=not (progress and ddp.is_main_process()))
+                for batch_idx, dictionary in enumerate(timer.iterate(loop, 'eval data')):
+                    image, label = dictionary
+                    with timer.stage('eval forward'):
+                        x, y = dictionary[image], dictionary[label]
+                        x, y = x.to(device=device), y.to(device=device)
+                        with precision.autocast():
+                            pred = model(x)
+                        y = tf.center_crop(y, pred.shape[2:])
+                    for sink in sinks:
+                        with timer.stage('eval '+type(sink).__name__):
+                            sink.update(name, batch_idx, x, y, pred)
+                    if batch_idx % refresh == 0:
+                        postfix = {}
+                        for sink in sinks:
+                            postfix.update(sink.progress(name) or {})
+                        if postfix:
+                            loop.set_postfix(**postfix)
+                    # deliting variables
+                    del pred, x, y, image, label, dictionary
+                for sink in sinks:
+                    with timer.stage('eval '+type(sink).__name__):
+                        sink.finish(name)
+    finally:
+        model.train(was_training)
+
+def check_accuracy(loader, model, loss_fn, device='cuda' if torch.cuda.is_available() else 'cpu', **kwargs):
+    '''Evaluate 'model' in 'loader', returning the accuracy, the loss of the
+    last batch and the mean Dice score (in %)
+
+    The metrics are computed from a confusion matrix accumulated on 'device'
+    over the whole loader. Optional keyword arguments: 'title' (printed before
+    the results), 'refresh' (batches between progress bar updates, default 10),
+    'timer' (a 'StageTimer' to record the time of each stage), 'precision' (a
+    'Precision' of the forward passes) and 'return_metrics' (if 'True', the
+    dictionary of 'ConfusionMatrix.compute' is also returned).
+    '''
     # if title is passed, use it before 'Check acc' and 'Got an accuracy...'
     title = kwargs.get('title')
     if title==None: title = ''
-    else: title = title+': '
-    # using tqdm.tqdm to show a progress bar
-    loop = tqdm(loader, desc=title+'Check acc')
-
-    with torch.no_grad():
-        for dictionary in loop:
-            image, label = dictionary
-            x, y = dictionary[image], dictionary[label]
-            x, y = x.to(device=device), y.to(device=device)
-            y = y.float()
-            pred = model(x)
-            y = tf.center_crop(y, pred.shape[2:])
-            pred = (pred > 0.5).float()
-            loss = loss_fn(pred, y)
-            num_correct += (pred == y).sum()
-            num_pixels += torch.numel(pred)
-            # next is to calculate dice-score
-            pred = pred.to(device='cpu').to(torch.int32)
-            y = y.to(device='cpu').to(torch.int32)
-            dice = Dice(ignore_index=0)
-            dice_score += dice(pred, y)
-            loop.set_postfix(acc=str(round(100*num_correct.item()/int(num_pixels),4)))
-            # deliting variables
-            loss_item = loss.item()
-            del loss, pred, x, y, image, label, dictionary
-    # deliting variables
-    num_correct_item = num_correct.item()
-    num_pixels = int(num_pixels)
-    dice_score_item = dice_score.item()
-    len_loader = len(loader)
-    del num_correct, dice_score, loader, loop
-
-    print('\n'+title+f'Got an accuracy of {round(100*num_correct_item/int(num_pixels),4)}')
-
-    print('\n'+title+f'Dice score: {round(100*dice_score_item/len_loader,4)}'+'\n')
-    model.train()
-    return 100*num_correct_item/num_pixels, loss_item, 100*dice_score_item/len_loader
+    # updating the progress bar forces a host sync, so only every 'refresh'
+    refresh = kwargs.get('refresh')
+    if not refresh: refresh = 10
+    metric = MetricSink(loss_fn)
+    evaluate({title: loader}, model, [metric], device=device, refresh=refresh,
+             timer=kwargs.get('timer'), precision=kwargs.get('precision'))
+    acc, loss_item, dice, metrics = metric.results[title]
+    print_metrics(title, acc, dice)
+    if kwargs.get('return_metrics'):
+        return acc, loss_item, dice, metrics
+    return acc, loss_item, dice
+
+# printing the accuracy and dice score of an evaluation (and their intervals,
+# a dictionary of 'IntervalSink.intervals')
+def print_metrics(title, acc, dice, interval=None):
+    # in distributed training, only the first process prints
+    if not ddp.is_main_process():
+        return
+    if title: title = title+': '
+    print('\n'+title+f'Got an accuracy of {round(acc,4)}')
+
+    print('\n'+title+f'Dice score: {round(dice,4)}'+'\n')
+    if interval is not None:
+        of = ' of '+str(interval['population']) if interval['population'] else ''
+        print(title+f"{round(100*interval['level'])}% intervals with "
+              f"{interval['images']}{of} images: accuracy "
+              f"{round(interval['accuracy'][0],4)}-{round(interval['accuracy'][1],4)}, "
+              f"Dice score {round(interval['dice'][0],4)}-{round(interval['dice'][1],4)}\n")
+
+# saving the prediction and label of a batch as images
+def save_prediction(pred, y, folder, idx, gray=False, writer=None):
+    y = expand_labels(y, pred.shape[1])
+    pred = (pred > 0.5).float()
+    # If image is grayscale, transforming to 'rgb' (utils.save_image needs)
+    if gray:
+        pred = torch.cat([pred,pred,pred],1)
+        y = y.unsqueeze(1)
+        y = torch.cat([y,y,y],1)
+        y = y.float()
+        y = tf.center_crop(y, pred.shape[2:])
+    # with a 'writer', the encoding and writing run in its thread pool
+    save = writer.save_image if writer is not None else save_image
+    save(pred, f'{folder}/pred_{idx}.png')
+    save(y, f'{folder}/y_{idx}.png')
 
 # saving images (only if the output are images)
 def save_predictions_as_imgs(loader, model, folder='saved_images',
@@ -408,31 +1879,125 @@ def save_predictions_as_imgs(loader, model, folder='saved_images',
                              **kwargs):
     # If image is grayscale, if yes, we have to turn into rgb to save
     gray = kwargs.get('gray')
-    # With model in evaluation
-    model.eval()
-    for idx, (dictionary) in enumerate(loader):
-        image, label = dictionary
-        x, y = dictionary[image], dictionary[label]
-        x = x.to(device=device)
-        y = y.to(dtype=torch.float32)
-        y = y.to(device=device)
-        with torch.no_grad():
-            pred = model(x)
-            y = tf.center_crop(y, pred.shape[2:])
-            pred = (pred > 0.5).float()
-        # If image is grayscale, transforming to 'rgb' (utils.save_image needs)
-        if gray:
-            pred = torch.cat([pred,pred,pred],1)
-            y = y.unsqueeze(1)
-            y = torch.cat([y,y,y],1)
-            y = y.float()
-            y = tf.center_crop(y, pred.shape[2:])
-        save_image(pred, f'{folder}/pred_{idx}.png')
-        save_image(y, f'{folder}/y_{idx}.png')
-
-    model.train()
-
-from google.colab import drive
-drive.mount('/content/gdrive')
-
-# -*- coding: utf-8 -*-
+    writer = ImageWriter()
+    evaluate({'': loader}, model, [ImageSink(folder, gray=gray, writer=writer)],
+             device=device, precision=kwargs.get('precision'))
+    writer.close()
+
+
+#%% Evaluation Schedule
+
+# Evaluating the whole validation and test sets in every epoch can take as
+# long as the training, so in some epochs only a fixed subset is evaluated.
+
+def stratified_subset(strata, fraction, minimum=1, seed=0):
+    '''Return the sorted indices of 'fraction' of the samples of each stratum
+
+    strata: ndarray (input)
+        stratum of each sample (e.g. 'dataset.directory()');
+    fraction: float (input)
+        fraction of the samples chosen in each stratum;
+    minimum: int (input)
+        minimum samples per stratum (or all of them, if it has less);
+    seed: int (input)
+        seed of the choice (the same seed gives the same subset).
+    '''
+    strata = np.asarray(strata)
+    rng = np.random.default_rng(seed)
+    indices = []
+    for stratum in np.unique(strata):
+        members = np.nonzero(strata == stratum)[0]
+        size = min(len(members), max(minimum, int(round(fraction*len(members)))))
+        indices.append(rng.choice(members, size, replace=False))
+    return np.sort(np.concatenate(indices)) if indices else np.zeros(0, dtype=np.int64)
+
+def subset_loader(loader, indices):
+    '''Return a loader like 'loader', but with only the samples 'indices' of
+    its dataset (with 'ShardSampler' if 'loader' has one)'''
+    dataset = loader.dataset.subset(indices)
+    sampler = None
+    if isinstance(loader.sampler, ddp.ShardSampler):
+        sampler = ddp.ShardSampler(dataset)
+    return DataLoader(dataset, batch_size=loader.batch_size,
+                      num_workers=loader.num_workers, pin_memory=loader.pin_memory,
+                      sampler=sampler, collate_fn=loader.collate_fn)
+
+
+class EvaluationSchedule(object):
+    '''Choose the loaders evaluated in each epoch
+
+    The whole datasets are evaluated every 'full_every' epochs (and in the
+    last one), and in the other epochs a subset with 'fraction' of the images
+    of each directory is evaluated. The subset is chosen once (with 'seed'),
+    and its loaders are built once and reused, so the subset metrics of
+    different epochs are comparable. Use 'interval_sink' to also have their
+    confidence intervals.
+
+    loaders: dict (input)
+        named evaluation loaders (e.g. {'Validating': valid_loader});
+    full_every: int (input)
+        epochs between full evaluations (1 evaluates everything every epoch);
+    fraction: float (input)
+        fraction of each directory in the subset;
+    minimum: int (input)
+        minimum images per directory in the subset;
+    seed: int (input)
+        seed of the subset.
+    '''
+    def __init__(self, loaders, full_every=1, fraction=0.1, minimum=4, seed=0):
+        self.full = loaders
+        self.full_every = full_every
+        self.fraction = fraction
+        self.minimum = minimum
+        self.seed = seed
+        self.subsets = None
+
+    def is_full(self, epoch, last=False):
+        return last or self.full_every is None or self.full_every <= 1 or \
+            (epoch+1) % self.full_every == 0
+
+    def loaders(self, epoch, last=False):
+        '''Return the named loaders to evaluate in 'epoch' (from 0)'''
+        if self.is_full(epoch, last):
+            return self.full
+        if self.subsets is None:
+            self.subsets = {}
+            for name, loader in self.full.items():
+                dataset = loader.dataset
+                strata = (dataset.directory() if hasattr(dataset, 'directory')
+                          else np.zeros(len(dataset), dtype=np.int64))
+                indices = stratified_subset(strata, self.fraction, self.minimum,
+                                            self.seed)
+                self.subsets[name] = subset_loader(loader, indices)
+        return self.subsets
+
+    def interval_sink(self, **kwargs):
+        '''Return an 'IntervalSink' for the subset loaders (with the sizes of
+        the whole datasets as population)'''
+        population = {name: len(loader.dataset) for name, loader in self.full.items()}
+        return IntervalSink(population=population, **kwargs)
+
+    def to_csv(self, filename, epoch, results, intervals=None):
+        '''Append the metrics of 'epoch' to 'filename', with 'results' of a
+        'MetricSink' and 'intervals' of an 'IntervalSink' (if any)'''
+        rows = []
+        for name, (acc, _, dice, _) in results.items():
+            row = {'epoch': epoch, 'loader': name,
+                   'evaluation': 'subset' if intervals else 'full',
+                   'accuracy': acc, 'dice': dice}
+            if intervals and name in intervals:
+                interval = intervals[name]
+                row.update({'images': interval['images'],
+                            'accuracy low': interval['accuracy'][0],
+                            'accuracy high': interval['accuracy'][1],
+                            'dice low': interval['dice'][0],
+                            'dice high': interval['dice'][1]})
+            else:
+                row.update({'images': len(self.full[name].dataset),
+                            'accuracy low': acc, 'accuracy high': acc,
+                            'dice low': dice, 'dice high': dice})
+            rows.append(row)
+        rows = pd.DataFrame(rows)
+        rows.to_csv(filename, mode='a', index=False, float_format='%.4f',
+                    header=not os.path.isfile(filename))
+        return rows